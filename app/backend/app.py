@@ -1,17 +1,43 @@
 import os
-import io
+import hmac
+import json
+import tempfile
 import mimetypes
 import time
 import logging
+from typing import Optional
 import openai
-from flask import Flask, request, jsonify, send_file, abort
-from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
+from quart import Quart, Response, request, jsonify, abort
+from quart.wrappers.response import FileBody
+from werkzeug.http import http_date, parse_date
+from azure.core import MatchConditions
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+from azure.identity.aio import DefaultAzureCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.readretrieveread import ReadRetrieveReadApproach
 from approaches.readdecomposeask import ReadDecomposeAsk
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient
+from blobcache import BlobDiskCache
+from batch import run_batch
+from retrievalcache import CachedSearchClient, CoalescingSearchClient
+from localsearch import LocalIndexSearchClient, TieredSearchClient, VectorSearchClient
+from rewritecache import QueryRewriteCache
+import metrics
+from promptbudget import get_tokenizer
+from tokenrefresher import TokenRefresher
+from httppool import HttpPool
+from opentelemetry import trace
+from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
+from opentelemetry.util.http import parse_excluded_urls
+from tracing import configure_tracing
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.environ.get("AZURE_STORAGE_ACCOUNT")
@@ -22,142 +48,677 @@ AZURE_OPENAI_SERVICE = os.environ.get("AZURE_OPENAI_SERVICE")
 AZURE_OPENAI_GPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT")
 AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT")
 
+# Optional: other endpoints than the public Azure ones (e.g. the local stand-ins used by benchmarks/harness.py) and
+# keys to use instead of the Azure AD identity, per service
+AZURE_OPENAI_ENDPOINT = (
+    os.environ.get("AZURE_OPENAI_ENDPOINT")
+    or f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+)
+AZURE_SEARCH_ENDPOINT = (
+    os.environ.get("AZURE_SEARCH_ENDPOINT")
+    or f"https://{AZURE_SEARCH_SERVICE}.search.windows.net"
+)
+AZURE_STORAGE_ENDPOINT = (
+    os.environ.get("AZURE_STORAGE_ENDPOINT")
+    or f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net"
+)
+AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY")
+AZURE_SEARCH_KEY = os.environ.get("AZURE_SEARCH_KEY")
+AZURE_STORAGE_KEY = os.environ.get("AZURE_STORAGE_KEY")
+
 KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
 KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
 
-# Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
-# just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
-# keys for each service
-# If you encounter a blocking error during a DefaultAzureCredntial resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
-azure_credential = DefaultAzureCredential()
+# Size of the pieces /content streams blobs in, and how long browsers may reuse a citation file without revalidating
+CONTENT_CHUNK_SIZE = int(os.environ.get("CONTENT_CHUNK_SIZE") or 256 * 1024)
+CONTENT_CACHE_MAX_AGE = int(os.environ.get("CONTENT_CACHE_MAX_AGE") or 3600)
+
+# Local disk cache for content files shared by all workers on the machine, set CONTENT_DISK_CACHE_MAX_BYTES to 0 to disable it.
+# Cached files are served without contacting Blob Storage for CONTENT_DISK_CACHE_REVALIDATE_SECONDS, then their ETag is checked again.
+CONTENT_DISK_CACHE_DIR = os.environ.get("CONTENT_DISK_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "content-cache"
+)
+CONTENT_DISK_CACHE_MAX_BYTES = int(
+    os.environ.get("CONTENT_DISK_CACHE_MAX_BYTES") or 256 * 1024 * 1024
+)
+CONTENT_DISK_CACHE_REVALIDATE_SECONDS = float(
+    os.environ.get("CONTENT_DISK_CACHE_REVALIDATE_SECONDS") or 300
+)
+
+# Search results are reused for identical queries for SEARCH_CACHE_TTL_SECONDS (0 disables the cache). Ingestion can
+# drop them earlier by calling /cache/invalidate with the SEARCH_CACHE_INVALIDATION_KEY secret.
+SEARCH_CACHE_TTL_SECONDS = float(os.environ.get("SEARCH_CACHE_TTL_SECONDS") or 300)
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES") or 1000)
+SEARCH_CACHE_INVALIDATION_KEY = os.environ.get("SEARCH_CACHE_INVALIDATION_KEY")
+
+# Local BM25 index of the same sections as the search index, exported by the ingestion scripts (--localindex), used
+# according to LOCAL_INDEX_MODE: "fallback" when Search fails or takes longer than LOCAL_INDEX_SEARCH_TIMEOUT_SECONDS,
+# "first" before Search, which is only called when the local index finds nothing, or "hybrid" merged with Search's
+# results (see TieredSearchClient)
+LOCAL_INDEX_PATH = os.environ.get("LOCAL_INDEX_PATH")
+LOCAL_INDEX_MODE = os.environ.get("LOCAL_INDEX_MODE") or "fallback"
+LOCAL_INDEX_SEARCH_TIMEOUT_SECONDS = float(
+    os.environ.get("LOCAL_INDEX_SEARCH_TIMEOUT_SECONDS") or 10
+)
+
+# Local vector index of the same sections, exported by the ingestion scripts (--vectorindex) with the embedding function
+# they were given, used like the BM25 index according to VECTOR_INDEX_MODE. The default hashing embedding only matches
+# shared words and word stems, so it adds no semantic recall: it doesn't find the sections answering questions worded
+# differently than the policies (see the paraphrase recall of benchmarks/vectors.py), that takes a python: embedding
+# backed by a model.
+# VECTOR_INDEX_NPROBE is how many of the lists of a partitioned index (--vectorlists) are searched, more finds more of
+# the closest sections but takes longer
+VECTOR_INDEX_PATH = os.environ.get("VECTOR_INDEX_PATH")
+VECTOR_INDEX_MODE = os.environ.get("VECTOR_INDEX_MODE") or "hybrid"
+VECTOR_INDEX_NPROBE = int(os.environ.get("VECTOR_INDEX_NPROBE") or 8)
+
+# Chat search queries generated by the rewrite completion are kept in a SQLite file shared by all workers,
+# set QUERY_REWRITE_CACHE_MAX_ENTRIES to 0 to disable it
+QUERY_REWRITE_CACHE_PATH = os.environ.get("QUERY_REWRITE_CACHE_PATH") or os.path.join(
+    tempfile.gettempdir(), "query-rewrites.sqlite"
+)
+QUERY_REWRITE_CACHE_MAX_ENTRIES = int(
+    os.environ.get("QUERY_REWRITE_CACHE_MAX_ENTRIES") or 10000
+)
+
+# Start searching for the user's question while the chat query rewrite is running, requests can also set the
+# "speculative_retrieval" override
+SPECULATIVE_RETRIEVAL = (os.environ.get("SPECULATIVE_RETRIEVAL") or "").lower() == "true"
+
+# Build the chat search query locally from the keywords of the question, without the rewrite completion, when there
+# is no earlier turn to take into account or the question is already a short keyword search. Requests can also set
+# the "keyword_query_fast_path" override
+KEYWORD_QUERY_FAST_PATH = (
+    os.environ.get("KEYWORD_QUERY_FAST_PATH") or "true"
+).lower() == "true"
+
+# Chat searches only return the sections of the policies of the DNI or CUIT the customer identified with (the dni and
+# cuit fields written by scripts/data-ingestion-v2.py), and nothing until they give one. "auto" (the default) turns it
+# on only when the index has those fields and they are filterable, which the index scripts/prepdocs.py writes doesn't;
+# "true" or "false" skip the check
+CUSTOMER_SCOPED_SEARCH = (os.environ.get("CUSTOMER_SCOPED_SEARCH") or "auto").lower()
+
+# Chat messages with a policy number, CUIT or DNI are answered from the sections having it, looked up with a filter on
+# the npoliza, cuit or dni field instead of a search query rewritten by GPT. Like CUSTOMER_SCOPED_SEARCH, and
+# independently of it, "auto" (the default) turns it on only when the index has all three fields and they are
+# filterable. Requests can also set the "identifier_fast_path" override
+IDENTIFIER_FAST_PATH = (os.environ.get("IDENTIFIER_FAST_PATH") or "auto").lower()
+
+# Prompts are sized with this tokenizer (cl100k_base is the gpt-35-turbo encoding) so that the sources and chat history
+# sent never overflow the context window of the deployments
+PROMPT_TOKENIZER_ENCODING = os.environ.get("PROMPT_TOKENIZER_ENCODING") or "cl100k_base"
+AZURE_OPENAI_GPT_CONTEXT_WINDOW = int(os.environ.get("AZURE_OPENAI_GPT_CONTEXT_WINDOW") or 4097)
+AZURE_OPENAI_CHATGPT_CONTEXT_WINDOW = int(
+    os.environ.get("AZURE_OPENAI_CHATGPT_CONTEXT_WINDOW") or 4096
+)
+
+# /ask/batch answers up to ASK_BATCH_MAX_QUESTIONS questions per request, ASK_BATCH_CONCURRENCY of them at a time
+# (requests can ask for less with "concurrency")
+ASK_BATCH_MAX_QUESTIONS = int(os.environ.get("ASK_BATCH_MAX_QUESTIONS") or 500)
+ASK_BATCH_CONCURRENCY = int(os.environ.get("ASK_BATCH_CONCURRENCY") or 8)
+
+# Connection pool shared by every call to OpenAI, Cognitive Search and Blob Storage (per worker process)
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT") or 100)
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST") or 50)
+HTTP_KEEPALIVE_SECONDS = float(os.environ.get("HTTP_KEEPALIVE_SECONDS") or 60)
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("HTTP_CONNECT_TIMEOUT_SECONDS") or 10)
+HTTP_READ_TIMEOUT_SECONDS = float(os.environ.get("HTTP_READ_TIMEOUT_SECONDS") or 120)
+
+# Set TRACING_EXPORTER to "file" to write request, approach, LangChain and Azure SDK spans as JSON lines to
+# TRACING_FILE (one file per worker, "{pid}" is replaced by its process id), or to "otlp" to send them to the collector
+# set in OTEL_EXPORTER_OTLP_ENDPOINT
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER") or ""
+TRACING_FILE = os.environ.get("TRACING_FILE") or os.path.join(
+    tempfile.gettempdir(), "traces-{pid}.jsonl"
+)
 
 # Used by the OpenAI SDK
 openai.api_type = "azure"
-openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+openai.api_base = AZURE_OPENAI_ENDPOINT
 openai.api_version = "2023-05-15"
 
-# Comment these two lines out if using keys, set your API key in the OPENAI_API_KEY environment variable instead
-openai.api_type = "azure_ad"
-openai_token = azure_credential.get_token(
-    "https://cognitiveservices.azure.com/.default"
-)
-openai.api_key = openai_token.token
+if AZURE_OPENAI_KEY:
+    openai.api_key = AZURE_OPENAI_KEY
+else:
+    openai.api_type = "azure_ad"
 
-# Set up clients for Cognitive Search and Storage
-search_client = SearchClient(
-    endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-    index_name=AZURE_SEARCH_INDEX,
-    credential=azure_credential,
-)
-blob_client = BlobServiceClient(
-    account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
-    credential=azure_credential,
+# Clients and approaches are created once the event loop is running (see setup_clients), one set per worker process.
+# All of them are async, so a single worker can keep many conversations in flight while waiting on OpenAI, Cognitive
+# Search or Blob Storage.
+azure_credential = None
+openai_token_refresher = None
+http_pool = None
+search_client = None
+blob_client = None
+blob_container = None
+query_rewrite_cache = None
+content_cache = (
+    BlobDiskCache(
+        CONTENT_DISK_CACHE_DIR,
+        CONTENT_DISK_CACHE_MAX_BYTES,
+        CONTENT_DISK_CACHE_REVALIDATE_SECONDS,
+    )
+    if CONTENT_DISK_CACHE_MAX_BYTES > 0
+    else None
 )
-blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
 
 # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
 # or some derivative, here we include several for exploration purposes
-ask_approaches = {
-    "rtr": RetrieveThenReadApproach(
-        search_client,
-        AZURE_OPENAI_GPT_DEPLOYMENT,
-        KB_FIELDS_SOURCEPAGE,
-        KB_FIELDS_CONTENT,
-    ),
-    "rrr": ReadRetrieveReadApproach(
-        search_client,
-        AZURE_OPENAI_GPT_DEPLOYMENT,
-        KB_FIELDS_SOURCEPAGE,
-        KB_FIELDS_CONTENT,
-    ),
-    "rda": ReadDecomposeAsk(
-        search_client,
-        AZURE_OPENAI_GPT_DEPLOYMENT,
-        KB_FIELDS_SOURCEPAGE,
-        KB_FIELDS_CONTENT,
-    ),
-}
-
-chat_approaches = {
-    "rrr": ChatReadRetrieveReadApproach(
-        search_client,
-        AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-        AZURE_OPENAI_GPT_DEPLOYMENT,
-        KB_FIELDS_SOURCEPAGE,
-        KB_FIELDS_CONTENT,
+ask_approaches = {}
+chat_approaches = {}
+
+tracer_provider = (
+    configure_tracing(TRACING_EXPORTER, TRACING_FILE) if TRACING_EXPORTER else None
+)
+
+app = Quart(__name__)
+if tracer_provider:
+    # One span per request, for streamed responses it lasts until the last event is sent
+    app.asgi_app = OpenTelemetryMiddleware(
+        app.asgi_app, excluded_urls=parse_excluded_urls("metrics")
+    )
+
+
+async def get_filterable_fields():
+    """Names of the filterable fields of the search index, none when its definition can't be read."""
+    try:
+        async with SearchIndexClient(
+            endpoint=AZURE_SEARCH_ENDPOINT,
+            credential=AzureKeyCredential(AZURE_SEARCH_KEY)
+            if AZURE_SEARCH_KEY
+            else azure_credential,
+        ) as index_client:
+            index = await index_client.get_index(AZURE_SEARCH_INDEX)
+    except Exception:
+        logging.warning(
+            "Could not read the definition of the %s index, searches filtering on its fields are turned off",
+            AZURE_SEARCH_INDEX,
+            exc_info=True,
+        )
+        return set()
+    return {field.name for field in index.fields if field.filterable}
+
+
+def is_enabled(name, setting, filterable_fields, required_fields):
+    """Whether a "true", "false" or "auto" setting is on, "auto" meaning the index has the fields it filters on."""
+    if setting != "auto":
+        return setting == "true"
+    enabled = set(required_fields) <= filterable_fields
+    if not enabled:
+        logging.info(
+            "%s is off, the %s index has no filterable %s fields",
+            name,
+            AZURE_SEARCH_INDEX,
+            ", ".join(sorted(set(required_fields) - filterable_fields)),
+        )
+    return enabled
+
+
+@app.before_serving
+async def setup_clients():
+    global azure_credential, openai_token_refresher, http_pool, search_client, blob_client, blob_container, query_rewrite_cache
+
+    # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
+    # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, set AZURE_OPENAI_KEY,
+    # AZURE_SEARCH_KEY and AZURE_STORAGE_KEY for the services that should use one
+    # If you encounter a blocking error during a DefaultAzureCredntial resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
+    azure_credential = DefaultAzureCredential()
+
+    # Without a key the token is renewed in the background well before it expires, so requests never wait on Azure AD
+    if not AZURE_OPENAI_KEY:
+        openai_token_refresher = TokenRefresher(
+            azure_credential,
+            "https://cognitiveservices.azure.com/.default",
+            on_refresh=lambda token: setattr(openai, "api_key", token.token),
+        )
+        await openai_token_refresher.start()
+
+    http_pool = HttpPool(
+        HTTP_POOL_LIMIT,
+        HTTP_POOL_LIMIT_PER_HOST,
+        HTTP_KEEPALIVE_SECONDS,
+        HTTP_CONNECT_TIMEOUT_SECONDS,
+        HTTP_READ_TIMEOUT_SECONDS,
     )
-}
 
-app = Flask(__name__)
+    # Set up clients for Cognitive Search and Storage
+    # Identical searches running at the same time are sent once (see CoalescingSearchClient)
+    search_client = CoalescingSearchClient(
+        SearchClient(
+            endpoint=AZURE_SEARCH_ENDPOINT,
+            index_name=AZURE_SEARCH_INDEX,
+            credential=AzureKeyCredential(AZURE_SEARCH_KEY)
+            if AZURE_SEARCH_KEY
+            else azure_credential,
+            transport=http_pool.azure_transport(),
+        )
+    )
+    if SEARCH_CACHE_TTL_SECONDS > 0:
+        search_client = CachedSearchClient(
+            search_client,
+            SEARCH_CACHE_TTL_SECONDS,
+            SEARCH_CACHE_MAX_ENTRIES,
+            os.path.join(tempfile.gettempdir(), f"search-cache-{AZURE_SEARCH_INDEX}"),
+        )
+    # In front of the cache, so results the local index stood in for are not kept once Search is back
+    if LOCAL_INDEX_PATH:
+        search_client = TieredSearchClient(
+            search_client,
+            LocalIndexSearchClient(LOCAL_INDEX_PATH, KB_FIELDS_CONTENT),
+            LOCAL_INDEX_MODE,
+            LOCAL_INDEX_SEARCH_TIMEOUT_SECONDS,
+        )
+    if VECTOR_INDEX_PATH:
+        search_client = TieredSearchClient(
+            search_client,
+            VectorSearchClient(VECTOR_INDEX_PATH, KB_FIELDS_CONTENT, VECTOR_INDEX_NPROBE),
+            VECTOR_INDEX_MODE,
+            LOCAL_INDEX_SEARCH_TIMEOUT_SECONDS,
+            name="vector",
+        )
+    blob_client = BlobServiceClient(
+        account_url=AZURE_STORAGE_ENDPOINT,
+        credential={"account_name": AZURE_STORAGE_ACCOUNT, "account_key": AZURE_STORAGE_KEY}
+        if AZURE_STORAGE_KEY
+        else azure_credential,
+        transport=http_pool.azure_transport(),
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE,
+    )
+    blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+    if QUERY_REWRITE_CACHE_MAX_ENTRIES > 0:
+        query_rewrite_cache = QueryRewriteCache(
+            QUERY_REWRITE_CACHE_PATH, QUERY_REWRITE_CACHE_MAX_ENTRIES
+        )
+    tokenizer = get_tokenizer(PROMPT_TOKENIZER_ENCODING)
+    filterable_fields = (
+        await get_filterable_fields()
+        if "auto" in (CUSTOMER_SCOPED_SEARCH, IDENTIFIER_FAST_PATH)
+        else set()
+    )
+    customer_scoped_search = is_enabled(
+        "CUSTOMER_SCOPED_SEARCH", CUSTOMER_SCOPED_SEARCH, filterable_fields, ("dni", "cuit")
+    )
+    identifier_fast_path = is_enabled(
+        "IDENTIFIER_FAST_PATH",
+        IDENTIFIER_FAST_PATH,
+        filterable_fields,
+        ("npoliza", "cuit", "dni"),
+    )
+
+    ask_approaches.update(
+        {
+            "rtr": RetrieveThenReadApproach(
+                search_client,
+                AZURE_OPENAI_GPT_DEPLOYMENT,
+                KB_FIELDS_SOURCEPAGE,
+                KB_FIELDS_CONTENT,
+                tokenizer,
+                AZURE_OPENAI_GPT_CONTEXT_WINDOW,
+            ),
+            "rrr": ReadRetrieveReadApproach(
+                search_client,
+                AZURE_OPENAI_GPT_DEPLOYMENT,
+                KB_FIELDS_SOURCEPAGE,
+                KB_FIELDS_CONTENT,
+            ),
+            "rda": ReadDecomposeAsk(
+                search_client,
+                AZURE_OPENAI_GPT_DEPLOYMENT,
+                KB_FIELDS_SOURCEPAGE,
+                KB_FIELDS_CONTENT,
+            ),
+        }
+    )
+
+    chat_approaches.update(
+        {
+            "rrr": ChatReadRetrieveReadApproach(
+                search_client,
+                AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+                AZURE_OPENAI_GPT_DEPLOYMENT,
+                KB_FIELDS_SOURCEPAGE,
+                KB_FIELDS_CONTENT,
+                query_rewrite_cache,
+                SPECULATIVE_RETRIEVAL,
+                KEYWORD_QUERY_FAST_PATH,
+                tokenizer,
+                AZURE_OPENAI_CHATGPT_CONTEXT_WINDOW,
+                customer_scoped_search,
+                identifier_fast_path,
+            )
+        }
+    )
+
+
+@app.after_serving
+async def close_clients():
+    if openai_token_refresher:
+        await openai_token_refresher.stop()
+    await search_client.close()
+    await blob_client.close()
+    await azure_credential.close()
+    if query_rewrite_cache:
+        query_rewrite_cache.close()
+    await http_pool.close()
+    if tracer_provider:
+        tracer_provider.shutdown()
+
+
+# openai only reuses connections through the session set in its context variable, which has to be set in the context
+# of each request
+@app.before_request
+async def use_http_pool():
+    openai.aiosession.set(http_pool.session)
 
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
-def static_file(path):
-    return app.send_static_file(path)
+async def static_file(path):
+    return await app.send_static_file(path)
 
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files.
+# Blobs are streamed to the client chunk by chunk (see CONTENT_CHUNK_SIZE) instead of being downloaded in full first,
+# single byte ranges are honoured, and ETag/Last-Modified validators are passed through to Blob Storage so a repeated
+# citation click is answered with 304 without transferring the file again.
 @app.route("/content/<path>")
-def content_file(path):
-    blob = blob_container.get_blob_client(path).download_blob()
-    if not blob.properties or not blob.properties.has_key("content_settings"):
+async def content_file(path):
+    blob = blob_container.get_blob_client(path)
+    if content_cache:
+        cached = content_cache.get(path)
+        if cached and not cached.fresh:
+            try:
+                properties = await blob.get_blob_properties()
+            except ResourceNotFoundError:
+                abort(404)
+            if properties.etag == cached.etag:
+                content_cache.mark_validated(path)
+                cached.fresh = True
+        if cached and cached.fresh:
+            return await cached_content_response(path, cached)
+
+    conditions = {}
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match and if_none_match != "*" and "," not in if_none_match:
+        conditions = {"etag": if_none_match, "match_condition": MatchConditions.IfModified}
+    elif request.if_modified_since:
+        conditions = {"if_modified_since": request.if_modified_since}
+
+    offset, length = None, None
+    if_range_condition = False
+    if_range = request.headers.get("If-Range")
+    byte_range = single_byte_range()
+    if byte_range:
+        start, stop = byte_range
+        offset, length = start, (stop - start if stop is not None else None)
+        if if_range and not conditions:
+            conditions = {"etag": if_range, "match_condition": MatchConditions.IfNotModified}
+            if_range_condition = True
+
+    try:
+        downloader = await blob.download_blob(offset=offset, length=length, **conditions)
+    except ResourceNotFoundError:
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
+    except HttpResponseError as e:
+        # azure-storage-blob raises a plain HttpResponseError for a 304, or a ResourceModifiedError when Blob Storage
+        # adds the ConditionNotMet code to it, so the status tells a met If-None-Match/If-Modified-Since apart from a
+        # failed If-Range ETag (412)
+        if e.status_code == 304:
+            headers = {}
+            etag = (e.response and e.response.headers.get("ETag")) or if_none_match
+            if etag:
+                headers["ETag"] = etag
+            return Response("", status=304, headers=headers)
+        if isinstance(e, ResourceModifiedError) and if_range_condition:
+            # If-Range didn't match the current blob, send the whole new version instead of a range of it
+            offset, length = None, None
+            downloader = await blob.download_blob()
+        elif e.status_code == 416:
+            properties = await blob.get_blob_properties()
+            return Response("", status=416, headers={"Content-Range": f"bytes */{properties.size}"})
+        else:
+            raise
+
+    properties = downloader.properties
+    mime_type = properties.content_settings.content_type
+    if not mime_type or mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    blob.readinto(blob_file)
-    blob_file.seek(0)
-    return send_file(
-        blob_file, mimetype=mime_type, as_attachment=False, download_name=path
-    )
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(downloader.size),
+        "Content-Disposition": f'inline; filename="{path}"',
+        "Cache-Control": f"private, max-age={CONTENT_CACHE_MAX_AGE}",
+    }
+    if properties.etag:
+        headers["ETag"] = properties.etag
+    if properties.last_modified:
+        headers["Last-Modified"] = http_date(properties.last_modified)
+    status = 200
+    if offset is not None:
+        status = 206
+        total_size = properties.content_range.rsplit("/", 1)[1]
+        headers["Content-Range"] = f"bytes {offset}-{offset + downloader.size - 1}/{total_size}"
+
+    async def stream_chunks():
+        async for chunk in downloader.chunks():
+            yield chunk
+
+    body = stream_chunks()
+    if content_cache and status == 200:
+        body = content_cache.tee(
+            path,
+            body,
+            downloader.size,
+            properties.etag,
+            mime_type,
+            headers.get("Last-Modified"),
+        )
+    return Response(body, status=status, mimetype=mime_type, headers=headers)
+
+
+def single_byte_range() -> Optional[tuple[int, Optional[int]]]:
+    """
+    The (start, stop) of the request's byte range, stop exclusive or None for the end of the file. Only a single range
+    with a known start is served as such, anything else (suffix ranges, multiple ranges, If-Range with a date) is
+    served as the full file, which is allowed by RFC 9110.
+    """
+    if_range = request.headers.get("If-Range")
+    if (
+        request.range
+        and request.range.units == "bytes"
+        and len(request.range.ranges) == 1
+        and request.range.ranges[0][0] >= 0
+        and (not if_range or if_range.startswith('"'))
+    ):
+        return request.range.ranges[0]
+    return None
+
+
+def is_not_modified(etag: str, last_modified: Optional[str]) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    modified = parse_date(last_modified) if last_modified else None
+    return bool(request.if_modified_since and modified and modified <= request.if_modified_since)
+
+
+# Cached files are answered like the ones streamed from Blob Storage: the same validators and range handling, and
+# Content-Length and Accept-Ranges on every full or partial response
+async def cached_content_response(path: str, cached) -> Response:
+    headers = {
+        "ETag": cached.etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'inline; filename="{path}"',
+        "Cache-Control": f"private, max-age={CONTENT_CACHE_MAX_AGE}",
+    }
+    if cached.last_modified:
+        headers["Last-Modified"] = cached.last_modified
+    if is_not_modified(cached.etag, cached.last_modified):
+        return Response("", status=304, headers=headers)
+
+    body = FileBody(cached.path, buffer_size=CONTENT_CHUNK_SIZE)
+    status = 200
+    byte_range = single_byte_range()
+    if_range = request.headers.get("If-Range")
+    if byte_range and (not if_range or if_range == cached.etag):
+        start, stop = byte_range
+        if start >= cached.size:
+            return Response("", status=416, headers={"Content-Range": f"bytes */{cached.size}"})
+        stop = min(stop or cached.size, cached.size)
+        await body.make_conditional(start, stop)
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{cached.size}"
+    headers["Content-Length"] = str(body.end - body.begin)
+    return Response(body, status=status, mimetype=cached.content_type, headers=headers)
 
 
 @app.route("/ask", methods=["POST"])
-def ask():
-    ensure_openai_token()
-    if not request.json:
+async def ask():
+    request_json = await request.get_json(silent=True)
+    if not request_json:
         return jsonify({"error": "request must be json"}), 400
-    approach = request.json["approach"]
+    approach = request_json["approach"]
+    span = trace.get_current_span()
+    span.set_attribute("approach", approach)
+    span.set_attribute("question_length", len(request_json.get("question") or ""))
     try:
         impl = ask_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["question"], request.json.get("overrides") or {})
+        if request_json.get("stream"):
+            return event_stream(
+                impl.run_stream(
+                    request_json["question"], request_json.get("overrides") or {}
+                ),
+                impl.name,
+            )
+        r = await impl.run(
+            request_json["question"], request_json.get("overrides") or {}
+        )
         return jsonify(r)
     except Exception as e:
         logging.exception("Exception in /ask")
         return jsonify({"error": str(e)}), 500
 
 
+# Back-office tools send many questions at once: they share the approach, overrides and searches, and each answer is
+# sent as a Server-Sent Event as soon as it is ready, with the index of its question (see batch.run_batch)
+@app.route("/ask/batch", methods=["POST"])
+async def ask_batch():
+    request_json = await request.get_json(silent=True)
+    if not request_json:
+        return jsonify({"error": "request must be json"}), 400
+    approach = request_json.get("approach")
+    questions = request_json.get("questions")
+    if not isinstance(questions, list) or not questions or not all(isinstance(q, str) for q in questions):
+        return jsonify({"error": "questions must be a non-empty list of strings"}), 400
+    if len(questions) > ASK_BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"at most {ASK_BATCH_MAX_QUESTIONS} questions per batch"}), 400
+    impl = ask_approaches.get(approach)
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    concurrency = request_json.get("concurrency") or ASK_BATCH_CONCURRENCY
+    if not isinstance(concurrency, int) or concurrency < 1:
+        return jsonify({"error": "concurrency must be a positive integer"}), 400
+    span = trace.get_current_span()
+    span.set_attribute("approach", approach)
+    span.set_attribute("batch_size", len(questions))
+    return event_stream(
+        run_batch(
+            impl,
+            questions,
+            request_json.get("overrides") or {},
+            min(concurrency, ASK_BATCH_CONCURRENCY),
+        ),
+        impl.name,
+        first_token=False,
+    )
+
+
 @app.route("/chat", methods=["POST"])
-def chat():
-    ensure_openai_token()
-    if not request.json:
+async def chat():
+    request_json = await request.get_json(silent=True)
+    if not request_json:
         return jsonify({"error": "request must be json"}), 400
-    approach = request.json["approach"]
+    approach = request_json["approach"]
+    span = trace.get_current_span()
+    span.set_attribute("approach", approach)
+    span.set_attribute("history_turns", len(request_json.get("history") or []))
     try:
         impl = chat_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
+        if request_json.get("stream"):
+            return event_stream(
+                impl.run_stream(
+                    request_json["history"], request_json.get("overrides") or {}
+                ),
+                impl.name,
+            )
+        r = await impl.run(request_json["history"], request_json.get("overrides") or {})
         return jsonify(r)
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
 
-def ensure_openai_token():
-    global openai_token
-    if openai_token.expires_on < int(time.time()) - 60:
-        openai_token = azure_credential.get_token(
-            "https://cognitiveservices.azure.com/.default"
-        )
-        openai.api_key = openai_token.token
+# Called by the ingestion scripts after the index changed, so answers don't keep citing removed or outdated sections
+# until the cached results expire. Clears the cache of every worker on this machine.
+@app.route("/cache/invalidate", methods=["POST"])
+async def invalidate_cache():
+    key = request.headers.get("X-Cache-Invalidation-Key") or ""
+    if not SEARCH_CACHE_INVALIDATION_KEY or not hmac.compare_digest(
+        key, SEARCH_CACHE_INVALIDATION_KEY
+    ):
+        return jsonify({"error": "forbidden"}), 403
+    cache = search_client
+    while isinstance(cache, TieredSearchClient):
+        cache = cache.search_client
+    if isinstance(cache, CachedSearchClient):
+        cache.invalidate()
+    return jsonify({"invalidated": True})
+
+
+@app.route("/metrics", methods=["GET"])
+async def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+# Sends approach events as Server-Sent Events: one "data:" message per event (sources and thoughts first, then
+# answer fragments), an "error" event if the approach fails midway and a final "done" event.
+# name is the approach's class-level name (e.g. readretrieveread for /ask and chatreadretrieveread for /chat), the
+# request's approach key is shared by approaches of different endpoints. Streams whose events are whole answers
+# (/ask/batch) set first_token to False, their first answer would be recorded as a time to first token
+def event_stream(events, name: str, first_token: bool = True) -> Response:
+    async def generate():
+        nonlocal first_token
+        start = time.perf_counter()
+        try:
+            async for event in events:
+                if first_token and event.get("answer"):
+                    first_token = False
+                    elapsed = time.perf_counter() - start
+                    metrics.TIME_TO_FIRST_TOKEN.labels(name).observe(elapsed)
+                    logging.info(
+                        "Approach %s time to first token: %.3fs", name, elapsed
+                    )
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            logging.exception("Exception while streaming")
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 if __name__ == "__main__":
@@ -1,6 +1,128 @@
-from typing import Any
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Optional
+
+import openai
+from metrics import STAGE_SECONDS, record_token_usage
+from opentelemetry.trace import Status, StatusCode
+from singleflight import SingleFlight
+from tracing import tracer
+
+# Completions at temperature 0 always return the same text for the same prompt and options, so identical ones that are
+# in flight at the same time (e.g. many users picking the same suggested follow-up question) are sent only once
+completions_in_flight = SingleFlight("completion")
+
+
+@dataclass
+class AgentRun:
+    """
+    State of one run of an agent: the request's overrides, the search client of the approach running it (batches run
+    a copy with their own, see batch.run_batch) and the sources its search tool retrieved last.
+    """
+
+    overrides: dict[str, Any]
+    search_client: Any
+    results: list[str] = field(default_factory=list)
+
+
+# The LangChain agents are built once and shared by all requests, their tools find the run they are serving here
+agent_run: ContextVar[AgentRun] = ContextVar("agent_run")
 
 
 class Approach:
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
+    """
+    Approaches are created once per worker process and shared by all its requests, which run concurrently on its event
+    loop and possibly on several threads, each with its own loop (see benchmarks/reentrancy.py). Whatever belongs to a
+    request lives in locals or, for the LangChain tools that can't be passed it, in agent_run; attributes are only set
+    when the approach is created, and caches shared by requests must be safe to use from several threads.
+    """
+
+    # Value of the approach label on /metrics
+    name = "approach"
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
         raise NotImplementedError
+
+    async def run_stream(
+        self, q: str, overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        # Approaches that can't stream the answer (e.g. multi-step agents) send their full result in two events,
+        # the same shape streaming approaches use: sources and thoughts first, then the answer
+        r = await self.run(q, overrides)
+        yield {"data_points": r["data_points"], "thoughts": r["thoughts"]}
+        yield {"answer": r["answer"]}
+
+    @contextmanager
+    def stage(self, stage: str, deployment: str = "", current: bool = True):
+        # Times the stage on /metrics and traces it as a span, which callers can add attributes to. Stages that span
+        # yields of an async generator must not make their span the current one (current=False): the generator's
+        # consumer could switch contexts in between
+        start = time.perf_counter()
+        attributes = {"approach": self.name, "stage": stage}
+        if deployment:
+            attributes["deployment"] = deployment
+        span_name = f"{self.name}.{stage}"
+        try:
+            if current:
+                with tracer.start_as_current_span(span_name, attributes=attributes) as span:
+                    yield span
+            else:
+                span = tracer.start_span(span_name, attributes=attributes)
+                try:
+                    yield span
+                except Exception as e:
+                    span.record_exception(e)
+                    span.set_status(Status(StatusCode.ERROR, str(e)))
+                    raise
+                finally:
+                    span.end()
+        finally:
+            STAGE_SECONDS.labels(self.name, stage, deployment).observe(
+                time.perf_counter() - start
+            )
+
+    async def complete(self, stage: str, deployment: str, **kwargs: Any) -> Any:
+        with self.stage(stage, deployment) as span:
+            if kwargs.get("temperature") == 0 and kwargs.get("n", 1) == 1:
+                key = (deployment, tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+                completion, coalesced = await completions_in_flight.run(
+                    key, lambda: openai.Completion.acreate(engine=deployment, **kwargs)
+                )
+                span.set_attribute("coalesced", coalesced)
+            else:
+                completion = await openai.Completion.acreate(engine=deployment, **kwargs)
+                coalesced = False
+            # The tokens of a coalesced completion were already counted for the caller that sent it
+            usage = getattr(completion, "usage", None)
+            if usage and not coalesced:
+                record_token_usage(
+                    self.name, deployment, usage.prompt_tokens, usage.completion_tokens
+                )
+                span.set_attribute("prompt_tokens", usage.prompt_tokens)
+                span.set_attribute("completion_tokens", usage.completion_tokens)
+        return completion
+
+    async def complete_stream(
+        self,
+        stage: str,
+        deployment: str,
+        prompt_tokens: Optional[int] = None,
+        **kwargs: Any,
+    ) -> AsyncGenerator[str, None]:
+        # Streamed completions don't report usage: the prompt is counted by the caller and every chunk carries a
+        # single generated token
+        completion_tokens = 0
+        with self.stage(stage, deployment, current=False) as span:
+            completion = await openai.Completion.acreate(
+                engine=deployment, stream=True, **kwargs
+            )
+            async for chunk in completion:
+                if chunk.choices and chunk.choices[0].text:
+                    completion_tokens += 1
+                    yield chunk.choices[0].text
+            if prompt_tokens:
+                span.set_attribute("prompt_tokens", prompt_tokens)
+            span.set_attribute("completion_tokens", completion_tokens)
+        record_token_usage(self.name, deployment, prompt_tokens, completion_tokens)
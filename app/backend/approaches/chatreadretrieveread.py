@@ -1,20 +1,28 @@
-from typing import Any, Sequence
+import asyncio
+from typing import Any, AsyncGenerator, Optional, Sequence
 
-import openai
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 from approaches.approach import Approach
 from text import nonewlines
+from bm25index import similar_queries
+from rewritecache import QueryRewriteCache
+from querybuilder import build_search_query, is_keyword_like, split_identifiers
+from identifiers import customer_identifier
+from metrics import QUERY_REWRITE_PATH
+from sections import merge_sections
+from promptbudget import ApproximateTokenizer, PromptBudget, Tokenizer
 
 
 class ChatReadRetrieveReadApproach(Approach):
-
     """
     Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
     top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion
     (answer) with that prompt.
     """
 
+    name = "chatreadretrieveread"
+
     prompt_prefix = """<|im_start|> 
 Aclaraciones para el asistente:(
 Actúa <EXCLUSIVAMENTE COMO> Asistente Inteligente de la aseguradora Galicia. Tu función es ayudar a los asegurados de la compañía con sus pólizas, coberturas y siniestros.
@@ -92,6 +100,8 @@ Question:
 Search query:
 """
 
+    max_answer_tokens = 1024
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -99,70 +109,130 @@ Search query:
         gpt_deployment: str,
         sourcepage_field: str,
         content_field: str,
+        query_rewrite_cache: Optional[QueryRewriteCache] = None,
+        speculative_retrieval: bool = False,
+        keyword_query_fast_path: bool = True,
+        tokenizer: Optional[Tokenizer] = None,
+        context_window: int = 4096,
+        customer_scoped_search: bool = False,
+        identifier_fast_path: bool = True,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
         self.gpt_deployment = gpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.query_rewrite_cache = query_rewrite_cache
+        self.speculative_retrieval = speculative_retrieval
+        self.keyword_query_fast_path = keyword_query_fast_path
+        self.prompt_budget = PromptBudget(tokenizer or ApproximateTokenizer(), context_window)
+        self.customer_scoped_search = customer_scoped_search
+        self.identifier_fast_path = identifier_fast_path
+
+    async def run(
+        self, history: Sequence[dict[str, str]], overrides: dict[str, Any]
+    ) -> Any:
+        q, results, prompt = await self.retrieve_and_build_prompt(history, overrides)
 
-    def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 6
-        exclude_category = overrides.get("exclude_category") or None
-        filter = (
-            "category ne '{}'".format(exclude_category.replace("'", "''"))
-            if exclude_category
-            else None
+        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
+        completion = await self.complete(
+            "answer",
+            self.chatgpt_deployment,
+            prompt=prompt,
+            temperature=0.0,  # overrides.get("temperature") or 0.0,
+            max_tokens=self.max_answer_tokens,
+            n=1,
+            stop=["<|im_end|>", "<|im_start|>"],
         )
 
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        prompt = self.query_prompt_template.format(
-            chat_history=self.get_chat_history_as_text(
-                history, include_last_turn=False
-            ),
-            question=history[-1]["user"],
-        )
-        completion = openai.Completion.create(
-            engine=self.gpt_deployment,
+        return {
+            "data_points": results,
+            "answer": completion.choices[0].text,
+            "thoughts": self.get_thoughts(q, prompt),
+        }
+
+    async def run_stream(
+        self, history: Sequence[dict[str, str]], overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        q, results, prompt = await self.retrieve_and_build_prompt(history, overrides)
+
+        # Sources and the search query are known before the answer starts, send them right away
+        yield {"data_points": results, "thoughts": self.get_thoughts(q, prompt)}
+
+        # STEP 3: Same as in run, but tokens are forwarded as they are generated
+        async for text in self.complete_stream(
+            "answer",
+            self.chatgpt_deployment,
+            prompt_tokens=self.prompt_budget.tokenizer.count(prompt),
             prompt=prompt,
             temperature=0.0,
-            max_tokens=200,
+            max_tokens=self.max_answer_tokens,
             n=1,
-            stop=["\n"],
-        )
-        q = completion.choices[0].text
-
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(
-                q,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language="es",
-                query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=6,
-                query_caption="extractive|highlight-false"
-                if use_semantic_captions
-                else None,
+            stop=["<|im_end|>", "<|im_start|>"],
+        ):
+            yield {"answer": text}
+
+    async def retrieve_and_build_prompt(
+        self, history: Sequence[dict[str, str]], overrides: dict[str, Any]
+    ) -> tuple[str, list[str], str]:
+        speculative_retrieval = overrides.get("speculative_retrieval")
+        if speculative_retrieval is None:
+            speculative_retrieval = self.speculative_retrieval
+
+        identifier = self.get_customer_identifier(history)
+        scope = [identifier] if identifier else []
+        # Nothing is retrieved until the customer gives their DNI or CUIT, which the assistant asks for
+        unidentified = self.customer_scoped_search and identifier is None
+        lookup = None if unidentified else self.get_identifier_lookup(history, overrides)
+        keyword_query = None if unidentified or lookup else self.get_keyword_query(history, overrides)
+        if unidentified:
+            q, results = "", []
+        elif lookup is not None:
+            # The sections of the policy, CUIT or DNI in the message, ranked by the rest of it
+            lookup_identifier, q = lookup
+            results = await self.search(q, overrides, list(dict.fromkeys(scope + [lookup_identifier])))
+            q = "{} {}".format(" ".join(lookup_identifier), "" if q == "*" else q).strip()
+        elif keyword_query is not None:
+            q = keyword_query
+            results = await self.search(q, overrides, scope)
+        elif speculative_retrieval:
+            # Search for the question as typed while the rewrite completion runs, most first questions are already
+            # good search queries and this takes the search off the critical path when the rewrite agrees
+            question = history[-1]["user"]
+            speculative_search = asyncio.create_task(self.search(question, overrides, scope))
+            # Errors of a discarded speculative search don't matter, retrieve them so they aren't logged as unhandled
+            speculative_search.add_done_callback(
+                lambda t: t.cancelled() or t.exception()
             )
+            try:
+                q = await self.generate_search_query(history)
+            except BaseException:
+                speculative_search.cancel()
+                raise
+            if similar_queries(q, question):
+                results = await speculative_search
+            else:
+                speculative_search.cancel()
+                results = await self.search(q, overrides, scope)
         else:
-            r = self.search_client.search(q, filter=filter, top=6)
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field]
-                + ": "
-                + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                for doc in r
-            ]
-        else:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
-                for doc in r
-            ]
-        content = "\n".join(results)
+            # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+            q = await self.generate_search_query(history)
+
+            # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+            results = await self.search(q, overrides, scope)
 
+        with self.stage("prompt") as span:
+            results, prompt = self.build_prompt(history, overrides, results)
+            span.set_attribute("sources", len(results))
+            span.set_attribute("prompt_length", len(prompt))
+        return q, results, prompt
+
+    def build_prompt(
+        self,
+        history: Sequence[dict[str, str]],
+        overrides: dict[str, Any],
+        results: list[str],
+    ) -> tuple[list[str], str]:
         follow_up_questions_prompt = (
             self.follow_up_questions_prompt_content
             if overrides.get("suggest_followup_questions")
@@ -172,64 +242,181 @@ Search query:
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         prompt_override = overrides.get("prompt_template")
         if prompt_override is None:
-            prompt = self.prompt_prefix.format(
-                injected_prompt="",
-                sources=content,
-                chat_history=self.get_chat_history_as_text(history),
-                follow_up_questions_prompt=follow_up_questions_prompt,
-            )
+            template = self.prompt_prefix
+            injected_prompt = ""
         elif prompt_override.startswith(">>>"):
-            prompt = self.prompt_prefix.format(
-                injected_prompt=prompt_override[3:] + "\n",
-                sources=content,
-                chat_history=self.get_chat_history_as_text(history),
-                follow_up_questions_prompt=follow_up_questions_prompt,
-            )
+            template = self.prompt_prefix
+            injected_prompt = prompt_override[3:] + "\n"
         else:
-            prompt = prompt_override.format(
-                sources=content,
-                chat_history=self.get_chat_history_as_text(history),
+            template = prompt_override
+            injected_prompt = ""
+
+        def render(sources: str, chat_history: str) -> str:
+            return template.format(
+                injected_prompt=injected_prompt,
+                sources=sources,
+                chat_history=chat_history,
                 follow_up_questions_prompt=follow_up_questions_prompt,
             )
 
-        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-        completion = openai.Completion.create(
-            engine=self.chatgpt_deployment,
+        # Sources and earlier turns only get the part of the context window the instructions and the answer leave
+        results, turns = self.prompt_budget.fit(
+            render("", ""), results, self.get_chat_history_turns(history), self.max_answer_tokens
+        )
+        return results, render("\n".join(results), "".join(reversed(turns)))
+
+    async def search(
+        self, q: str, overrides: dict[str, Any], scope: Sequence[tuple[str, str]] = ()
+    ) -> list[str]:
+        # "*" only comes from identifier lookups: every section in scope, with no text to rank them or caption
+        match_all = q == "*"
+        use_semantic_captions = True if overrides.get("semantic_captions") and not match_all else False
+        top = overrides.get("top") or 6
+        exclude_category = overrides.get("exclude_category") or None
+        filters = []
+        if exclude_category:
+            filters.append("category ne '{}'".format(exclude_category.replace("'", "''")))
+        # Only the sections with these values in these fields, e.g. the customer's DNI: the dni, cuit and npoliza
+        # fields hold the normalized identifiers
+        for field, value in scope:
+            filters.append("{} eq '{}'".format(field, value.replace("'", "''")))
+        filter = " and ".join(filters) or None
+
+        with self.stage("search") as span:
+            span.set_attribute("query_length", len(q))
+            if scope:
+                span.set_attribute("scope", ",".join(field for field, _ in scope))
+            if overrides.get("semantic_ranker") and not match_all:
+                r = await self.search_client.search(
+                    q,
+                    filter=filter,
+                    query_type=QueryType.SEMANTIC,
+                    query_language="es",
+                    query_speller="lexicon",
+                    semantic_configuration_name="default",
+                    top=6,
+                    query_caption="extractive|highlight-false"
+                    if use_semantic_captions
+                    else None,
+                )
+            else:
+                r = await self.search_client.search(q, filter=filter, top=6)
+            if use_semantic_captions:
+                results = [
+                    doc[self.sourcepage_field]
+                    + ": "
+                    + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
+                    async for doc in r
+                ]
+            else:
+                # Overlapping neighbour sections and repeated passages would only send the same text several times
+                docs = merge_sections(
+                    [doc async for doc in r], self.content_field, self.sourcepage_field
+                )
+                results = [
+                    doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
+                    for doc in docs
+                ]
+            span.set_attribute("results", len(results))
+        return results
+
+    def get_customer_identifier(
+        self, history: Sequence[dict[str, str]]
+    ) -> Optional[tuple[str, str]]:
+        # Not an override: the scope is what keeps a customer from reading another one's policies, so requests can't
+        # turn it off. It is worked out again from the user messages of the history on every turn
+        if not self.customer_scoped_search:
+            return None
+        return customer_identifier([h["user"] for h in history])
+
+    def get_identifier_lookup(
+        self, history: Sequence[dict[str, str]], overrides: dict[str, Any]
+    ) -> Optional[tuple[tuple[str, str], str]]:
+        # A message with a policy number, CUIT or DNI is answered from the sections having it, found with a filter
+        # instead of a query rewritten by GPT. Returns the identifier that narrows them the most and a keyword query
+        # made of the rest of the message
+        fast_path = overrides.get("identifier_fast_path")
+        if fast_path is None:
+            fast_path = self.identifier_fast_path
+        if not fast_path:
+            return None
+        identifiers, q = split_identifiers(history[-1]["user"])
+        if not identifiers:
+            return None
+        QUERY_REWRITE_PATH.labels(path="identifier").inc()
+        kinds = ("npoliza", "cuit", "dni")
+        return min(identifiers, key=lambda i: kinds.index(i[0])), q
+
+    def get_keyword_query(
+        self, history: Sequence[dict[str, str]], overrides: dict[str, Any]
+    ) -> Optional[str]:
+        # With no previous turns to resolve, or a message that is already a short list of keywords, a local keyword
+        # extraction gives as good a query as the rewrite completion without the round trip to GPT
+        fast_path = overrides.get("keyword_query_fast_path")
+        if fast_path is None:
+            fast_path = self.keyword_query_fast_path
+        question = history[-1]["user"]
+        if fast_path and (len(history) == 1 or is_keyword_like(question)):
+            QUERY_REWRITE_PATH.labels(path="keywords").inc()
+            return build_search_query(question)
+        return None
+
+    async def generate_search_query(self, history: Sequence[dict[str, str]]) -> str:
+        prompt = self.query_prompt_template.format(
+            chat_history=self.get_chat_history_as_text(
+                history, include_last_turn=False
+            ),
+            question=history[-1]["user"],
+        )
+
+        # The rewrite is deterministic (temperature 0), so a query generated before for the same prompt can be reused
+        if self.query_rewrite_cache:
+            q = await self.query_rewrite_cache.get(self.gpt_deployment, prompt)
+            if q is not None:
+                QUERY_REWRITE_PATH.labels(path="cache").inc()
+                return q
+
+        completion = await self.complete(
+            "rewrite",
+            self.gpt_deployment,
             prompt=prompt,
-            temperature=0.0,  # overrides.get("temperature") or 0.0,
-            max_tokens=1024,
+            temperature=0.0,
+            max_tokens=200,
             n=1,
-            stop=["<|im_end|>", "<|im_start|>"],
+            stop=["\n"],
         )
+        q = completion.choices[0].text
+        QUERY_REWRITE_PATH.labels(path="llm").inc()
+        if self.query_rewrite_cache:
+            await self.query_rewrite_cache.put(self.gpt_deployment, prompt, q)
+        return q
 
-        return {
-            "data_points": results,
-            "answer": completion.choices[0].text,
-            "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>"
-            + prompt.replace("\n", "<br>"),
-        }
+    def get_thoughts(self, q: str, prompt: str) -> str:
+        return f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace("\n", "<br>")
 
     def get_chat_history_as_text(
         self,
         history: Sequence[dict[str, str]],
         include_last_turn: bool = True,
-        approx_max_tokens: int = 1200,
+        max_tokens: int = 1200,
     ) -> str:
-        history_text = ""
-        for h in reversed(history if include_last_turn else history[:-1]):
-            history_text = (
-                """<|im_start|>user"""
-                + "\n"
-                + h["user"]
-                + "\n"
-                + """<|im_end|>"""
-                + "\n"
-                + """<|im_start|>assistant"""
-                + "\n"
-                + (h.get("bot", "") + """<|im_end|>""" if h.get("bot") else "")
-                + "\n"
-                + history_text
-            )
-            if len(history_text) > approx_max_tokens * 4:
-                break
-        return history_text
+        turns = self.get_chat_history_turns(history, include_last_turn)
+        return "".join(reversed(self.prompt_budget.fit_turns(turns, max_tokens)))
+
+    def get_chat_history_turns(
+        self, history: Sequence[dict[str, str]], include_last_turn: bool = True
+    ) -> list[str]:
+        # One ChatML block per turn, newest first
+        return [
+            """<|im_start|>user"""
+            + "\n"
+            + h["user"]
+            + "\n"
+            + """<|im_end|>"""
+            + "\n"
+            + """<|im_start|>assistant"""
+            + "\n"
+            + (h.get("bot", "") + """<|im_end|>""" if h.get("bot") else "")
+            + "\n"
+            for h in reversed(history if include_last_turn else history[:-1])
+        ]
@@ -1,32 +1,73 @@
 import openai
 import re
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
+import threading
+from collections import OrderedDict
+from approaches.approach import AgentRun, Approach, agent_run
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
-from langchain.prompts import PromptTemplate, BasePromptTemplate
-from langchain.callbacks.manager import CallbackManager
+from langchain.prompts import PromptTemplate
+from langchain.chains import LLMChain
 from langchain.agents import Tool, AgentExecutor
 from langchain.agents.react.base import ReActDocstoreAgent
-from langchainadapters import HtmlCallbackHandler
+from langchainadapters import CoalescingAzureOpenAI, HtmlCallbackHandler, MetricsCallbackHandler, TracingCallbackHandler
 from text import nonewlines
-from typing import Any, List, Optional
+from typing import Any, Optional
 
 class ReadDecomposeAsk(Approach):
+    name = "readdecomposeask"
+
+    # Agents are built for the temperature and prompt overrides requests use, the least recently used ones are dropped once
+    # there are more than max_agents
+    max_agents = 16
+
     def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
 
-    def search(self, q: str, overrides: dict[str, Any]) -> str:
+        # The tools, prompt, LLM and agent are built once and shared by all requests, which only pass their state (see AgentRun)
+        # and callbacks to each run
+        self.tools = [
+            Tool(name="Search", func=lambda _: "Not implemented", coroutine=self.search_tool, description="useful for when you need to ask with search"),
+            Tool(name="Lookup", func=lambda _: "Not implemented", coroutine=self.lookup_tool, description="useful for when you need to ask with lookup")
+        ]
+        self.agents: OrderedDict[tuple, AgentExecutor] = OrderedDict()
+        self.agents_lock = threading.Lock()
+        self.get_agent(0.3, None)
+
+    def get_agent(self, temperature: float, prompt_prefix: Optional[str]) -> AgentExecutor:
+        key = (temperature, prompt_prefix)
+        with self.agents_lock:
+            agent_exec = self.agents.get(key)
+            if agent_exec:
+                self.agents.move_to_end(key)
+                return agent_exec
+
+        prompt = PromptTemplate.from_examples(
+            EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
+        llm = CoalescingAzureOpenAI(deployment_name=self.openai_deployment, temperature=temperature, openai_api_key=openai.api_key)
+        agent = ReActDocstoreAgent(llm_chain=LLMChain(llm=llm, prompt=prompt), allowed_tools=[tool.name for tool in self.tools])
+        agent_exec = AgentExecutor.from_agent_and_tools(agent, self.tools, verbose=True)
+        # Built without holding the lock, requests on other threads asking for the same agent may build it too
+        with self.agents_lock:
+            agent_exec = self.agents.setdefault(key, agent_exec)
+            while len(self.agents) > self.max_agents:
+                self.agents.popitem(last=False)
+        return agent_exec
+
+    async def search_tool(self, q: str) -> str:
+        return await self.search(q, agent_run.get())
+
+    async def search(self, q: str, run: AgentRun) -> str:
+        overrides = run.overrides
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
         if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
+            r = await run.search_client.search(q,
                                           filter=filter,
                                           query_type=QueryType.SEMANTIC, 
                                           query_language="en-us", 
@@ -35,15 +76,18 @@ class ReadDecomposeAsk(Approach):
                                           top = top,
                                           query_caption="extractive|highlight-false" if use_semantic_captions else None)
         else:
-            r = self.search_client.search(q, filter=filter, top=top)
+            r = await run.search_client.search(q, filter=filter, top=top)
         if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
+            run.results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) async for doc in r]
         else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) for doc in r]
-        return "\n".join(self.results)
+            run.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) async for doc in r]
+        return "\n".join(run.results)
+
+    async def lookup_tool(self, q: str) -> Optional[str]:
+        return await self.lookup(q, agent_run.get())
 
-    def lookup(self, q: str) -> Optional[str]:
-        r = self.search_client.search(q,
+    async def lookup(self, q: str, run: AgentRun) -> Optional[str]:
+        r = await run.search_client.search(q,
                                       top = 1,
                                       include_total_count=True,
                                       query_type=QueryType.SEMANTIC, 
@@ -53,48 +97,33 @@ class ReadDecomposeAsk(Approach):
                                       query_answer="extractive|count-1",
                                       query_caption="extractive|highlight-false")
         
-        answers = r.get_answers()
+        answers = await r.get_answers()
         if answers and len(answers) > 0:
             return answers[0].text
-        if r.get_count() > 0:
-            return "\n".join(d['content'] for d in r)
+        if await r.get_count() > 0:
+            return "\n".join([d['content'] async for d in r])
         return None
 
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        agent_exec = self.get_agent(overrides.get("temperature") or 0.3, overrides.get("prompt_template"))
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
-
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
-        tools = [
-            Tool(name="Search", func=lambda q: self.search(q, overrides), description="useful for when you need to ask with search", callbacks=cb_manager),
-            Tool(name="Lookup", func=self.lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
-        ]
 
-        # Like results above, not great to keep this as a global, will interfere with interleaving
-        global prompt
-        prompt_prefix = overrides.get("prompt_template")
-        prompt = PromptTemplate.from_examples(
-            EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
-
-        agent = ReAct.from_llm_and_tools(llm, tools)
-        chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = chain.run(q)
+        run = AgentRun(overrides, self.search_client)
+        token = agent_run.set(run)
+        try:
+            with self.stage("agent", self.openai_deployment):
+                result = await agent_exec.arun(q, callbacks=[cb_handler, MetricsCallbackHandler(self.name, self.openai_deployment), TracingCallbackHandler()])
+        finally:
+            agent_run.reset(token)
 
         # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid 
         # generalizing too much and disrupt HTML snippets if present
         result = re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", result)
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
-    
-class ReAct(ReActDocstoreAgent):
-    @classmethod
-    def create_prompt(cls, tools: List[Tool]) -> BasePromptTemplate:
-        return prompt
-    
+        return {"data_points": run.results, "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+
 # Modified version of langchain's ReAct prompt that includes instructions and examples for how to cite information sources
 EXAMPLES = [
     """Question: What is the elevation range for the area that the eastern sector of the
@@ -1,16 +1,22 @@
+import logging
+import os
 import openai
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
+import threading
+from collections import OrderedDict
+from approaches.approach import AgentRun, Approach, agent_run
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
-from langchain.callbacks.manager import CallbackManager, Callbacks
+from langchain.callbacks.manager import Callbacks
 from langchain.chains import LLMChain
 from langchain.agents import Tool, ZeroShotAgent, AgentExecutor
-from langchainadapters import HtmlCallbackHandler
+from langchainadapters import CoalescingAzureOpenAI, HtmlCallbackHandler, MetricsCallbackHandler, TracingCallbackHandler
 from text import nonewlines
 from lookuptool import CsvLookupTool
 from typing import Any
 
+# Relative to the working directory of the backend
+EMPLOYEE_INFO_FILE = "data/employeeinfo.csv"
+
 
 class ReadRetrieveReadApproach(Approach):
     """
@@ -44,8 +50,14 @@ Question: {input}
 
 Thought: {agent_scratchpad}"""
 
+    name = "readretrieveread"
+
     CognitiveSearchToolDescription = "useful for searching the Microsoft employee benefits information such as healthcare plans, retirement plans, etc."
 
+    # Agents are built for the temperature and prompt overrides requests use, the least recently used ones are dropped
+    # once there are more than max_agents
+    max_agents = 16
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -58,7 +70,61 @@ Thought: {agent_scratchpad}"""
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
 
-    def retrieve(self, q: str, overrides: dict[str, Any]) -> Any:
+        # The tools, prompt, LLM and agent are built once and shared by all requests, which only pass their state
+        # (see AgentRun) and callbacks to each run
+        acs_tool = Tool(
+            name="CognitiveSearch",
+            func=lambda _: "Not implemented",
+            coroutine=self.search_tool,
+            description=self.CognitiveSearchToolDescription,
+        )
+        self.tools = [acs_tool]
+        # The employee CSV is optional sample data, without it the agent can only search
+        if os.path.exists(EMPLOYEE_INFO_FILE):
+            self.tools.append(EmployeeInfoTool("Employee1"))
+        else:
+            logging.warning("%s not found, the rrr approach runs without the Employee tool", EMPLOYEE_INFO_FILE)
+        self.agents: OrderedDict[tuple, AgentExecutor] = OrderedDict()
+        self.agents_lock = threading.Lock()
+        self.get_agent(0.0, self.template_prefix, self.template_suffix)
+
+    def get_agent(self, temperature: float, prefix: str, suffix: str) -> AgentExecutor:
+        key = (temperature, prefix, suffix)
+        with self.agents_lock:
+            agent_exec = self.agents.get(key)
+            if agent_exec:
+                self.agents.move_to_end(key)
+                return agent_exec
+
+        prompt = ZeroShotAgent.create_prompt(
+            tools=self.tools,
+            prefix=prefix,
+            suffix=suffix,
+            input_variables=["input", "agent_scratchpad"],
+        )
+        llm = CoalescingAzureOpenAI(
+            deployment_name=self.openai_deployment,
+            temperature=temperature,
+            openai_api_key=openai.api_key,
+        )
+        chain = LLMChain(llm=llm, prompt=prompt)
+        agent_exec = AgentExecutor.from_agent_and_tools(
+            agent=ZeroShotAgent(llm_chain=chain, tools=self.tools),
+            tools=self.tools,
+            verbose=True,
+        )
+        # Built without holding the lock, requests on other threads asking for the same agent may build it too
+        with self.agents_lock:
+            agent_exec = self.agents.setdefault(key, agent_exec)
+            while len(self.agents) > self.max_agents:
+                self.agents.popitem(last=False)
+        return agent_exec
+
+    async def search_tool(self, q: str) -> str:
+        return await self.retrieve(q, agent_run.get())
+
+    async def retrieve(self, q: str, run: AgentRun) -> str:
+        overrides = run.overrides
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
@@ -69,7 +135,7 @@ Thought: {agent_scratchpad}"""
         )
 
         if overrides.get("semantic_ranker"):
-            r = self.search_client.search(
+            r = await run.search_client.search(
                 q,
                 filter=filter,
                 query_type=QueryType.SEMANTIC,
@@ -82,66 +148,54 @@ Thought: {agent_scratchpad}"""
                 else None,
             )
         else:
-            r = self.search_client.search(q, filter=filter, top=top)
+            r = await run.search_client.search(q, filter=filter, top=top)
         if use_semantic_captions:
-            self.results = [
+            run.results = [
                 doc[self.sourcepage_field]
                 + ":"
                 + nonewlines(" -.- ".join([c.text for c in doc["@search.captions"]]))
-                for doc in r
+                async for doc in r
             ]
         else:
-            self.results = [
+            run.results = [
                 doc[self.sourcepage_field]
                 + ":"
                 + nonewlines(doc[self.content_field][:250])
-                for doc in r
+                async for doc in r
             ]
-        content = "\n".join(self.results)
+        content = "\n".join(run.results)
         return content
 
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        agent_exec = self.get_agent(
+            overrides.get("temperature") or 0.0,
+            overrides.get("prompt_template_prefix") or self.template_prefix,
+            overrides.get("prompt_template_suffix") or self.template_suffix,
+        )
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
 
-        acs_tool = Tool(
-            name="CognitiveSearch",
-            func=lambda q: self.retrieve(q, overrides),
-            description=self.CognitiveSearchToolDescription,
-            callbacks=cb_manager,
-        )
-        employee_tool = EmployeeInfoTool("Employee1", callbacks=cb_manager)
-        tools = [acs_tool, employee_tool]
-
-        prompt = ZeroShotAgent.create_prompt(
-            tools=tools,
-            prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
-            suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
-            input_variables=["input", "agent_scratchpad"],
-        )
-        llm = AzureOpenAI(
-            deployment_name=self.openai_deployment,
-            temperature=overrides.get("temperature") or 0.0,
-            openai_api_key=openai.api_key,
-        )
-        chain = LLMChain(llm=llm, prompt=prompt)
-        agent_exec = AgentExecutor.from_agent_and_tools(
-            agent=ZeroShotAgent(llm_chain=chain, tools=tools),
-            tools=tools,
-            verbose=True,
-            callback_manager=cb_manager,
-        )
-        result = agent_exec.run(q)
+        run = AgentRun(overrides, self.search_client)
+        token = agent_run.set(run)
+        try:
+            with self.stage("agent", self.openai_deployment):
+                result = await agent_exec.arun(
+                    q,
+                    callbacks=[
+                        cb_handler,
+                        MetricsCallbackHandler(self.name, self.openai_deployment),
+                        TracingCallbackHandler(),
+                    ],
+                )
+        finally:
+            agent_run.reset(token)
 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
 
         return {
-            "data_points": self.results or [],
+            "data_points": run.results,
             "answer": result,
             "thoughts": cb_handler.get_and_reset_log(),
         }
@@ -152,7 +206,7 @@ class EmployeeInfoTool(CsvLookupTool):
 
     def __init__(self, employee_name: str, callbacks: Callbacks = None):
         super().__init__(
-            filename="data/employeeinfo.csv",
+            filename=EMPLOYEE_INFO_FILE,
             key_field="name",
             name="Employee",
             description="useful for answering questions about the employee, their benefits and other personal information",
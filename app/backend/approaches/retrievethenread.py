@@ -1,9 +1,10 @@
-import openai
 from approaches.approach import Approach
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 from text import nonewlines
-from typing import Any
+from sections import merge_sections
+from promptbudget import ApproximateTokenizer, PromptBudget, Tokenizer
+from typing import Any, AsyncGenerator, Optional
 
 
 class RetrieveThenReadApproach(Approach):
@@ -44,19 +45,63 @@ Answer:
 """
     )
 
+    name = "retrievethenread"
+    max_answer_tokens = 1024
+
     def __init__(
         self,
         search_client: SearchClient,
         openai_deployment: str,
         sourcepage_field: str,
         content_field: str,
+        tokenizer: Optional[Tokenizer] = None,
+        context_window: int = 4097,
     ):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.prompt_budget = PromptBudget(tokenizer or ApproximateTokenizer(), context_window)
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        results, prompt = await self.retrieve_and_build_prompt(q, overrides)
+        completion = await self.complete(
+            "answer",
+            self.openai_deployment,
+            prompt=prompt,
+            temperature=overrides.get("temperature") or 0.0,
+            max_tokens=self.max_answer_tokens,
+            n=1,
+            stop=["\n"],
+        )
 
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        return {
+            "data_points": results,
+            "answer": completion.choices[0].text,
+            "thoughts": self.get_thoughts(q, prompt),
+        }
+
+    async def run_stream(
+        self, q: str, overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        results, prompt = await self.retrieve_and_build_prompt(q, overrides)
+        yield {"data_points": results, "thoughts": self.get_thoughts(q, prompt)}
+
+        async for text in self.complete_stream(
+            "answer",
+            self.openai_deployment,
+            prompt_tokens=self.prompt_budget.tokenizer.count(prompt),
+            prompt=prompt,
+            temperature=overrides.get("temperature") or 0.0,
+            max_tokens=self.max_answer_tokens,
+            n=1,
+            stop=["\n"],
+        ):
+            yield {"answer": text}
+
+    async def retrieve_and_build_prompt(
+        self, q: str, overrides: dict[str, Any]
+    ) -> tuple[list[str], str]:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
@@ -66,50 +111,49 @@ Answer:
             else None
         )
 
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(
-                q,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language="en-us",
-                query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false"
-                if use_semantic_captions
-                else None,
+        with self.stage("search") as span:
+            span.set_attribute("query_length", len(q))
+            if overrides.get("semantic_ranker"):
+                r = await self.search_client.search(
+                    q,
+                    filter=filter,
+                    query_type=QueryType.SEMANTIC,
+                    query_language="en-us",
+                    query_speller="lexicon",
+                    semantic_configuration_name="default",
+                    top=top,
+                    query_caption="extractive|highlight-false"
+                    if use_semantic_captions
+                    else None,
+                )
+            else:
+                r = await self.search_client.search(q, filter=filter, top=top)
+            if use_semantic_captions:
+                results = [
+                    doc[self.sourcepage_field]
+                    + ": "
+                    + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
+                    async for doc in r
+                ]
+            else:
+                docs = merge_sections(
+                    [doc async for doc in r], self.content_field, self.sourcepage_field
+                )
+                results = [
+                    doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
+                    for doc in docs
+                ]
+            span.set_attribute("results", len(results))
+
+        with self.stage("prompt") as span:
+            template = overrides.get("prompt_template") or self.template
+            results, _ = self.prompt_budget.fit(
+                template.format(q=q, retrieved=""), results, [], self.max_answer_tokens
             )
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field]
-                + ": "
-                + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                for doc in r
-            ]
-        else:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
-                for doc in r
-            ]
-        content = "\n".join(results)
-
-        prompt = (overrides.get("prompt_template") or self.template).format(
-            q=q, retrieved=content
-        )
-        completion = openai.Completion.create(
-            engine=self.openai_deployment,
-            prompt=prompt,
-            temperature=overrides.get("temperature") or 0.0,
-            max_tokens=1024,
-            n=1,
-            stop=["\n"],
-        )
+            prompt = template.format(q=q, retrieved="\n".join(results))
+            span.set_attribute("sources", len(results))
+            span.set_attribute("prompt_length", len(prompt))
+        return results, prompt
 
-        return {
-            "data_points": results,
-            "answer": completion.choices[0].text,
-            "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>"
-            + prompt.replace("\n", "<br>"),
-        }
+    def get_thoughts(self, q: str, prompt: str) -> str:
+        return f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace("\n", "<br>")
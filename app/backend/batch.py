@@ -0,0 +1,94 @@
+import asyncio
+import copy
+import logging
+from typing import Any, AsyncGenerator
+from approaches.approach import Approach
+from retrievalcache import CachedSearchResults, read_search_results, search_key
+
+
+class BatchSearchClient:
+    """
+    Search client shared by the questions of one batch. Identical searches (same text and options) are sent once, also
+    when several questions run them at the same time, and each caller gets its own replay of the results. Unlike
+    CachedSearchClient the results only live as long as the batch.
+    """
+
+    def __init__(self, search_client):
+        self.search_client = search_client
+        self.searches: dict[tuple, asyncio.Task] = {}
+        self.hits = 0
+
+    async def search(self, search_text: str, **kwargs: Any) -> CachedSearchResults:
+        key = search_key(search_text, kwargs)
+        task = self.searches.get(key)
+        if task:
+            self.hits += 1
+        else:
+            task = asyncio.create_task(self._search(key, search_text, **kwargs))
+            self.searches[key] = task
+        # A question being cancelled must not cancel the search for the others waiting on it
+        return await asyncio.shield(task)
+
+    async def _search(self, key: tuple, search_text: str, **kwargs: Any) -> CachedSearchResults:
+        try:
+            return await read_search_results(self.search_client, search_text, **kwargs)
+        except Exception:
+            # Failures are not shared with later questions, they try again
+            self.searches.pop(key, None)
+            raise
+
+    def cancel(self):
+        for task in self.searches.values():
+            task.cancel()
+
+
+async def run_batch(
+    approach: Approach, questions: list[str], overrides: dict[str, Any], concurrency: int
+) -> AsyncGenerator[dict[str, Any], None]:
+    """
+    Answers questions with approach, at most concurrency at a time, and yields one event per question as soon as it is
+    answered: its index in questions, the question and the approach's result (or "error"). Repeated questions are
+    answered once and searches are shared by all the questions (see BatchSearchClient). A last event summarizes the
+    batch. Closing the generator cancels the questions still running.
+    """
+    # The approach instance is shared with every other request, the batch gets a copy using its own search client
+    search_client = BatchSearchClient(approach.search_client)
+    batch_approach = copy.copy(approach)
+    batch_approach.search_client = search_client
+
+    indexes: dict[str, list[int]] = {}
+    for i, q in enumerate(questions):
+        indexes.setdefault(q.strip(), []).append(i)
+    pending = iter(indexes.items())
+    answered: asyncio.Queue = asyncio.Queue()
+
+    async def answer_pending():
+        for q, question_indexes in pending:
+            try:
+                r = await batch_approach.run(q, overrides)
+            except Exception as e:
+                logging.exception("Exception in batch question")
+                r = {"error": str(e)}
+            await answered.put((question_indexes, r))
+
+    workers = [asyncio.create_task(answer_pending()) for _ in range(min(concurrency, len(indexes)))]
+    failed = 0
+    try:
+        for _ in range(len(indexes)):
+            question_indexes, r = await answered.get()
+            if "error" in r:
+                failed += len(question_indexes)
+            for i in question_indexes:
+                yield {"index": i, "question": questions[i], **r}
+        yield {
+            "summary": {
+                "questions": len(questions),
+                "distinct_questions": len(indexes),
+                "failed": failed,
+                "shared_searches": search_client.hits,
+            }
+        }
+    finally:
+        for worker in workers:
+            worker.cancel()
+        search_client.cancel()
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+
+
+@dataclass
+class CachedBlob:
+    path: str
+    size: int
+    etag: str
+    content_type: str
+    last_modified: Optional[str]
+    fresh: bool
+
+
+class BlobDiskCache:
+    """
+    Size-bounded LRU cache of blob contents on local disk, shared by all worker processes on the machine.
+    Every blob version is stored in its own immutable file named after the blob name and its ETag, next to a small
+    metadata file that points at the current version. Files are always written to a temporary name and then renamed,
+    so readers in other processes never see partial content and no locking is needed. The data file mtime records the
+    last access (used for LRU eviction), the metadata file mtime records the last time the ETag was checked against
+    Blob Storage.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, revalidate_after: float = 300):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        os.makedirs(directory, exist_ok=True)
+
+    def _key(self, value: str) -> str:
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+    def _meta_path(self, name: str) -> str:
+        return os.path.join(self.directory, self._key(name) + ".json")
+
+    def _data_path(self, name: str, etag: str) -> str:
+        return os.path.join(self.directory, self._key(name) + "-" + self._key(etag))
+
+    def get(self, name: str) -> Optional[CachedBlob]:
+        meta_path = self._meta_path(name)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            validated = os.stat(meta_path).st_mtime
+            data_path = self._data_path(name, meta["etag"])
+            if os.stat(data_path).st_size != meta["size"]:
+                return None
+            os.utime(data_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return CachedBlob(
+            path=data_path,
+            size=meta["size"],
+            etag=meta["etag"],
+            content_type=meta["content_type"],
+            last_modified=meta.get("last_modified"),
+            fresh=time.time() - validated < self.revalidate_after,
+        )
+
+    def mark_validated(self, name: str):
+        try:
+            os.utime(self._meta_path(name))
+        except OSError:
+            pass
+
+    async def tee(
+        self,
+        name: str,
+        chunks: AsyncIterator[bytes],
+        size: int,
+        etag: str,
+        content_type: str,
+        last_modified: Optional[str],
+    ) -> AsyncIterator[bytes]:
+        # Pass the chunks through to the caller while writing them to disk, the file is only added to the cache
+        # if the whole blob was received (e.g. not when the client disconnects halfway)
+        if not etag or size > self.max_bytes:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        tmp = tempfile.NamedTemporaryFile(dir=self.directory, prefix=".tmp-", delete=False)
+        written = 0
+        complete = False
+        try:
+            async for chunk in chunks:
+                tmp.write(chunk)
+                written += len(chunk)
+                yield chunk
+            complete = written == size
+        finally:
+            tmp.close()
+            if complete:
+                self._commit(name, tmp.name, size, etag, content_type, last_modified)
+            else:
+                self._remove(tmp.name)
+
+    def _commit(self, name: str, tmp_path: str, size: int, etag: str, content_type: str, last_modified: Optional[str]):
+        os.replace(tmp_path, self._data_path(name, etag))
+        meta = {"name": name, "etag": etag, "size": size, "content_type": content_type, "last_modified": last_modified}
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, prefix=".tmp-", delete=False, encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(f.name, self._meta_path(name))
+        self.evict()
+
+    def evict(self):
+        # Other processes may be evicting at the same time, files that are already gone are simply skipped
+        data_files = []
+        total = 0
+        now = time.time()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith(".tmp-"):
+                    # Left behind by a worker that died while writing
+                    if now - stat.st_mtime > 3600:
+                        self._remove(entry.path)
+                elif not entry.name.endswith(".json"):
+                    data_files.append((stat.st_mtime, stat.st_size, entry.path, entry.name))
+                    total += stat.st_size
+
+        data_files.sort()
+        for _, size, path, filename in data_files:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            self._remove_meta_for(filename)
+            total -= size
+
+    def _remove_meta_for(self, data_filename: str):
+        # Only drop the metadata if it still points at the evicted version, a newer version may have replaced it
+        name_key, etag_key = data_filename.split("-", 1)
+        meta_path = os.path.join(self.directory, name_key + ".json")
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+        if self._key(meta.get("etag", "")) == etag_key:
+            self._remove(meta_path)
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,242 @@
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import tempfile
+from collections import Counter
+from typing import Any, Callable, Iterable, Iterator, Optional
+from identifiers import find_identifiers
+from querybuilder import SPANISH_STOPWORDS
+from text import fold_accents
+
+# Local full-text index of the sections sent to Cognitive Search, written by the ingestion scripts (--localindex) and
+# searched by the backend with BM25 when Search is slow or failing (see localsearch.py). Everything lives in one file
+# that is memory-mapped, so opening it costs nothing and its pages are shared by all the workers on the machine:
+#
+#   header         magic, document and term counts, average document length, offsets of the two tables
+#   term texts     UTF-8 terms, back to back
+#   postings       per term, the ids of the documents containing it (uint32) followed by how many times it does (uint32)
+#   documents      per document, the section as JSON
+#   term table     per term, sorted by its UTF-8 bytes: text offset and length, document frequency, postings offset
+#   document table per document: JSON offset and length, number of terms
+MAGIC = b"BM25IDX1"
+HEADER = struct.Struct("<8sIIdQQ")
+TERM = struct.Struct("<QIIQ")
+DOCUMENT = struct.Struct("<QII")
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def stem(word: str) -> str:
+    # Light Spanish stemmer (J. Savoy): only plurals and gender endings are removed, which is enough for "pólizas" to
+    # match "póliza" and "asegurado" to match "asegurada" without the errors of more aggressive stemmers
+    if len(word) < 5 or not word.isalpha():
+        return word
+    if word.endswith("eses"):
+        return word[:-2]
+    if word.endswith("ces"):
+        return word[:-3] + "z"
+    if word.endswith(("os", "as", "es")):
+        return word[:-2]
+    if word.endswith(("o", "a", "e")):
+        return word[:-1]
+    return word
+
+
+def word_terms(text: str) -> Iterator[str]:
+    for word in WORD_PATTERN.findall(fold_accents(text.lower())):
+        if word in SPANISH_STOPWORDS or (len(word) < 2 and not word.isdigit()):
+            continue
+        yield stem(word)
+
+
+def analyze(text: str) -> list[str]:
+    """
+    Spanish analyzer used for both sections and queries: lowercased words without accents, stopwords or plural and
+    gender endings. Policy numbers, CUITs and DNIs are kept as single terms in the format stored in the index, however
+    they were written.
+    """
+    terms = []
+    last = 0
+    for start, end, _, value in find_identifiers(text):
+        terms.extend(word_terms(text[last:start]))
+        terms.append(value)
+        last = end
+    terms.extend(word_terms(text[last:]))
+    return terms
+
+
+def same_term(a: str, b: str, prefix: int = 5) -> bool:
+    # The stemmer leaves verb and noun forms apart ("denunciar", "denuncia"), terms sharing a long enough prefix match
+    return a == b or (len(a) >= prefix and len(b) >= prefix and a[:prefix] == b[:prefix])
+
+
+def similar_queries(a: str, b: str, threshold: float = 0.6) -> bool:
+    """
+    Whether two search queries should retrieve much the same sections: the share of the terms of either (as analyzed
+    for the index, so without stopwords, accents or plural and gender endings) that match a term of the other is at
+    least threshold. A question and its rewrite are similar when the rewrite mostly drops filler words, and not when
+    it adds terms from earlier turns ("¿y por robo?" rewritten as "cobertura robo póliza auto").
+    """
+    terms_a, terms_b = set(analyze(a)), set(analyze(b))
+    if not terms_a or not terms_b:
+        return False
+    matched = sum(any(same_term(t, u) for u in terms_b) for t in terms_a) + sum(
+        any(same_term(t, u) for u in terms_a) for t in terms_b
+    )
+    return matched / (len(terms_a) + len(terms_b)) >= threshold
+
+
+class BM25IndexWriter:
+    """Collects sections (the documents uploaded to Cognitive Search) and writes them as a BM25Index file."""
+
+    def __init__(self, content_field: str = "content"):
+        self.content_field = content_field
+        self.documents: list[bytes] = []
+        self.lengths: list[int] = []
+        self.postings: dict[str, list[tuple[int, int]]] = {}
+
+    def add(self, section: dict[str, Any]):
+        doc_id = len(self.documents)
+        terms = analyze(section.get(self.content_field) or "")
+        for term, count in Counter(terms).items():
+            self.postings.setdefault(term, []).append((doc_id, count))
+        self.documents.append(json.dumps(section, ensure_ascii=False).encode("utf-8"))
+        self.lengths.append(len(terms))
+
+    def write(self, path: str):
+        # Written next to the destination and renamed, so backends reloading it never see a partial file
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                self._write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _write(self, f):
+        f.write(b"\0" * HEADER.size)
+        terms = sorted(self.postings, key=lambda t: t.encode("utf-8"))
+        text_offsets = []
+        for term in terms:
+            text_offsets.append(f.tell())
+            f.write(term.encode("utf-8"))
+
+        pad(f, 4)
+        postings_offsets = []
+        for term in terms:
+            postings = self.postings[term]
+            postings_offsets.append(f.tell())
+            f.write(struct.pack(f"<{len(postings)}I", *[doc_id for doc_id, _ in postings]))
+            f.write(struct.pack(f"<{len(postings)}I", *[count for _, count in postings]))
+
+        document_offsets = []
+        for document in self.documents:
+            document_offsets.append(f.tell())
+            f.write(document)
+
+        pad(f, 8)
+        terms_offset = f.tell()
+        for term, text_offset, postings_offset in zip(terms, text_offsets, postings_offsets):
+            f.write(TERM.pack(text_offset, len(term.encode("utf-8")), len(self.postings[term]), postings_offset))
+        documents_offset = f.tell()
+        for document, offset, length in zip(self.documents, document_offsets, self.lengths):
+            f.write(DOCUMENT.pack(offset, len(document), length))
+
+        average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(self.documents), len(terms), average_length, terms_offset, documents_offset))
+
+
+def pad(f, alignment: int):
+    f.write(b"\0" * (-f.tell() % alignment))
+
+
+class BM25Index:
+    """
+    Read-only view of an index file written by BM25IndexWriter. Only the postings of the query terms and the sections
+    returned are read, through the memory map.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        with open(path, "rb") as f:
+            # Empty files can't be mapped
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        if len(self.data) < HEADER.size:
+            raise ValueError(f"{path} is not a BM25 index")
+        magic, self.document_count, self.term_count, self.average_length, self.terms_offset, self.documents_offset = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a BM25 index")
+
+    def __len__(self) -> int:
+        return self.document_count
+
+    def _find_term(self, term: str) -> Optional[tuple[int, int]]:
+        # Binary search of the term table, returns the document frequency and postings offset of the term
+        key = term.encode("utf-8")
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            text_offset, text_length, df, postings_offset = TERM.unpack_from(self.data, self.terms_offset + middle * TERM.size)
+            text = self.data[text_offset : text_offset + text_length]
+            if text < key:
+                low = middle + 1
+            elif text > key:
+                high = middle
+            else:
+                return df, postings_offset
+        return None
+
+    def _document_length(self, doc_id: int) -> int:
+        return DOCUMENT.unpack_from(self.data, self.documents_offset + doc_id * DOCUMENT.size)[2]
+
+    def document(self, doc_id: int) -> dict[str, Any]:
+        offset, length, _ = DOCUMENT.unpack_from(self.data, self.documents_offset + doc_id * DOCUMENT.size)
+        return json.loads(self.data[offset : offset + length].decode("utf-8"))
+
+    def documents(self) -> Iterator[dict[str, Any]]:
+        for doc_id in range(self.document_count):
+            yield self.document(doc_id)
+
+    def scores(self, query: str) -> dict[int, float]:
+        scores: dict[int, float] = {}
+        for term in set(analyze(query)):
+            found = self._find_term(term)
+            if not found:
+                continue
+            df, postings_offset = found
+            idf = math.log(1 + (self.document_count - df + 0.5) / (df + 0.5))
+            doc_ids = struct.unpack_from(f"<{df}I", self.data, postings_offset)
+            counts = struct.unpack_from(f"<{df}I", self.data, postings_offset + 4 * df)
+            for doc_id, count in zip(doc_ids, counts):
+                norm = self.k1 * (1 - self.b + self.b * self._document_length(doc_id) / (self.average_length or 1))
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        return scores
+
+    def search(
+        self, query: str, top: int, accept: Optional[Callable[[dict[str, Any]], bool]] = None
+    ) -> list[tuple[float, dict[str, Any]]]:
+        """The top best scoring sections for query, with their score, skipping those accept() rejects."""
+        scores = self.scores(query)
+        results = []
+        for doc_id in sorted(scores, key=lambda d: (-scores[d], d)):
+            document = self.document(doc_id)
+            if accept is None or accept(document):
+                results.append((scores[doc_id], document))
+                if len(results) >= top:
+                    break
+        return results
+
+
+def write_index(path: str, sections: Iterable[dict[str, Any]], content_field: str = "content"):
+    writer = BM25IndexWriter(content_field)
+    for section in sections:
+        writer.add(section)
+    writer.write(path)
@@ -0,0 +1,26 @@
+import multiprocessing
+import os
+import tempfile
+
+# Each worker runs an asyncio event loop, so it can keep many requests in flight while waiting on OpenAI, Cognitive
+# Search and Blob Storage; a few workers per core are enough
+max_requests = 1000
+max_requests_jitter = 50
+log_file = "-"
+bind = "0.0.0.0"
+
+timeout = 230
+# https://learn.microsoft.com/en-us/troubleshoot/azure/app-service/web-apps-performance-faqs#why-does-my-request-time-out-after-230-seconds
+
+num_cpus = multiprocessing.cpu_count()
+workers = (num_cpus * 2) + 1
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Workers share their Prometheus metrics through this directory, it has to exist before they import the app
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="prometheus-"))
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
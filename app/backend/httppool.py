@@ -0,0 +1,60 @@
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+from metrics import HTTP_CONNECTIONS
+
+
+class HttpPool:
+    """
+    One keep-alive connection pool for every outbound call of a worker: OpenAI (through openai.aiosession), Cognitive
+    Search and Blob Storage (through azure_transport()). Without it openai opens a new session, and so a new TLS
+    connection, for every completion. New and reused connections are counted on /metrics
+    (http_client_connections_total), once warmed up practically every request should reuse one.
+    aiohttp, which both SDKs are built on, only speaks HTTP/1.1, so connections are not multiplexed: limit_per_host
+    bounds the number of concurrent calls to each service.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 50,
+        keepalive_timeout: float = 60,
+        connect_timeout: float = 10,
+        read_timeout: float = 120,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._connection_created)
+        trace_config.on_connection_reuseconn.append(self._connection_reused)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=limit,
+                limit_per_host=limit_per_host,
+                keepalive_timeout=keepalive_timeout,
+                ttl_dns_cache=300,
+            ),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+            # Same as the sessions the Azure SDK creates for itself: no cookies shared between calls
+            cookie_jar=aiohttp.DummyCookieJar(),
+            trust_env=True,
+            trace_configs=[trace_config],
+        )
+
+    async def _connection_created(self, session, context, params):
+        HTTP_CONNECTIONS.labels(event="created").inc()
+
+    async def _connection_reused(self, session, context, params):
+        HTTP_CONNECTIONS.labels(event="reused").inc()
+
+    def azure_transport(self) -> AioHttpTransport:
+        # A transport per client, all on the shared session, which they don't close
+        return AioHttpTransport(
+            session=self.session,
+            session_owner=False,
+            connection_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+        )
+
+    async def close(self):
+        await self.session.close()
@@ -0,0 +1,64 @@
+import re
+from typing import Optional, Sequence
+
+# Identifiers as they appear in the policies (see extract_dni, extract_cuit and extract_npoliza in
+# scripts/data-ingestion-v2.py) and as users type them: DNI with or without dots, CUIT with or without dashes. The
+# index only has 8 digit DNIs
+NPOLIZA_PATTERN = re.compile(r"\b\d{3}-\d{8}-\d{2}\b")
+CUIT_PATTERN = re.compile(r"\b(\d{2})-?(\d{8})-?(\d)\b")
+DNI_PATTERN = re.compile(r"(?<![\d.-])(\d{2})\.?(\d{3})\.?(\d{3})(?!\d|[.-]\d)")
+
+# Any amount or phone number can look like a DNI, so outside of a message with nothing else it must come shortly after
+# a label ("DNI", "D.N.I.", "documento", "doc"), with no other number or amount in between
+DNI_LABEL_PATTERN = re.compile(r"\b(?:d\.?\s?n\.?\s?i|documento|doc)\b[^\d$]{0,20}$", re.IGNORECASE)
+CURRENCY_BEFORE_PATTERN = re.compile(r"(?:\$|\bars|\bu\$s|\busd)\s*$", re.IGNORECASE)
+CURRENCY_AFTER_PATTERN = re.compile(r"^\s*(?:pesos|ars|d[oó]lares|usd)\b", re.IGNORECASE)
+MESSAGE_PUNCTUATION = " \t\r\n.,;:!?¿¡"
+
+
+def is_dni(text: str, start: int, end: int) -> bool:
+    """Whether the DNI_PATTERN match at text[start:end] is a DNI rather than an amount or some other number."""
+    before, after = text[:start], text[end:]
+    if CURRENCY_BEFORE_PATTERN.search(before) or CURRENCY_AFTER_PATTERN.search(after):
+        return False
+    return text.strip(MESSAGE_PUNCTUATION) == text[start:end] or DNI_LABEL_PATTERN.search(before) is not None
+
+
+def find_identifiers(text: str) -> list[tuple[int, int, str, str]]:
+    """
+    Returns (start, end, kind, normalized value) for every policy number ("npoliza"), CUIT ("cuit") and DNI ("dni")
+    in the text, ordered by position. They are matched in that order of precedence so that e.g. the digits inside a
+    CUIT are not also reported as a DNI, and DNIs only when labeled or typed alone (see is_dni). CUITs are normalized
+    to XX-XXXXXXXX-X and DNIs to plain digits, the formats stored in the index.
+    """
+    found = []
+
+    def overlaps(start: int, end: int) -> bool:
+        return any(start < e and s < end for s, e, _, _ in found)
+
+    for m in NPOLIZA_PATTERN.finditer(text):
+        found.append((m.start(), m.end(), "npoliza", m.group(0)))
+    for m in CUIT_PATTERN.finditer(text):
+        if not overlaps(m.start(), m.end()):
+            found.append((m.start(), m.end(), "cuit", f"{m.group(1)}-{m.group(2)}-{m.group(3)}"))
+    for m in DNI_PATTERN.finditer(text):
+        if not overlaps(m.start(), m.end()) and is_dni(text, m.start(), m.end()):
+            found.append((m.start(), m.end(), "dni", "".join(m.groups())))
+    return sorted(found)
+
+
+def customer_identifier(messages: Sequence[str]) -> Optional[tuple[str, str]]:
+    """
+    Returns (kind, normalized value) of the DNI or CUIT a customer identified with, given their messages in order: the
+    latest one they confirmed by typing it in two different messages or, until they do, the first one they typed. None
+    when they haven't typed any.
+    """
+    counts: dict[tuple[str, str], int] = {}
+    first = confirmed = None
+    for message in messages:
+        for identifier in dict.fromkeys((kind, value) for _, _, kind, value in find_identifiers(message) if kind != "npoliza"):
+            counts[identifier] = counts.get(identifier, 0) + 1
+            first = first or identifier
+            if counts[identifier] == 2:
+                confirmed = identifier
+    return confirmed or first
@@ -1,47 +1,65 @@
+import time
 from typing import Any, Dict, List, Optional, Union
-from langchain.callbacks.base import BaseCallbackHandler
+from uuid import UUID
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun
+from langchain.llms.openai import AzureOpenAI
 from langchain.schema import AgentAction, AgentFinish, LLMResult
+from opentelemetry import context as otel_context, trace
+from opentelemetry.trace import Span, Status, StatusCode
+from metrics import STAGE_SECONDS, record_token_usage
+from singleflight import SingleFlight
+from tracing import tracer
 
 def ch(text: Union[str, object]) -> str:
     s = text if isinstance(text, str) else str(text)
     return s.replace("<", "&lt;").replace(">", "&gt;").replace("\r", "").replace("\n", "<br>")
 
-class HtmlCallbackHandler (BaseCallbackHandler):
+class HtmlCallbackHandler(AsyncCallbackHandler):
+    """Logs an agent run as html, for the thoughts shown in the UI. It is passed to the agent's run, so it also receives
+    the events of the chains and LLM calls nested in it: only the agent's own chain, its actions and the tools' output
+    are logged. Async, so that logging doesn't take a thread pool round trip per event."""
+
     html: str = ""
 
     def get_and_reset_log(self) -> str:
         result = self.html
         self.html = ""
         return result
-    
-    def on_llm_start(
-        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+
+    async def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], *, parent_run_id: Optional[UUID] = None, **kwargs: Any
     ) -> None:
         """Print out the prompts."""
-        self.html += f"LLM prompts:<br>" + "<br>".join(ch(prompts)) + "<br>";
+        if parent_run_id is None:
+            self.html += f"LLM prompts:<br>" + "<br>".join(ch(prompts)) + "<br>";
 
-    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         """Do nothing."""
         pass
 
-    def on_llm_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>LLM error: {ch(error)}</span><br>"
+    async def on_llm_error(self, error: Exception, *, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        if parent_run_id is None:
+            self.html += f"<span style='color:red'>LLM error: {ch(error)}</span><br>"
 
-    def on_chain_start(
-        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
+    async def on_chain_start(
+        self, serialized: Dict[str, Any], inputs: Dict[str, Any], *, parent_run_id: Optional[UUID] = None, **kwargs: Any
     ) -> None:
         """Print out that we are entering a chain."""
-        class_name = serialized["name"]
-        self.html += f"Entering chain: {ch(class_name)}<br>"
+        if parent_run_id is None:
+            class_name = serialized["name"]
+            self.html += f"Entering chain: {ch(class_name)}<br>"
 
-    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
+    async def on_chain_end(self, outputs: Dict[str, Any], *, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
         """Print out that we finished a chain."""
-        self.html += f"Finished chain<br>"
+        if parent_run_id is None:
+            self.html += f"Finished chain<br>"
 
-    def on_chain_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>Chain error: {ch(error)}</span><br>"
+    async def on_chain_error(self, error: Exception, *, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        if parent_run_id is None:
+            self.html += f"<span style='color:red'>Chain error: {ch(error)}</span><br>"
 
-    def on_tool_start(
+    async def on_tool_start(
         self,
         serialized: Dict[str, Any],
         input_str: str,
@@ -51,7 +69,7 @@ class HtmlCallbackHandler (BaseCallbackHandler):
         """Print out the log in specified color."""
         pass
 
-    def on_tool_end(
+    async def on_tool_end(
         self,
         output: str,
         color: Optional[str] = None,
@@ -62,27 +80,147 @@ class HtmlCallbackHandler (BaseCallbackHandler):
         """If not the final action, print out observation."""
         self.html += f"{ch(observation_prefix)}<br><span style='color:{color}'>{ch(output)}</span><br>{ch(llm_prefix)}<br>"
 
-    def on_tool_error(self, error: Exception, **kwargs: Any) -> None:
+    async def on_tool_error(self, error: Exception, **kwargs: Any) -> None:
         self.html += f"<span style='color:red'>Tool error: {ch(error)}</span><br>"
 
-    def on_text(
+    async def on_text(
         self,
         text: str,
         color: Optional[str] = None,
-        **kwargs: Optional[str],
+        *,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
     ) -> None:
         """Run when agent ends."""
-        self.html += f"<span style='color:{color}'>{ch(text)}</span><br>"
+        if parent_run_id is None:
+            self.html += f"<span style='color:{color}'>{ch(text)}</span><br>"
 
-    def on_agent_action(
+    async def on_agent_action(
         self, 
         action: AgentAction, 
         color: Optional[str] = None,
         **kwargs: Any) -> Any:
         self.html += f"<span style='color:{color}'>{ch(action.log)}</span><br>"
 
-    def on_agent_finish(
+    async def on_agent_finish(
         self, finish: AgentFinish, color: Optional[str] = None, **kwargs: Any
     ) -> None:
         """Run on agent end."""
         self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+
+
+class MetricsCallbackHandler(AsyncCallbackHandler):
+    """Times the completions ("llm" stage) and tool calls ("tool:<name>" stages) of an agent run and records the
+    tokens the completions used."""
+
+    def __init__(self, approach: str, deployment: str):
+        self.approach = approach
+        self.deployment = deployment
+        self.starts: Dict[UUID, float] = {}
+        self.tools: Dict[UUID, str] = {}
+
+    def _observe(self, run_id: UUID, stage: str, deployment: str = "") -> None:
+        # A tool with its own callbacks also inherits the agent's, so its events can arrive twice
+        start = self.starts.pop(run_id, None)
+        if start is not None:
+            STAGE_SECONDS.labels(self.approach, stage, deployment).observe(time.perf_counter() - start)
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self.starts.setdefault(run_id, time.perf_counter())
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id in self.starts:
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            record_token_usage(self.approach, self.deployment, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+        self._observe(run_id, "llm", self.deployment)
+
+    async def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        self._observe(run_id, "llm", self.deployment)
+
+    async def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self.starts.setdefault(run_id, time.perf_counter())
+        self.tools[run_id] = serialized.get("name") or "tool"
+
+    async def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._observe(run_id, "tool:" + self.tools.pop(run_id, "tool"))
+
+    async def on_tool_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        self._observe(run_id, "tool:" + self.tools.pop(run_id, "tool"))
+
+
+class TracingCallbackHandler(AsyncCallbackHandler):
+    """Traces the chains, completions and tool calls of a LangChain run as nested spans, under the span that was
+    current when the handler was created."""
+
+    def __init__(self):
+        self.context = otel_context.get_current()
+        self.spans: Dict[UUID, Span] = {}
+
+    def _start(self, name: str, run_id: UUID, parent_run_id: Optional[UUID], attributes: Dict[str, Any]) -> None:
+        if run_id in self.spans:
+            return
+        parent = self.spans.get(parent_run_id) if parent_run_id else None
+        context = trace.set_span_in_context(parent) if parent else self.context
+        self.spans[run_id] = tracer.start_span(name, context=context, attributes=attributes)
+
+    def _end(self, run_id: UUID, attributes: Optional[Dict[str, Any]] = None, error: Optional[BaseException] = None) -> None:
+        span = self.spans.pop(run_id, None)
+        if span is None:
+            return
+        if attributes:
+            span.set_attributes(attributes)
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(Status(StatusCode.ERROR, str(error)))
+        span.end()
+
+    async def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        self._start("chain " + (serialized.get("name") or "chain"), run_id, parent_run_id, {})
+
+    async def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    async def on_chain_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error=error)
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        self._start("llm", run_id, parent_run_id, {"prompt_length": sum(len(p) for p in prompts)})
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        self._end(run_id, {k: v for k, v in usage.items() if isinstance(v, int)})
+
+    async def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error=error)
+
+    async def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        self._start("tool " + (serialized.get("name") or "tool"), run_id, parent_run_id, {"input_length": len(input_str)})
+
+    async def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, {"output_length": len(output)})
+
+    async def on_tool_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error=error)
+
+
+llm_completions_in_flight = SingleFlight("completion")
+
+
+class CoalescingAzureOpenAI(AzureOpenAI):
+    """AzureOpenAI for agents whose completions at temperature 0 are coalesced with identical ones already in flight
+    (see SingleFlight), e.g. the first step of several agents answering the same question."""
+
+    async def _agenerate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+    ) -> LLMResult:
+        if self.temperature != 0 or self.n != 1 or self.streaming:
+            return await super()._agenerate(prompts, stop, run_manager)
+        key = (tuple(prompts), tuple(stop or ()), tuple(sorted((k, repr(v)) for k, v in self._identifying_params.items())))
+        result, coalesced = await llm_completions_in_flight.run(key, lambda: super(CoalescingAzureOpenAI, self)._agenerate(prompts, stop, run_manager))
+        if coalesced:
+            # The tokens were already counted for the agent that sent the completion
+            result = LLMResult(generations=result.generations, llm_output={**(result.llm_output or {}), "token_usage": {}})
+        return result
@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+import re
+from typing import Any, Callable, Optional
+from bm25index import BM25Index
+from metrics import RETRIEVAL_SOURCE
+from retrievalcache import CachedSearchResults, read_search_results
+from vectorindex import VectorIndex, get_embedder
+
+FILTER_CLAUSE = re.compile(r"\s*(\w+)\s+(eq|ne)\s+'((?:[^']|'')*)'\s*")
+FILTER_AND = re.compile(r"and\b")
+
+
+def parse_filter(filter: Optional[str]) -> Optional[Callable[[dict[str, Any]], bool]]:
+    """
+    Turns the OData filters the approaches send to Cognitive Search (field eq/ne 'value' clauses joined by "and") into
+    a function telling whether a section matches. Anything else raises ValueError: a filter that can't be applied
+    locally must not be ignored, it may be what keeps a customer from seeing another one's policies.
+    """
+    if not filter or not filter.strip():
+        return None
+    clauses = []
+    position = 0
+    while True:
+        m = FILTER_CLAUSE.match(filter, position)
+        if not m:
+            raise ValueError(f"Unsupported filter: {filter}")
+        clauses.append((m.group(1), m.group(2) == "eq", m.group(3).replace("''", "'")))
+        position = m.end()
+        if position == len(filter):
+            break
+        m = FILTER_AND.match(filter, position)
+        if not m:
+            raise ValueError(f"Unsupported filter: {filter}")
+        position = m.end()
+
+    def accept(document: dict[str, Any]) -> bool:
+        # Like OData, a missing field is never equal to a value
+        for field, equal, value in clauses:
+            actual = document.get(field)
+            if (actual is not None and str(actual) == value) != equal:
+                return False
+        return True
+
+    return accept
+
+
+class Caption:
+    # Stands in for the semantic captions of Cognitive Search, the approaches only read their text
+    def __init__(self, text: str):
+        self.text = text
+
+
+class LocalIndexSearchClient:
+    """
+    Searches the BM25 index file written by the ingestion scripts (see bm25index.py) with the same interface and result
+    shape as SearchClient. Only the search text, filter and top are taken into account: there is no semantic ranking,
+    and the whole section stands in for its caption. The file is opened again when ingestion replaces it.
+    """
+
+    def __init__(self, path: str, content_field: str = "content"):
+        self.path = path
+        self.content_field = content_field
+        self.version: Optional[tuple[int, int]] = None
+        self.index: Optional[BM25Index] = None
+        self._open_if_changed()
+
+    def _open_if_changed(self):
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version != self.version:
+            # Searches still using the previous file keep it mapped until they finish
+            self.index, self.version = BM25Index(self.path), version
+
+    async def search(self, search_text: str, filter: Optional[str] = None, top: Optional[int] = None, **kwargs: Any) -> CachedSearchResults:
+        self._open_if_changed()
+        accept = parse_filter(filter)
+        if is_match_all(search_text):
+            results = match_all(self.index, top or 50, accept)
+        else:
+            results = self.index.search(search_text or "", top or 50, accept)
+        documents = []
+        for score, document in results:
+            document["@search.score"] = score
+            document["@search.captions"] = [Caption(document.get(self.content_field) or "")]
+            documents.append(document)
+        return CachedSearchResults(documents, [] if kwargs.get("query_answer") else None, len(documents))
+
+    async def close(self):
+        pass
+
+
+class VectorSearchClient(LocalIndexSearchClient):
+    """
+    Searches the vector index file written by the ingestion scripts (see vectorindex.py) like LocalIndexSearchClient:
+    sections are ranked by cosine similarity with the search text, embedded the same way as they were. With
+    partitioned indexes only the nprobe lists closest to the query are scored.
+    """
+
+    def __init__(self, path: str, content_field: str = "content", nprobe: Optional[int] = None):
+        self.nprobe = nprobe
+        self.embedder = None
+        super().__init__(path, content_field)
+
+    def _open_if_changed(self):
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version != self.version:
+            index = VectorIndex(self.path)
+            # Replaced together, a search holding the previous pair embeds its query for that index
+            embedder = self.embedder if self.embedder and self.embedder.spec == index.embedding else get_embedder(index.embedding)
+            self.index, self.embedder, self.version = index, embedder, version
+
+    async def search(self, search_text: str, filter: Optional[str] = None, top: Optional[int] = None, **kwargs: Any) -> CachedSearchResults:
+        self._open_if_changed()
+        index, embedder, accept = self.index, self.embedder, parse_filter(filter)
+        # Embedding models and large indexes would hold up the event loop, hashing a query and scoring a few thousand
+        # sections don't
+        if embedder.blocking or len(index) > 100_000:
+            results = await asyncio.to_thread(self._search, index, embedder, search_text, top, accept)
+        else:
+            results = self._search(index, embedder, search_text, top, accept)
+        documents = []
+        for score, document in results:
+            document["@search.score"] = score
+            document["@search.captions"] = [Caption(document.get(self.content_field) or "")]
+            documents.append(document)
+        return CachedSearchResults(documents, [] if kwargs.get("query_answer") else None, len(documents))
+
+    def _search(self, index: VectorIndex, embedder, search_text: str, top: Optional[int], accept) -> list[tuple[float, dict[str, Any]]]:
+        if is_match_all(search_text):
+            return match_all(index, top or 50, accept)
+        query = embedder.embed([search_text or ""])[0]
+        return index.search(query, top or 50, accept, self.nprobe)
+
+
+def is_match_all(search_text: Optional[str]) -> bool:
+    return (search_text or "").strip() == "*"
+
+
+def match_all(index, top: int, accept: Optional[Callable[[dict[str, Any]], bool]]) -> list[tuple[float, dict[str, Any]]]:
+    # "*" matches every section the filter lets through, all with the same score, as in Cognitive Search
+    results = []
+    for document in index.documents():
+        if accept is None or accept(document):
+            results.append((1.0, document))
+            if len(results) >= top:
+                break
+    return results
+
+
+class TieredSearchClient:
+    """
+    Puts a local index (LocalIndexSearchClient or VectorSearchClient) in front of or beside Cognitive Search, or of
+    another TieredSearchClient, depending on mode:
+    - fallback: Search answers, the local index only does when Search fails or takes longer than timeout seconds.
+    - first: the local index answers, Search only does when the local index finds nothing (or can't apply the filter).
+    - hybrid: both are searched at the same time and their results merged by reciprocal rank fusion, Search's copy of a
+      section being the one kept. When Search fails the local results are returned on their own.
+    """
+
+    modes = ("fallback", "first", "hybrid")
+
+    def __init__(
+        self, search_client, local_client: LocalIndexSearchClient, mode: str = "fallback", timeout: Optional[float] = None, name: str = "bm25"
+    ):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown local index mode {mode}, use one of {', '.join(self.modes)}")
+        self.search_client = search_client
+        self.local_client = local_client
+        self.mode = mode
+        self.timeout = timeout or None
+        # Tells tiers apart in the metrics
+        self.name = name
+
+    async def search(self, search_text: str, **kwargs: Any) -> Any:
+        if self.mode == "first":
+            return await self._search_first(search_text, **kwargs)
+        if self.mode == "hybrid":
+            return await self._search_hybrid(search_text, **kwargs)
+        return await self._search_fallback(search_text, **kwargs)
+
+    async def _search_remote(self, search_text: str, **kwargs: Any) -> CachedSearchResults:
+        # Read in full within the timeout, the documents are only downloaded while iterating
+        return await asyncio.wait_for(read_search_results(self.search_client, search_text, **kwargs), self.timeout)
+
+    async def _search_local(self, search_text: str, **kwargs: Any) -> Optional[CachedSearchResults]:
+        # None when the local index can't answer, e.g. a filter it doesn't support
+        try:
+            return await self.local_client.search(search_text, **kwargs)
+        except ValueError:
+            return None
+        except Exception:
+            logging.exception("Local index search failed")
+            return None
+
+    async def _search_fallback(self, search_text: str, **kwargs: Any) -> Any:
+        try:
+            r = await self._search_remote(search_text, **kwargs)
+        except Exception as e:
+            local = await self._search_local(search_text, **kwargs)
+            if local is None:
+                raise
+            logging.warning("Search failed, answering from the local index: %r", e)
+            RETRIEVAL_SOURCE.labels(self.name, "fallback").inc()
+            return local
+        RETRIEVAL_SOURCE.labels(self.name, "search").inc()
+        return r
+
+    async def _search_first(self, search_text: str, **kwargs: Any) -> Any:
+        local = await self._search_local(search_text, **kwargs)
+        if local and local.documents:
+            RETRIEVAL_SOURCE.labels(self.name, "local").inc()
+            return local
+        RETRIEVAL_SOURCE.labels(self.name, "search").inc()
+        return await self.search_client.search(search_text, **kwargs)
+
+    async def _search_hybrid(self, search_text: str, **kwargs: Any) -> Any:
+        remote = asyncio.create_task(self._search_remote(search_text, **kwargs))
+        local = await self._search_local(search_text, **kwargs)
+        if local is None:
+            RETRIEVAL_SOURCE.labels(self.name, "search").inc()
+            return await remote
+        try:
+            r = await remote
+        except Exception as e:
+            logging.warning("Search failed, answering from the local index: %r", e)
+            RETRIEVAL_SOURCE.labels(self.name, "fallback").inc()
+            return local
+        RETRIEVAL_SOURCE.labels(self.name, "hybrid").inc()
+        documents = fuse([r.documents, local.documents], kwargs.get("top") or 50)
+        return CachedSearchResults(documents, r.answers, r.count)
+
+    async def close(self):
+        await self.search_client.close()
+        await self.local_client.close()
+
+
+def fuse(rankings: list[list[dict[str, Any]]], top: int, k: int = 60) -> list[dict[str, Any]]:
+    # Reciprocal rank fusion: every list a section appears in adds 1 / (k + rank), the first copy seen is kept
+    scores: dict[str, float] = {}
+    documents: dict[str, dict[str, Any]] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            key = document.get("id") or document.get("sourcepage")
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank + 1)
+            documents.setdefault(key, document)
+    return [documents[key] for key in sorted(scores, key=lambda key: -scores[key])[:top]]
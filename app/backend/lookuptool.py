@@ -1,20 +1,261 @@
+import array
+import bisect
+import contextlib
 import csv
+import glob
+import heapq
+import itertools
+import mmap
+import os
+import tempfile
+import threading
+import zlib
 from pathlib import Path
 from langchain.agents import Tool
 from langchain.callbacks.manager import Callbacks
-from typing import Optional, Union
+from typing import Any, Iterator, Optional, Sequence, Union
+
+# Files bigger than this are looked up through a memory-mapped index instead of being loaded into memory
+CSV_INDEX_THRESHOLD_BYTES = int(os.environ.get("CSV_INDEX_THRESHOLD_BYTES") or 64 * 1024 * 1024)
+CSV_INDEX_DIR = os.environ.get("CSV_INDEX_DIR") or os.path.join(tempfile.gettempdir(), "csv-lookup")
+
+# Index records are 64-bit integers: a 30-bit hash of the key followed by the 34-bit offset of its row in the file
+HASH_BITS = 30
+OFFSET_BITS = 34
+SORT_CHUNK_RECORDS = 1_000_000
+
+
+def format_row(header: Sequence[str], row: Sequence[str]) -> str:
+    return "\n".join(f"{field}:{value}" for field, value in zip(header, row))
+
+
+def key_hash(value: str) -> int:
+    return zlib.crc32(value.encode("utf-8")) >> (32 - HASH_BITS)
+
+
+class MemoryTable:
+    """Rows of a small CSV file kept in memory as tuples of strings, with a dict per key field from value to rows."""
+
+    def __init__(self, filename: str, key_fields: Sequence[str]):
+        with open(filename, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            self.header = tuple(next(reader, ()))
+            self.rows = [tuple(row) for row in reader]
+        self.indexes: dict[str, dict[str, Union[int, list[int]]]] = {}
+        for field in key_fields:
+            column = self.header.index(field)
+            index: dict[str, Union[int, list[int]]] = {}
+            for i, row in enumerate(self.rows):
+                # Most values are unique, a list is only made for the ones repeated
+                positions = index.setdefault(row[column], i)
+                if isinstance(positions, list):
+                    positions.append(i)
+                elif positions != i:
+                    index[row[column]] = [positions, i]
+            self.indexes[field] = index
+
+    def find(self, field: str, value: str) -> list[tuple[str, ...]]:
+        positions = self.indexes[field].get(value)
+        if positions is None:
+            return []
+        return [self.rows[i] for i in positions] if isinstance(positions, list) else [self.rows[positions]]
+
+    def close(self):
+        pass
+
+
+class MappedTable:
+    """
+    Rows of a large CSV file read straight from the memory-mapped file through a sorted index per key field, also
+    memory-mapped, so neither is loaded into the process: lookups are a binary search over the index and the matching
+    rows are parsed from the file. Indexes are written to index_dir once per version of the file and shared by every
+    process. Rows must not contain line breaks. New versions of the file must replace it (written elsewhere and
+    renamed over it): rewriting a mapped file in place crashes the processes reading it.
+    """
+
+    def __init__(self, filename: str, key_fields: Sequence[str], index_dir: str):
+        self.file = open(filename, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = tuple(next(csv.reader([self.data.readline().decode("utf-8")]), ()))
+        self.indexes: dict[str, tuple[Any, mmap.mmap, memoryview]] = {}
+        stat = os.fstat(self.file.fileno())
+        for field in key_fields:
+            path = self._index_path(filename, field, index_dir, stat)
+            if not os.path.exists(path):
+                self._build_index(field, path)
+                # Indexes of previous versions of the file, processes still reading them keep them open until they reload
+                prefix = self._index_prefix(filename, field, index_dir)
+                for stale in glob.glob(glob.escape(prefix) + "*.idx"):
+                    if stale != path:
+                        with contextlib.suppress(OSError):
+                            os.remove(stale)
+            index_file = open(path, "rb")
+            if os.fstat(index_file.fileno()).st_size:
+                index_data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.indexes[field] = (index_file, index_data, memoryview(index_data).cast("Q"))
+            else:
+                self.indexes[field] = (index_file, None, memoryview(array.array("Q")))
+
+    def _index_path(self, filename: str, field: str, index_dir: str, stat: os.stat_result) -> str:
+        return f"{self._index_prefix(filename, field, index_dir)}{stat.st_size}-{stat.st_mtime_ns}.idx"
+
+    def _index_prefix(self, filename: str, field: str, index_dir: str) -> str:
+        name = os.path.basename(filename)
+        return os.path.join(index_dir, f"{name}-{zlib.crc32(filename.encode()):08x}-{field}-")
+
+    def _records(self, column: int) -> Iterator[int]:
+        self.data.seek(0)
+        offset = len(self.data.readline())
+        for line in iter(self.data.readline, b""):
+            row = next(csv.reader([line.decode("utf-8")]), None)
+            if row and column < len(row):
+                yield key_hash(row[column]) << OFFSET_BITS | offset
+            offset += len(line)
+
+    def _build_index(self, field: str, path: str):
+        # Sorted in chunks written to temporary files and merged, so building the index of a file with millions of rows
+        # doesn't need memory for all of them at once
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        column = self.header.index(field)
+        chunks = []
+        records = self._records(column)
+        while True:
+            chunk = array.array("Q", sorted(itertools.islice(records, SORT_CHUNK_RECORDS)))
+            if not chunk:
+                break
+            f = tempfile.TemporaryFile(dir=os.path.dirname(path))
+            chunk.tofile(f)
+            f.seek(0)
+            chunks.append(f)
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as out:
+            buffer = array.array("Q")
+            for record in heapq.merge(*[self._read_chunk(f) for f in chunks]):
+                buffer.append(record)
+                if len(buffer) >= 65536:
+                    buffer.tofile(out)
+                    buffer = array.array("Q")
+            buffer.tofile(out)
+        for f in chunks:
+            f.close()
+        # Other processes may build the same index at the same time, whichever finishes last replaces an identical file
+        os.replace(temp_path, path)
+
+    def _read_chunk(self, f) -> Iterator[int]:
+        while True:
+            block = array.array("Q")
+            block.frombytes(f.read(8 * 65536))
+            if not block:
+                return
+            yield from block
+
+    def find(self, field: str, value: str) -> list[tuple[str, ...]]:
+        records = self.indexes[field][2]
+        column = self.header.index(field)
+        h = key_hash(value)
+        rows = []
+        i = bisect.bisect_left(records, h << OFFSET_BITS)
+        while i < len(records) and records[i] >> OFFSET_BITS == h:
+            offset = records[i] & ((1 << OFFSET_BITS) - 1)
+            end = self.data.find(b"\n", offset)
+            line = self.data[offset : end if end >= 0 else len(self.data)].decode("utf-8")
+            row = tuple(next(csv.reader([line]), ()))
+            # Different keys can share a hash
+            if column < len(row) and row[column] == value:
+                rows.append(row)
+            i += 1
+        return rows
+
+    def close(self):
+        for index_file, index_data, records in self.indexes.values():
+            records.release()
+            if index_data:
+                index_data.close()
+            index_file.close()
+        self.data.close()
+        self.file.close()
+
+
+class CsvLookupStore:
+    """
+    Rows of a CSV file looked up by key_field or any of secondary_keys, loaded once per process and shared by every
+    tool reading the same file. Rows are only formatted as text when they are looked up. The file is loaded again when
+    its modification time or size changes. Files bigger than index_threshold_bytes are not loaded at all but read
+    through memory-mapped indexes (see MappedTable), so startup time and memory stay flat however many rows they have.
+    """
+
+    def __init__(
+        self,
+        filename: Union[str, Path],
+        key_field: str,
+        secondary_keys: Sequence[str] = (),
+        index_threshold_bytes: int = CSV_INDEX_THRESHOLD_BYTES,
+        index_dir: str = CSV_INDEX_DIR,
+    ):
+        self.filename = os.path.abspath(filename)
+        self.key_fields = (key_field, *secondary_keys)
+        self.index_threshold_bytes = index_threshold_bytes
+        self.index_dir = index_dir
+        self.version: Optional[tuple[int, int]] = None
+        self.table: Union[MemoryTable, MappedTable, None] = None
+        self.lock = threading.Lock()
+        self._load_if_changed()
+
+    def _load_if_changed(self) -> Union[MemoryTable, MappedTable]:
+        """
+        The table of the current version of the file. Callers keep using the table they got even if the file changes
+        meanwhile: the previous table is not closed but dropped, and garbage collected (unmapping its files) once the
+        last lookup still reading it is done.
+        """
+        stat = os.stat(self.filename)
+        version = (stat.st_mtime_ns, stat.st_size)
+        table = self.table
+        if version == self.version:
+            return table
+        with self.lock:
+            if version != self.version:
+                if stat.st_size > self.index_threshold_bytes:
+                    self.table = MappedTable(self.filename, self.key_fields, self.index_dir)
+                else:
+                    self.table = MemoryTable(self.filename, self.key_fields)
+                self.version = version
+            return self.table
+
+    def lookup(self, value: str) -> Optional[str]:
+        """The row with value as key or, failing that, the rows with value in the first secondary key that has any."""
+        table = self._load_if_changed()
+        for field in self.key_fields:
+            rows = table.find(field, value)
+            if rows:
+                return "\n\n".join(format_row(table.header, row) for row in rows)
+        return None
+
+
+stores: dict[tuple, CsvLookupStore] = {}
+stores_lock = threading.Lock()
+
+
+def get_store(filename: Union[str, Path], key_field: str, secondary_keys: Sequence[str] = ()) -> CsvLookupStore:
+    key = (os.path.abspath(filename), key_field, tuple(secondary_keys))
+    with stores_lock:
+        store = stores.get(key)
+        if not store:
+            store = stores[key] = CsvLookupStore(filename, key_field, secondary_keys)
+    return store
+
 
 class CsvLookupTool(Tool):
-    data: dict[str, str] = {}
+    store: Any = None
 
-    def __init__(self, filename: Union[str, Path], key_field: str, name: str = "lookup", 
+    def __init__(self, filename: Union[str, Path], key_field: str, name: str = "lookup",
                  description: str = "useful to look up details given an input key as opposite to searching data with an unstructured question",
-                 callbacks: Callbacks = None):
-        super().__init__(name, self.lookup, description, callbacks=callbacks)
-        with open(filename, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.data[row[key_field]] =  "\n".join([f"{i}:{row[i]}" for i in row])
+                 callbacks: Callbacks = None, secondary_keys: Sequence[str] = ()):
+        super().__init__(name, self.lookup, description, coroutine=self.alookup, callbacks=callbacks)
+        self.store = get_store(filename, key_field, secondary_keys)
 
     def lookup(self, key: str) -> Optional[str]:
-        return self.data.get(key, "")
+        return self.store.lookup(key) or ""
+
+    async def alookup(self, key: str) -> Optional[str]:
+        return self.func(key)
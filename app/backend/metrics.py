@@ -0,0 +1,87 @@
+import os
+from typing import Optional
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# All metrics exposed on /metrics. When the app runs under gunicorn (see gunicorn.conf.py) every worker writes its
+# values to PROMETHEUS_MULTIPROC_DIR and a scrape adds them up, so it doesn't matter which worker answers it.
+
+QUERY_REWRITE_PATH = Counter(
+    "chat_search_query_total",
+    "Chat requests by how the search query was produced: identifier (filtered lookup of the policy number, CUIT or "
+    "DNI in the message), keywords (local fast path), cache (stored rewrite) or llm",
+    ["path"],
+)
+
+TOKEN_REFRESH_SECONDS = Histogram(
+    "aad_token_refresh_seconds", "Time taken to get a new Azure AD token, including failed attempts", ["scope"]
+)
+TOKEN_REFRESH_FAILURES = Counter("aad_token_refresh_failures_total", "Failed Azure AD token refreshes", ["scope"])
+TOKEN_EXPIRES = Gauge(
+    "aad_token_expiry_timestamp_seconds",
+    "Expiry time of the current Azure AD token, the earliest one across workers",
+    ["scope"],
+    multiprocess_mode="min",
+)
+
+HTTP_CONNECTIONS = Counter(
+    "http_client_connections_total",
+    "Outbound connections to OpenAI, Cognitive Search and Blob Storage: created (a new TLS handshake) or reused",
+    ["event"],
+)
+
+COALESCED_CALLS = Counter(
+    "coalesced_calls_total",
+    "Deterministic searches and completions (kind) that were sent, or coalesced with an identical call already in flight",
+    ["kind", "result"],
+)
+
+RETRIEVAL_SOURCE = Counter(
+    "retrieval_source_total",
+    "Searches by local index (bm25 or vector) and where their results came from when one is set up (see "
+    "localsearch.py): search, local, hybrid (both merged) or fallback (local after Search failed or timed out)",
+    ["index", "source"],
+)
+
+# Stages are e.g. rewrite, search, prompt and answer, "llm" for the completions made by LangChain agents and
+# "tool:<name>" for agent tool calls. deployment is empty for stages that don't call OpenAI.
+STAGE_SECONDS = Histogram(
+    "approach_stage_seconds",
+    "Time spent in each stage of an approach",
+    ["approach", "stage", "deployment"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80),
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "time_to_first_token_seconds",
+    "Time from the start of a streamed answer to the first event with answer text, by approach name (e.g. "
+    "readretrieveread for /ask, chatreadretrieveread for /chat)",
+    ["approach"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 7.5, 10, 20, 40),
+)
+OPENAI_TOKENS = Counter(
+    "openai_tokens_total", "Tokens used by OpenAI completions, by type (prompt or completion)", ["approach", "deployment", "type"]
+)
+
+
+def record_token_usage(approach: str, deployment: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    if prompt_tokens:
+        OPENAI_TOKENS.labels(approach, deployment, "prompt").inc(prompt_tokens)
+    if completion_tokens:
+        OPENAI_TOKENS.labels(approach, deployment, "completion").inc(completion_tokens)
+
+
+def render() -> tuple[bytes, str]:
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
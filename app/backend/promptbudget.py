@@ -0,0 +1,125 @@
+import logging
+import math
+from typing import Protocol, Sequence
+
+
+class Tokenizer(Protocol):
+    def count(self, text: str) -> int:
+        ...
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        ...
+
+
+class TiktokenTokenizer:
+    """
+    Exact token counts for the OpenAI models (cl100k_base for gpt-35-turbo, p50k_base for text-davinci-003).
+    tiktoken downloads the encoding the first time it is used; point TIKTOKEN_CACHE_DIR at a directory that already
+    contains it to run fully offline.
+    """
+
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        import tiktoken
+
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[: max(max_tokens, 0)])
+
+
+class ApproximateTokenizer:
+    """
+    Character based estimate, used when tiktoken isn't available. Spanish text averages a bit over 3 characters per
+    token, so this errs on the side of counting too many.
+    """
+
+    def __init__(self, chars_per_token: float = 3):
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        return text[: max(int(max_tokens * self.chars_per_token), 0)]
+
+
+def get_tokenizer(encoding_name: str) -> Tokenizer:
+    try:
+        return TiktokenTokenizer(encoding_name)
+    except Exception as e:
+        logging.warning("Could not load the %s tokenizer, prompt sizes will be estimated: %s", encoding_name, e)
+        return ApproximateTokenizer()
+
+
+class PromptBudget:
+    """
+    Splits the context window of a deployment between the parts of a prompt, by priority:
+    1. the fixed text (instructions, injected prompt, question) and the tokens reserved for the completion,
+    2. the current turn and earlier turns up to history_tokens,
+    3. the retrieved sources, in rank order,
+    4. older turns, with whatever the sources left.
+    Sources and turns are only ever added whole, except for the top source when it alone doesn't fit (e.g. a section
+    holding a large table), which is cut so the prompt isn't sent without any source at all.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, context_window: int, history_tokens: int = 1200):
+        self.tokenizer = tokenizer
+        self.context_window = context_window
+        self.history_tokens = history_tokens
+
+    def fit(
+        self,
+        fixed: str,
+        sources: Sequence[str],
+        turns: Sequence[str],
+        max_completion_tokens: int,
+        separator: str = "\n",
+    ) -> tuple[list[str], list[str]]:
+        # turns are given newest first, the first one is the question being answered and is always kept
+        available = self.context_window - max_completion_tokens - self.tokenizer.count(fixed)
+        separator_tokens = self.tokenizer.count(separator)
+        turn_tokens = [self.tokenizer.count(t) for t in turns]
+
+        used = 0
+        kept_turns = 0
+        history_limit = min(self.history_tokens, available)
+        while kept_turns < len(turns) and (kept_turns == 0 or used + turn_tokens[kept_turns] <= history_limit):
+            used += turn_tokens[kept_turns]
+            kept_turns += 1
+
+        kept_sources = []
+        for source in sources:
+            tokens = self.tokenizer.count(source) + separator_tokens
+            if used + tokens <= available:
+                kept_sources.append(source)
+                used += tokens
+            elif not kept_sources and available - used - separator_tokens > 0:
+                source = self.tokenizer.truncate(source, available - used - separator_tokens)
+                kept_sources.append(source)
+                used += self.tokenizer.count(source) + separator_tokens
+
+        while kept_turns < len(turns) and used + turn_tokens[kept_turns] <= available:
+            used += turn_tokens[kept_turns]
+            kept_turns += 1
+
+        if used > available:
+            logging.warning("Prompt is %d tokens over the context window", used - available)
+        return kept_sources, list(turns[:kept_turns])
+
+    def fit_turns(self, turns: Sequence[str], max_tokens: int) -> list[str]:
+        # Newest first, stopping at the first turn that doesn't fit; the newest one is always kept
+        used = 0
+        kept = 0
+        for turn in turns:
+            tokens = self.tokenizer.count(turn)
+            if kept and used + tokens > max_tokens:
+                break
+            used += tokens
+            kept += 1
+        return list(turns[:kept])
@@ -0,0 +1,85 @@
+import re
+from identifiers import find_identifiers
+from text import fold_accents
+
+# Spanish function words, greetings and filler that never help a keyword search, stored without accents
+SPANISH_STOPWORDS = frozenset(
+    """
+    a al algo algun alguna algunas alguno algunos ante antes aqui asi aun bajo bien buen buena buenas bueno buenos
+    cada como con contra cual cuales cuando cuanto cuanta cuantos cuantas de del desde donde dos e el ella ellas
+    ello ellos en entre era eran es esa esas ese eso esos esta estaba estan estar estas este esto estos estoy fue
+    fueron ha haber habia han has hasta hay he hola gracias favor la las le les lo los mas me mi mis mucho muy nada
+    ni no nos nosotros o os otra otras otro otros para pero poco por porque puede pueden puedo que quien quienes
+    quiero quisiera saber se sea ser si sin sobre su sus tambien tan tanto te tener tengo ti tiene tienen toda
+    todas todo todos tu tus un una unas uno unos usted ustedes y ya yo dia dias tardes noches consulta pregunta
+    necesito podria podrias decir dime quiere
+    """.split()
+)
+
+# Words naming the identifier next to it ("mi DNI es ...", "póliza nro ..."), stored without accents
+IDENTIFIER_LABELS = frozenset("dni cuit cuil documento poliza numero nro n".split())
+
+# Words that refer back to earlier turns, a message using them can't be turned into a query without the history
+ANAPHORIC_WORDS = frozenset(
+    "eso esa ese esto esta este ello aquello aquella anterior mismo misma tambien otra otro dicha dicho".split()
+)
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def content_terms(text: str) -> list[str]:
+    terms = []
+    seen = set()
+    for word in WORD_PATTERN.findall(text.lower()):
+        folded = fold_accents(word)
+        if folded in SPANISH_STOPWORDS or folded in seen or (len(folded) < 2 and not folded.isdigit()):
+            continue
+        seen.add(folded)
+        terms.append(word)
+    return terms
+
+
+def build_search_query(text: str) -> str:
+    """
+    Builds a keyword search query from a user message without calling GPT: policy numbers, CUITs and DNIs are kept
+    as complete terms (normalized to the format stored in the index), the remaining words are lowercased and stopwords
+    and repeated words are dropped. Stopwords are matched ignoring accents, but the kept words keep their accents
+    since that is how they appear in the indexed policies.
+    """
+    parts = []
+    last = 0
+    for start, end, _, value in find_identifiers(text):
+        parts.extend(content_terms(text[last:start]))
+        parts.append(value)
+        last = end
+    parts.extend(content_terms(text[last:]))
+    return " ".join(parts) or text.strip()
+
+
+def split_identifiers(text: str) -> tuple[list[tuple[str, str]], str]:
+    """
+    Separates the policy numbers, CUITs and DNIs of a user message, as (kind, normalized value) in order, from a
+    keyword query built from the rest of it without the words naming them. The query is "*", which matches every
+    section, when nothing else is left.
+    """
+    identifiers = []
+    parts = []
+    last = 0
+    for start, end, kind, value in find_identifiers(text):
+        parts.extend(content_terms(text[last:start]))
+        identifiers.append((kind, value))
+        last = end
+    parts.extend(content_terms(text[last:]))
+    return identifiers, " ".join(t for t in parts if fold_accents(t) not in IDENTIFIER_LABELS) or "*"
+
+
+def is_keyword_like(text: str, max_terms: int = 6) -> bool:
+    """
+    True for short messages that already read like a search ("cobertura granizo póliza auto", "franquicia robo moto")
+    and don't refer back to the conversation, so the keywords alone make a good query.
+    """
+    words = [fold_accents(w) for w in WORD_PATTERN.findall(text.lower())]
+    if not words or len(words) > max_terms + 2 or any(w in ANAPHORIC_WORDS for w in words):
+        return False
+    terms = [w for w in words if w not in SPANISH_STOPWORDS]
+    return 0 < len(terms) <= max_terms and len(terms) * 2 >= len(words)
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+from azure.search.documents.aio import SearchClient
+from singleflight import SingleFlight
+
+
+class CachedSearchResults:
+    """
+    Fully read search results that can be replayed any number of times. Mirrors the parts of AsyncSearchItemPaged the
+    approaches use: async iteration, get_answers() and get_count().
+    """
+
+    def __init__(self, documents: list[dict[str, Any]], answers: Optional[list], count: Optional[int]):
+        self.documents = documents
+        self.answers = answers
+        self.count = count
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.documents:
+            yield doc
+
+    async def get_answers(self) -> Optional[list]:
+        return self.answers
+
+    async def get_count(self) -> Optional[int]:
+        return self.count
+
+
+def search_key(search_text: str, kwargs: dict[str, Any]) -> tuple:
+    return (search_text, tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+
+
+async def read_search_results(search_client: SearchClient, search_text: str, **kwargs: Any) -> CachedSearchResults:
+    r = await search_client.search(search_text, **kwargs)
+    documents = [doc async for doc in r]
+    answers = await r.get_answers() if kwargs.get("query_answer") else None
+    count = await r.get_count() if kwargs.get("include_total_count") else None
+    return CachedSearchResults(documents, answers, count)
+
+
+class CachedSearchClient:
+    """
+    Drop-in replacement for the async SearchClient used by the approaches that keeps recent results in memory, so the
+    same question asked again within ttl seconds doesn't cost another query. Entries are keyed on the search text and
+    every search option (filter, query type, language, speller, captions, answers, top...) and evicted least recently
+    used first once max_entries is reached.
+    invalidate() drops everything, e.g. after ingestion changed the index. When generation_file is set, invalidations
+    are shared with the other workers on the machine through the file's mtime. Entries can be shared by requests
+    running on different threads.
+    """
+
+    def __init__(
+        self,
+        search_client: SearchClient,
+        ttl: float = 300,
+        max_entries: int = 1000,
+        generation_file: Optional[str] = None,
+    ):
+        self.search_client = search_client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.generation_file = generation_file
+        self.generation = self._read_generation()
+        self.entries: OrderedDict[tuple, tuple[float, CachedSearchResults]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    async def search(self, search_text: str, **kwargs: Any) -> CachedSearchResults:
+        generation = self._read_generation()
+        key = search_key(search_text, kwargs)
+        with self.lock:
+            if generation != self.generation:
+                self.generation = generation
+                self.entries.clear()
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        results = await read_search_results(self.search_client, search_text, **kwargs)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return results
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+        if self.generation_file:
+            with open(self.generation_file, "a"):
+                pass
+            os.utime(self.generation_file)
+            self.generation = self._read_generation()
+
+    def _read_generation(self) -> Optional[int]:
+        if not self.generation_file:
+            return None
+        try:
+            return os.stat(self.generation_file).st_mtime_ns
+        except OSError:
+            return None
+
+    async def close(self):
+        await self.search_client.close()
+
+
+class CoalescingSearchClient:
+    """
+    Wraps the async SearchClient so that identical searches (same text and options) running at the same time are sent
+    once, see SingleFlight. Results are read in full so that every caller gets its own replay of them.
+    """
+
+    def __init__(self, search_client: SearchClient):
+        self.search_client = search_client
+        self.in_flight = SingleFlight("search")
+
+    async def search(self, search_text: str, **kwargs: Any) -> CachedSearchResults:
+        results, _ = await self.in_flight.run(
+            search_key(search_text, kwargs),
+            lambda: read_search_results(self.search_client, search_text, **kwargs),
+        )
+        return results
+
+    async def close(self):
+        await self.search_client.close()
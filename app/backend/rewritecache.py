@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+class QueryRewriteCache:
+    """
+    Persistent cache of the search queries generated by the rewrite completion. The rewrite runs at temperature 0, so
+    the same rendered prompt sent to the same deployment always yields the same query and can be reused. Entries live
+    in a SQLite file so every worker process (and restarts) share them; the least recently used entries are dropped
+    once there are more than max_entries. Any database error is treated as a cache miss, and a database that can't be
+    opened leaves the cache disabled. The connection is shared by the threads of the worker, one statement at a time,
+    and get and put run it in a thread so that waiting on another worker's write lock never blocks the event loop.
+    Hits only read: when entries were last used is kept in memory and written with the next put, or once
+    flush_hits entries or flush_seconds have gone by.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, flush_hits: int = 100, flush_seconds: float = 60):
+        self.max_entries = max_entries
+        self.flush_hits = flush_hits
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.hits: dict[str, float] = {}
+        self.flushed_at = time.monotonic()
+        self.connection = None
+        try:
+            connection = sqlite3.connect(path, timeout=1, isolation_level=None, check_same_thread=False)
+            try:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS rewrites (key TEXT PRIMARY KEY, query TEXT NOT NULL, last_used REAL NOT NULL)"
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS rewrites_last_used ON rewrites (last_used)")
+            except sqlite3.Error:
+                connection.close()
+                raise
+            self.connection = connection
+        except sqlite3.Error:
+            logging.exception("Query rewrite cache could not be opened, it is disabled")
+
+    def _key(self, deployment: str, prompt: str) -> str:
+        return hashlib.sha256(f"{deployment}\0{prompt}".encode("utf-8")).hexdigest()
+
+    async def get(self, deployment: str, prompt: str) -> Optional[str]:
+        if self.connection is None:
+            return None
+        return await asyncio.to_thread(self._get, self._key(deployment, prompt))
+
+    async def put(self, deployment: str, prompt: str, query: str):
+        if self.connection is not None:
+            await asyncio.to_thread(self._put, self._key(deployment, prompt), query)
+
+    def _get(self, key: str) -> Optional[str]:
+        try:
+            with self.lock:
+                row = self.connection.execute("SELECT query FROM rewrites WHERE key = ?", (key,)).fetchone()
+                if row:
+                    self.hits[key] = time.time()
+                    if len(self.hits) >= self.flush_hits or time.monotonic() - self.flushed_at >= self.flush_seconds:
+                        self._flush_hits()
+        except sqlite3.Error:
+            logging.exception("Query rewrite cache lookup failed")
+            return None
+        return row[0] if row else None
+
+    def _put(self, key: str, query: str):
+        try:
+            with self.lock:
+                self._flush_hits()
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO rewrites (key, query, last_used) VALUES (?, ?, ?)",
+                    (key, query, time.time()),
+                )
+                self.connection.execute(
+                    "DELETE FROM rewrites WHERE key IN "
+                    "(SELECT key FROM rewrites ORDER BY last_used LIMIT MAX(0, (SELECT COUNT(*) FROM rewrites) - ?))",
+                    (self.max_entries,),
+                )
+        except sqlite3.Error:
+            logging.exception("Query rewrite cache update failed")
+
+    def _flush_hits(self):
+        # Called with the lock held. The hits are dropped even if the write fails, they only order evictions
+        hits, self.hits = self.hits, {}
+        self.flushed_at = time.monotonic()
+        if hits:
+            self.connection.executemany(
+                "UPDATE rewrites SET last_used = MAX(last_used, ?) WHERE key = ?",
+                [(last_used, key) for key, last_used in hits.items()],
+            )
+
+    def close(self):
+        if self.connection is not None:
+            with self.lock:
+                try:
+                    self._flush_hits()
+                except sqlite3.Error:
+                    logging.exception("Query rewrite cache update failed")
+                self.connection.close()
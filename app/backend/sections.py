@@ -0,0 +1,97 @@
+import re
+from typing import Any, Optional
+from text import fold_accents
+
+# Section ids are "<file name>-<section number>" (see create_sections in scripts/prepdocs.py), sections with
+# consecutive numbers are consecutive in the document and overlap by up to SECTION_OVERLAP characters plus the
+# distance to the nearest sentence ending
+SECTION_ID_PATTERN = re.compile(r"^(.*)-(\d+)$")
+
+# data-ingestion-v2.py prefixes every section with the identifiers of its policy, e.g. "/Npoliza: .../ /DNI: .../ "
+SECTION_HEADER_PATTERN = re.compile(r"^(?:/[^/\n]{1,40}: [^/\n]*/ )+")
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def split_header(text: str) -> tuple[str, str]:
+    m = SECTION_HEADER_PATTERN.match(text)
+    return (m.group(0), text[m.end() :]) if m else ("", text)
+
+
+def remove_overlap(previous: str, text: str, min_overlap: int = 20, max_overlap: int = 1000) -> str:
+    # Drops the longest start of text that previous ends with
+    anchor = text[:min_overlap]
+    if len(anchor) < min_overlap:
+        return text
+    start = previous.find(anchor, max(0, len(previous) - max_overlap))
+    while start != -1:
+        if text.startswith(previous[start:]):
+            return text[len(previous) - start :]
+        start = previous.find(anchor, start + 1)
+    return text
+
+
+def shingles(text: str, size: int = 3) -> set[tuple[str, ...]]:
+    words = WORD_PATTERN.findall(fold_accents(text.lower()))
+    return {tuple(words[i : i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def merge_sections(
+    docs: list[dict[str, Any]],
+    content_field: str,
+    sourcepage_field: str,
+    sourcefile_field: str = "sourcefile",
+    id_field: str = "id",
+    duplicate_threshold: float = 0.8,
+) -> list[dict[str, Any]]:
+    """
+    Post-processes search results (in rank order) before they go into a prompt:
+    - consecutive sections of the same page are joined into one, without the text they have in common,
+    - a section that continues the previous section of the same file on another page keeps its own citation but loses
+      the text it repeats,
+    - passages that mostly repeat a better ranked one (e.g. the same policy conditions on several pages) are dropped.
+    Each resulting section takes the rank of its best ranked part. Returns new dicts, the input is not modified.
+    """
+    parsed = []
+    for rank, doc in enumerate(docs):
+        m = SECTION_ID_PATTERN.match(doc.get(id_field) or "")
+        position = (doc.get(sourcefile_field), m.group(1), int(m.group(2))) if m else None
+        parsed.append((position, rank, doc))
+
+    # Walk the sections of each file in document order to find the runs of consecutive ones
+    merged: list[tuple[int, dict[str, Any]]] = []
+    in_document_order = sorted(
+        (p for p in parsed if p[0] is not None), key=lambda p: (p[0][0] or "", p[0][1], p[0][2])
+    )
+    previous: Optional[tuple[tuple, int, dict[str, Any]]] = None
+    for position, rank, doc in in_document_order:
+        text = doc[content_field]
+        if previous and previous[0][:2] == position[:2] and previous[0][2] + 1 == position[2]:
+            last_rank, last = merged[-1]
+            header, body = split_header(text)
+            previous_header, previous_body = split_header(previous[2][content_field])
+            body = remove_overlap(previous_body, body)
+            if header != previous_header:
+                body = header + body
+            if doc[sourcepage_field] == last[sourcepage_field]:
+                last[content_field] += body
+                merged[-1] = (min(last_rank, rank), last)
+                previous = (position, rank, doc)
+                continue
+            text = body
+        merged.append((rank, {**doc, content_field: text}))
+        previous = (position, rank, doc)
+    merged.extend((rank, dict(doc)) for position, rank, doc in parsed if position is None)
+    merged.sort(key=lambda m: m[0])
+
+    results = []
+    kept_shingles = []
+    for _, doc in merged:
+        doc_shingles = shingles(split_header(doc[content_field])[1])
+        if any(
+            len(doc_shingles & s) >= duplicate_threshold * min(len(doc_shingles), len(s)) for s in kept_shingles
+        ):
+            continue
+        kept_shingles.append(doc_shingles)
+        results.append(doc)
+    return results
@@ -0,0 +1,40 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+from metrics import COALESCED_CALLS
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls that are in flight at the same time: while the call for a key runs, callers with the same
+    key wait for its result (or exception) instead of making their own. Nothing is kept once it finishes, so this is
+    not a cache, but it must only be used for deterministic calls whose result any of the callers could have gotten.
+    kind labels the calls on /metrics (coalesced_calls_total).
+    Calls are only coalesced with others running on the same event loop, so an instance can be shared by workers that
+    run a loop per thread.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.calls: dict[tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Future] = {}
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> tuple[T, bool]:
+        """Returns the result of call() and whether it came from a call another caller had already started."""
+        key = (asyncio.get_running_loop(), key)
+        future = self.calls.get(key)
+        coalesced = future is not None
+        COALESCED_CALLS.labels(self.kind, "coalesced" if coalesced else "sent").inc()
+        if not coalesced:
+            future = asyncio.ensure_future(call())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        # A caller being cancelled (e.g. its client went away) must not cancel the call for the others waiting on it
+        return await asyncio.shield(future), coalesced
+
+    def _done(self, key: tuple[asyncio.AbstractEventLoop, Hashable], future: asyncio.Future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved, in case every caller was cancelled before it was raised
+            future.exception()
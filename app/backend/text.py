@@ -1,2 +1,9 @@
+import unicodedata
+
+
 def nonewlines(s: str) -> str:
     return s.replace('\n', ' ').replace('\r', ' ')
+
+
+def fold_accents(s: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn")
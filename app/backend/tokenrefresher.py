@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+from azure.core.credentials import AccessToken
+from azure.core.credentials_async import AsyncTokenCredential
+from metrics import TOKEN_EXPIRES, TOKEN_REFRESH_FAILURES, TOKEN_REFRESH_SECONDS
+
+
+class TokenRefresher:
+    """
+    Keeps an Azure AD token for a scope valid from a background task, so requests only ever read the current token and
+    never wait on AAD. The token is renewed refresh_before seconds ahead of its expiry; failed attempts are retried
+    with exponential backoff (capped at max_retry_interval) while the current token is still good. Every new token is
+    passed to on_refresh, e.g. to set openai.api_key.
+    Each worker process keeps its own token: tokens are not written to disk, and reading them only involves a plain
+    attribute read, which is safe from executor threads too.
+    """
+
+    def __init__(
+        self,
+        credential: AsyncTokenCredential,
+        scope: str,
+        on_refresh: Optional[Callable[[AccessToken], None]] = None,
+        refresh_before: float = 600,
+        retry_interval: float = 5,
+        max_retry_interval: float = 60,
+    ):
+        self.credential = credential
+        self.scope = scope
+        self.on_refresh = on_refresh
+        self.refresh_before = refresh_before
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.token: Optional[AccessToken] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # The first token is fetched before serving, the app can't answer anything without it
+        await self.refresh()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def refresh(self):
+        start = time.perf_counter()
+        try:
+            token = await self.credential.get_token(self.scope)
+        except Exception:
+            TOKEN_REFRESH_FAILURES.labels(scope=self.scope).inc()
+            raise
+        finally:
+            TOKEN_REFRESH_SECONDS.labels(scope=self.scope).observe(time.perf_counter() - start)
+        self.token = token
+        TOKEN_EXPIRES.labels(scope=self.scope).set(token.expires_on)
+        if self.on_refresh:
+            self.on_refresh(token)
+
+    async def run(self):
+        retry_interval = self.retry_interval
+        while True:
+            await asyncio.sleep(max(self.token.expires_on - self.refresh_before - time.time(), 0))
+            try:
+                await self.refresh()
+                retry_interval = self.retry_interval
+            except Exception:
+                logging.exception(
+                    "Refreshing the token for %s failed, the current one expires in %d seconds",
+                    self.scope,
+                    self.token.expires_on - time.time(),
+                )
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, self.max_retry_interval)
@@ -0,0 +1,39 @@
+import os
+from typing import Optional
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+# Spans for requests, approach stages, LangChain runs and Azure SDK calls. Until configure_tracing is called the
+# tracer is OpenTelemetry's no-op one, so instrumented code costs next to nothing when tracing is off.
+tracer = trace.get_tracer("app.backend")
+
+
+def configure_tracing(exporter: str, file_path: Optional[str] = None, service_name: str = "backend"):
+    """
+    exporter is "file", to append spans as JSON lines to file_path ("{pid}" is replaced by the worker's process id, so
+    each worker writes its own file), or "otlp", to send them to an OpenTelemetry collector configured through the
+    standard OTEL_EXPORTER_OTLP_* environment variables.
+    """
+    if exporter == "file":
+        out = open((file_path or "traces-{pid}.jsonl").format(pid=os.getpid()), "a", encoding="utf-8")
+        span_exporter = ConsoleSpanExporter(
+            out=out, formatter=lambda span: span.to_json(indent=None) + "\n"
+        )
+    elif exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        span_exporter = OTLPSpanExporter()
+    else:
+        raise ValueError(f"Unknown tracing exporter: {exporter}")
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    trace.set_tracer_provider(provider)
+
+    # Cognitive Search and Blob Storage calls become child spans of the current one
+    from azure.core.settings import settings
+
+    settings.tracing_implementation = "opentelemetry"
+    return provider
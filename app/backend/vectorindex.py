@@ -0,0 +1,349 @@
+import collections
+import functools
+import importlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from typing import Any, Callable, Iterator, Optional, Sequence
+import numpy as np
+from bm25index import analyze
+
+# Dense-vector index of the sections sent to Cognitive Search, written by the ingestion scripts (--vectorindex) and
+# searched by the backend (see VectorSearchClient in localsearch.py). One memory-mapped file shared by all the workers
+# on the machine:
+#
+#   magic, header length, JSON header (embedding spec, dimensions, dtype, counts and where each array starts)
+#   vectors          count x dimensions, float32 or int8 (each row scaled to [-127, 127], scales kept apart)
+#   scales           float32 per row, int8 only
+#   centroids        lists x dimensions float32, when the rows are partitioned in inverted lists (IVF)
+#   list_offsets     int64 per list + 1: the rows of list i are list_offsets[i]:list_offsets[i + 1]
+#   section_offsets  int64 per row + 1, into the sections
+#   sections         the section of each row as JSON
+MAGIC = b"VECIDX01"
+PREFIX = struct.Struct("<8sQ")
+ALIGNMENT = 64
+SCORE_BLOCK_ROWS = 65536
+
+
+class HashingEmbedder:
+    """
+    Embeds text without a model or a service: the terms of the Spanish analyzer (see bm25index.analyze) and their
+    character trigrams are hashed into a fixed number of dimensions, so sections sharing words or word stems end up
+    close. It only captures lexical similarity; a model capturing meaning can be plugged in as a python: embedding.
+    """
+
+    blocking = False
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+        self.spec = f"hashing:{dimensions}"
+        self.features = functools.lru_cache(maxsize=100_000)(self._features)
+
+    def _features(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        # Dimensions and signed weights of a term and its trigrams, signs keep unrelated features from adding up
+        features = [term]
+        padded = f"<{term}>"
+        features.extend(padded[i : i + 3] for i in range(len(padded) - 2))
+        hashes = np.array([zlib.crc32(f.encode("utf-8")) for f in features], dtype=np.uint32)
+        weights = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+        weights[1:] *= 0.5
+        return (hashes % self.dimensions).astype(np.intp), weights
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term, count in collections.Counter(analyze(text)).items():
+                dimensions, weights = self.features(term)
+                np.add.at(vectors[row], dimensions, weights * (1 + np.log(count)))
+        return normalize(vectors)
+
+
+class FunctionEmbedder:
+    """Embeds text with function(texts) -> one vector per text, e.g. a local sentence embedding model."""
+
+    blocking = True
+
+    def __init__(self, spec: str, function: Callable[[list[str]], Any]):
+        self.spec = spec
+        self.function = function
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return normalize(np.asarray(self.function(list(texts)), dtype=np.float32))
+
+
+def get_embedder(spec: str):
+    """
+    The embedding function named by spec: "hashing" or "hashing:<dimensions>" for HashingEmbedder, or
+    "python:<module>:<function>" for a function importable by both the ingestion scripts and the backend. The spec is
+    stored in the index, so queries are always embedded the same way as its sections.
+    """
+    kind, _, rest = spec.partition(":")
+    if kind == "hashing":
+        return HashingEmbedder(int(rest) if rest else 512)
+    if kind == "python":
+        module, _, function = rest.partition(":")
+        return FunctionEmbedder(spec, getattr(importlib.import_module(module), function))
+    raise ValueError(f"Unknown embedding {spec}, use hashing[:<dimensions>] or python:<module>:<function>")
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def closest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # In blocks, the whole vectors x centroids matrix can take gigabytes
+    return np.concatenate(
+        [np.argmax(vectors[i : i + SCORE_BLOCK_ROWS] @ centroids.T, axis=1) for i in range(0, len(vectors), SCORE_BLOCK_ROWS)]
+    )
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = 15, sample: int = 64, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Spherical k-means: centroids of unit length and each vector assigned to the closest one by cosine. Centroids are
+    trained on up to sample vectors per list, which places them about as well as all of them would.
+    """
+    rng = np.random.default_rng(seed)
+    training = vectors[rng.choice(len(vectors), k * sample, replace=False)] if len(vectors) > k * sample else vectors
+    centroids = training[rng.choice(len(training), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = closest(training, centroids)
+        order = np.argsort(assignment, kind="stable")
+        starts = np.searchsorted(assignment[order], np.arange(k))
+        empty = np.bincount(assignment, minlength=k) == 0
+        sums = np.empty_like(centroids)
+        sums[~empty] = np.add.reduceat(training[order], starts[~empty], axis=0)
+        # An empty list starts again from a random vector
+        sums[empty] = training[rng.integers(len(training), size=int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids, closest(vectors, centroids)
+
+
+class VectorIndexWriter:
+    """
+    Collects sections (the documents uploaded to Cognitive Search) with their vectors and writes them as a VectorIndex
+    file. Vectors are stored as int8 when dtype is "int8", a quarter of the size for a slight loss of precision, and
+    rows are partitioned in that many lists when lists is over 1.
+    """
+
+    def __init__(self, embedder, dtype: str = "float32", lists: int = 0, content_field: str = "content"):
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"Unsupported dtype {dtype}, use float32 or int8")
+        self.embedder = embedder
+        self.embedding = embedder.spec
+        self.dtype = dtype
+        self.lists = lists
+        self.content_field = content_field
+        self.sections: list[bytes] = []
+        self.vectors: list[np.ndarray] = []
+
+    def add(self, section: dict[str, Any], vector: np.ndarray):
+        self.sections.append(json.dumps(section, ensure_ascii=False).encode("utf-8"))
+        self.vectors.append(np.asarray(vector, dtype=np.float32))
+
+    def add_sections(self, sections: Sequence[dict[str, Any]], batch_size: int = 64):
+        # Embedded in batches, which embedding models handle much faster than one text at a time
+        for start in range(0, len(sections), batch_size):
+            batch = sections[start : start + batch_size]
+            for section, vector in zip(batch, self.embedder.embed([s.get(self.content_field) or "" for s in batch])):
+                self.add(section, vector)
+
+    def write(self, path: str):
+        # Written next to the destination and renamed, so backends reloading it never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                self._write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _write(self, f):
+        vectors = normalize(np.vstack(self.vectors)) if self.vectors else np.zeros((0, 0), dtype=np.float32)
+        sections = self.sections
+        arrays: dict[str, np.ndarray] = {}
+
+        lists = min(self.lists, len(vectors))
+        if lists > 1:
+            # Rows of the same list are stored together, so probing a list reads one contiguous block
+            centroids, assignment = kmeans(vectors, lists)
+            order = np.argsort(assignment, kind="stable")
+            vectors = vectors[order]
+            sections = [sections[i] for i in order]
+            arrays["centroids"] = centroids.astype(np.float32)
+            arrays["list_offsets"] = np.searchsorted(assignment[order], np.arange(lists + 1)).astype(np.int64)
+
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127 if len(vectors) else np.zeros(0, dtype=np.float32)
+            scales = np.where(scales > 0, scales, 1).astype(np.float32)
+            arrays["vectors"] = np.round(vectors / scales[:, None]).astype(np.int8)
+            arrays["scales"] = scales
+        else:
+            arrays["vectors"] = vectors.astype(np.float32)
+        arrays["section_offsets"] = np.concatenate([[0], np.cumsum([len(s) for s in sections])]).astype(np.int64)
+
+        # Array offsets depend on the header length, which depends on the offsets: reserve room for them first
+        layout = {name: [0, str(a.dtype), list(a.shape)] for name, a in arrays.items()}
+        header = {
+            "embedding": self.embedding,
+            "dimensions": int(vectors.shape[1]) if len(vectors) else 0,
+            "dtype": self.dtype,
+            "count": len(vectors),
+            "lists": lists if lists > 1 else 0,
+            "arrays": layout,
+            "sections": 0,
+        }
+        header_size = len(json.dumps(header)) + 32 * (len(layout) + 1)
+        position = aligned(PREFIX.size + header_size)
+        for name, a in arrays.items():
+            layout[name][0] = position
+            position = aligned(position + a.nbytes)
+        header["sections"] = position
+        encoded = json.dumps(header).encode("utf-8").ljust(header_size)
+
+        f.write(PREFIX.pack(MAGIC, header_size))
+        f.write(encoded)
+        for name, a in arrays.items():
+            f.write(b"\0" * (layout[name][0] - f.tell()))
+            f.write(a.tobytes())
+        f.write(b"\0" * (header["sections"] - f.tell()))
+        for section in sections:
+            f.write(section)
+
+
+def aligned(position: int) -> int:
+    return position + (-position % ALIGNMENT)
+
+
+class VectorIndex:
+    """
+    Read-only view of a file written by VectorIndexWriter. Queries are scored against the memory-mapped rows in blocks
+    with NumPy, only against the nprobe closest lists when the rows are partitioned, and only the sections returned
+    are read.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_size = PREFIX.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a vector index")
+        header = json.loads(self.data[PREFIX.size : PREFIX.size + header_size])
+        self.embedding: str = header["embedding"]
+        self.dimensions: int = header["dimensions"]
+        self.dtype: str = header["dtype"]
+        self.count: int = header["count"]
+        self.lists: int = header["lists"]
+        self.sections_offset: int = header["sections"]
+        self.arrays = {
+            name: np.frombuffer(self.data, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+            for name, (offset, dtype, shape) in header["arrays"].items()
+        }
+        self.vectors = self.arrays["vectors"]
+        self.scales = self.arrays.get("scales")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def section(self, row: int) -> dict[str, Any]:
+        offsets = self.arrays["section_offsets"]
+        start = self.sections_offset + int(offsets[row])
+        return json.loads(self.data[start : self.sections_offset + int(offsets[row + 1])].decode("utf-8"))
+
+    def vector(self, row: int) -> np.ndarray:
+        vector = self.vectors[row].astype(np.float32)
+        return vector * self.scales[row] if self.scales is not None else vector
+
+    def documents(self) -> Iterator[dict[str, Any]]:
+        for row in range(self.count):
+            yield self.section(row)
+
+    def rows(self) -> Iterator[tuple[dict[str, Any], np.ndarray]]:
+        """Every section with its vector, as float32."""
+        for row in range(self.count):
+            yield self.section(row), self.vector(row)
+
+    def _ranges(self, queries: np.ndarray, nprobe: Optional[int]) -> list[tuple[int, int]]:
+        if not self.lists or not nprobe or nprobe >= self.lists:
+            return [(0, self.count)]
+        # Lists closest to any of the queries
+        closest = np.argsort(-(queries @ self.arrays["centroids"].T), axis=1)[:, :nprobe]
+        offsets = self.arrays["list_offsets"]
+        return [(int(offsets[i]), int(offsets[i + 1])) for i in sorted(set(closest.ravel().tolist()))]
+
+    def scores(self, queries: np.ndarray, nprobe: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """Cosine similarity of each query (rows of queries) with the rows probed: (row numbers, queries x rows)."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        rows, blocks = [], []
+        for start, end in self._ranges(queries, nprobe):
+            for block_start in range(start, end, SCORE_BLOCK_ROWS):
+                block_end = min(block_start + SCORE_BLOCK_ROWS, end)
+                block = self.vectors[block_start:block_end]
+                scores = queries @ block.T.astype(np.float32, copy=False)
+                if self.scales is not None:
+                    scores *= self.scales[block_start:block_end]
+                rows.append(np.arange(block_start, block_end))
+                blocks.append(scores)
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        return np.concatenate(rows), np.concatenate(blocks, axis=1)
+
+    def search_batch(self, queries: np.ndarray, top: int, nprobe: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """The top row numbers and scores for each query, best first (padded with -1 rows when fewer rows are probed)."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.lists and nprobe and nprobe < self.lists:
+            # Each query probes its own lists, scoring the union of all of them would end up scanning everything
+            found = [top_rows(*self.scores(query[None], nprobe), top) for query in queries]
+        else:
+            rows, scores = self.scores(queries, nprobe)
+            found = [top_rows(rows, scores, top)]
+        width = max(len(rows[0]) for rows, _ in found)
+        pad = lambda a, value: np.pad(a, ((0, 0), (0, width - a.shape[1])), constant_values=value)
+        return np.vstack([pad(rows, -1) for rows, _ in found]), np.vstack([pad(scores, -np.inf) for _, scores in found])
+
+    def search(
+        self, query: np.ndarray, top: int, accept: Optional[Callable[[dict[str, Any]], bool]] = None, nprobe: Optional[int] = None
+    ) -> list[tuple[float, dict[str, Any]]]:
+        """The top closest sections to query, with their score, skipping those accept() rejects."""
+        rows, scores = self.scores(query, nprobe)
+        scores = scores[0]
+        # With a filter more rows are ranked, in case the best ones are rejected, and all of them when that's not enough
+        candidates = min(len(rows), top * 8 if accept else top)
+        while True:
+            if candidates < len(rows):
+                order = np.argpartition(-scores, candidates - 1)[:candidates]
+                order = order[np.argsort(-scores[order], kind="stable")]
+            else:
+                order = np.argsort(-scores, kind="stable")
+            results = []
+            for i in order:
+                section = self.section(int(rows[i]))
+                if accept is None or accept(section):
+                    results.append((float(scores[i]), section))
+                    if len(results) >= top:
+                        return results
+            if candidates >= len(rows):
+                return results
+            candidates = len(rows)
+
+
+def top_rows(rows: np.ndarray, scores: np.ndarray, top: int) -> tuple[np.ndarray, np.ndarray]:
+    # Best top of each row of scores with argpartition, only those are sorted
+    top = min(top, len(rows))
+    if top == 0:
+        return np.zeros((len(scores), 0), dtype=np.int64), np.zeros((len(scores), 0), dtype=np.float32)
+    best = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1)
+    return rows[np.take_along_axis(best, order, axis=1)], np.take_along_axis(best_scores, order, axis=1)
+
+
+def write_index(path: str, sections: Sequence[dict[str, Any]], embedder, dtype: str = "float32", lists: int = 0, content_field: str = "content"):
+    writer = VectorIndexWriter(embedder, dtype, lists, content_field)
+    writer.add_sections(sections)
+    writer.write(path)
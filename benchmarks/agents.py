@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(BENCHMARKS_DIR, "..", "app", "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+import openai
+from openai.openai_object import OpenAIObject
+from fakeservices import FakeServices, parse_args as parse_fake_args
+from retrievalcache import CachedSearchResults
+from approaches.readretrieveread import ReadRetrieveReadApproach
+from approaches.readdecomposeask import ReadDecomposeAsk
+
+parser = argparse.ArgumentParser(
+    description="Measure the CPU time and peak memory allocated per request by the LangChain approaches (rrr, rda) in process, with OpenAI and "
+    "Cognitive Search replaced by instant in-memory stand-ins, so only the approach's own work (building and running the agent) is measured.",
+    epilog="Example: agents.py --requests 200 --employees 1000",
+)
+parser.add_argument("--approaches", default="rrr,rda", help="Comma separated approaches to measure")
+parser.add_argument("--requests", type=int, default=200, help="Measured requests per approach")
+parser.add_argument("--warmup", type=int, default=20, help="Requests run before measuring")
+parser.add_argument("--employees", type=int, default=100, help="Rows in the data/employeeinfo.csv read by the rrr approach")
+parser.add_argument("--question", default="¿Cuál es la cobertura incluida en mi póliza?", help="Question sent in every request")
+args = parser.parse_args()
+
+fakes = FakeServices(parse_fake_args(["--openai-tokens", "40", "--blob-kb", "0"]))
+
+
+async def fake_completion(engine=None, prompt=None, **kwargs):
+    text = fakes.completion_text(prompt if isinstance(prompt, str) else "".join(prompt))
+    return OpenAIObject.construct_from({
+        "choices": [{"text": text, "index": 0, "finish_reason": "stop", "logprobs": None}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 40, "total_tokens": 140},
+    })
+
+
+class FakeSearchClient:
+    def __init__(self):
+        self.documents = [
+            {"id": f"doc-{i}", "content": fakes.text(120), "sourcepage": f"poliza-{i}.pdf", "sourcefile": "poliza.pdf", "@search.captions": []}
+            for i in range(3)
+        ]
+
+    async def search(self, search_text, **kwargs):
+        return CachedSearchResults(self.documents, [], len(self.documents))
+
+
+async def measure(approach):
+    overrides = {}
+    # The agents log every step to stdout (verbose=True)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(args.warmup):
+            await approach.run(args.question, overrides)
+
+        gc.collect()
+        start = time.process_time()
+        for _ in range(args.requests):
+            await approach.run(args.question, overrides)
+        cpu = time.process_time() - start
+
+        # Separate pass, tracemalloc slows everything down
+        tracemalloc.start()
+        peaks = []
+        for _ in range(args.requests):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            await approach.run(args.question, overrides)
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+
+    return {
+        "requests": args.requests,
+        "cpu_ms_per_request": round(cpu / args.requests * 1000, 3),
+        "peak_kb_per_request": round(sum(peaks) / len(peaks) / 1024, 1),
+    }
+
+
+async def main():
+    openai.api_type = "azure"
+    openai.api_key = "benchmark"
+    openai.Completion.acreate = fake_completion
+
+    # The rrr approach reads data/employeeinfo.csv relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="agents-benchmark-")
+    os.makedirs(os.path.join(workdir, "data"))
+    with open(os.path.join(workdir, "data", "employeeinfo.csv"), "w", newline="") as f:
+        f.write("name,title,insurance,insurancegroup\n")
+        for i in range(args.employees):
+            f.write(f"Employee{i + 1},Program Manager,Standard,{'AB'[i % 2]}\n")
+    os.chdir(workdir)
+
+    search_client = FakeSearchClient()
+    approaches = {
+        "rrr": lambda: ReadRetrieveReadApproach(search_client, "davinci", "sourcepage", "content"),
+        "rda": lambda: ReadDecomposeAsk(search_client, "davinci", "sourcepage", "content"),
+    }
+    results = {}
+    for name in args.approaches.split(","):
+        results[name] = await measure(approaches[name]())
+    print(json.dumps(results, indent=2))
+
+
+asyncio.run(main())
@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import json
+import re
+import time
+import aiohttp
+
+parser = argparse.ArgumentParser(
+    description="Drive /ask or /chat of a running backend in consecutive intervals and report, from the backend's /metrics, how many new outbound connections (TLS handshakes) each request caused. "
+    "With the shared connection pool the first interval pays for warming up the pool and the following ones should be close to 0. "
+    "Start the backend with SEARCH_CACHE_TTL_SECONDS=0 and QUERY_REWRITE_CACHE_MAX_ENTRIES=0 so every request reaches Cognitive Search and OpenAI.",
+    epilog="Example: connections.py --url http://127.0.0.1:5000 --endpoint chat --concurrency 16 --intervals 5 --interval-duration 20",
+)
+parser.add_argument("--url", default="http://127.0.0.1:5000", help="Base URL of the backend")
+parser.add_argument("--endpoint", choices=["ask", "chat"], default="chat", help="Endpoint to drive")
+parser.add_argument("--approach", default="rrr", help="Approach to request (rtr, rrr, rda for ask; rrr for chat)")
+parser.add_argument("--question", default="¿Cuál es la cobertura incluida en mi póliza?", help="Question sent in every request")
+parser.add_argument("--concurrency", type=int, default=16, help="Number of requests kept in flight")
+parser.add_argument("--intervals", type=int, default=5, help="Number of measurement intervals")
+parser.add_argument("--interval-duration", type=float, default=20, help="Seconds per interval")
+args = parser.parse_args()
+
+METRIC_PATTERN = re.compile(r'^http_client_connections_total\{event="(\w+)"\} ([0-9.e+]+)$', re.MULTILINE)
+
+
+def request_body():
+    if args.endpoint == "ask":
+        return {"approach": args.approach, "question": args.question, "overrides": {}}
+    return {"approach": args.approach, "history": [{"user": args.question}], "overrides": {}}
+
+
+async def connection_counts(session):
+    async with session.get(f"{args.url}/metrics") as response:
+        text = await response.text()
+    counts = {"created": 0.0, "reused": 0.0}
+    for event, value in METRIC_PATTERN.findall(text):
+        counts[event] = float(value)
+    return counts
+
+
+async def worker(session, deadline, completed):
+    body = request_body()
+    while time.monotonic() < deadline:
+        try:
+            async with session.post(f"{args.url}/{args.endpoint}", json=body) as response:
+                await response.read()
+                if response.status == 200:
+                    completed.append(1)
+        except aiohttp.ClientError:
+            pass
+
+
+async def main():
+    results = []
+    connector = aiohttp.TCPConnector(limit=args.concurrency + 1)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+        for interval in range(args.intervals):
+            before = await connection_counts(session)
+            completed = []
+            deadline = time.monotonic() + args.interval_duration
+            await asyncio.gather(*[worker(session, deadline, completed) for _ in range(args.concurrency)])
+            after = await connection_counts(session)
+
+            created = after["created"] - before["created"]
+            reused = after["reused"] - before["reused"]
+            results.append({
+                "interval": interval + 1,
+                "requests": len(completed),
+                "new_connections": int(created),
+                "reused_connections": int(reused),
+                "handshakes_per_request": round(created / len(completed), 3) if completed else None,
+                "reuse_ratio": round(reused / (created + reused), 3) if created + reused else None,
+            })
+            print(json.dumps(results[-1]))
+
+    print(json.dumps({"endpoint": args.endpoint, "approach": args.approach, "concurrency": args.concurrency, "intervals": results}, indent=2))
+
+
+asyncio.run(main())
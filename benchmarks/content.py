@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import tempfile
+from email.utils import formatdate
+
+from aiohttp import web
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(BENCHMARKS_DIR, "..", "app", "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+from fakeservices import FakeServices, parse_args as parse_fake_args
+
+parser = argparse.ArgumentParser(
+    description="Checks the conditional and range requests of /content against the Blob Storage stand-in of fakeservices.py: "
+    "If-None-Match and If-Modified-Since answered with 304, If-Range with a current or stale ETag, single, suffix and multiple ranges, "
+    "and the headers of full and partial responses, for files streamed from Blob Storage and files in the disk cache. The backend runs in process through the Quart test client. Exits with an error when a response differs "
+    "from the expected one.",
+    epilog="Example: content.py --blob-kb 512",
+)
+parser.add_argument("--blob-kb", type=int, default=64, help="Size of the blob served by the stand-in")
+parser.add_argument("--port", type=int, default=9181, help="Port of the stand-ins")
+args = parser.parse_args()
+
+
+def backend_environment(fake_url: str, cache_dir: str) -> dict:
+    return {
+        "AZURE_OPENAI_ENDPOINT": fake_url,
+        "AZURE_OPENAI_KEY": "content",
+        "AZURE_SEARCH_ENDPOINT": fake_url,
+        "AZURE_SEARCH_KEY": "content",
+        "AZURE_SEARCH_INDEX": "gptkbindex",
+        "AZURE_OPENAI_GPT_DEPLOYMENT": "davinci",
+        "AZURE_OPENAI_CHATGPT_DEPLOYMENT": "chat",
+        "AZURE_STORAGE_ACCOUNT": "content",
+        "AZURE_STORAGE_ENDPOINT": f"{fake_url}/content",
+        "AZURE_STORAGE_KEY": base64.b64encode(b"content").decode(),
+        "AZURE_STORAGE_CONTAINER": "content",
+        "CUSTOMER_SCOPED_SEARCH": "false",
+        "IDENTIFIER_FAST_PATH": "false",
+        "CONTENT_DISK_CACHE_DIR": cache_dir,
+    }
+
+
+class Checks:
+    def __init__(self, client, fake: FakeServices):
+        self.client = client
+        self.fake = fake
+        self.blob = fake.blob_data
+        self.results = []
+
+    async def check(self, case: str, path: str, headers: dict, status: int, body: bytes, expected_headers: dict):
+        response = await self.client.get(f"/content/{path}", headers=headers)
+        data = await response.get_data()
+        problems = []
+        if response.status_code != status:
+            problems.append(f"status {response.status_code}, expected {status}")
+        if data != body:
+            problems.append(f"{len(data)} bytes, expected {len(body)}")
+        for name, value in expected_headers.items():
+            if response.headers.get(name) != value:
+                problems.append(f"{name}: {response.headers.get(name)!r}, expected {value!r}")
+        self.results.append({"case": case, "status": response.status_code, "problems": problems})
+
+    async def uncached(self, etag: str):
+        size = len(self.blob)
+        full = {"Content-Length": str(size), "Accept-Ranges": "bytes", "ETag": etag}
+        await self.check("full", "full.pdf", {}, 200, self.blob, full)
+        await self.check("if-none-match current", "inm.pdf", {"If-None-Match": etag}, 304, b"", {"ETag": etag})
+        await self.check("if-none-match stale", "inm-stale.pdf", {"If-None-Match": '"0xSTALE"'}, 200, self.blob, full)
+        await self.check(
+            "if-modified-since later", "ims.pdf", {"If-Modified-Since": formatdate(usegmt=True)}, 304, b"", {}
+        )
+        await self.check(
+            "range",
+            "range.pdf",
+            {"Range": "bytes=10-19"},
+            206,
+            self.blob[10:20],
+            {"Content-Length": "10", "Content-Range": f"bytes 10-19/{size}"},
+        )
+        await self.check(
+            "range if-range current",
+            "if-range.pdf",
+            {"Range": "bytes=0-9", "If-Range": etag},
+            206,
+            self.blob[:10],
+            {"Content-Range": f"bytes 0-9/{size}"},
+        )
+        await self.check(
+            "range if-range stale", "if-range-stale.pdf", {"Range": "bytes=0-9", "If-Range": '"0xSTALE"'}, 200, self.blob, full
+        )
+        await self.check("range past the end", "range-416.pdf", {"Range": f"bytes={size}-"}, 416, b"", {})
+
+    async def cached(self, etag: str):
+        """The same requests for a file in the disk cache, which are answered without Blob Storage."""
+        size = len(self.blob)
+        full = {"Content-Length": str(size), "Accept-Ranges": "bytes", "ETag": etag}
+        path = "cached.pdf"
+        # The first download fills the cache
+        await self.check("cached fill", path, {}, 200, self.blob, full)
+        blob_requests = self.fake.blob_requests
+        await self.check("cached full", path, {}, 200, self.blob, full)
+        await self.check("cached if-none-match current", path, {"If-None-Match": etag}, 304, b"", {"ETag": etag})
+        await self.check("cached if-none-match stale", path, {"If-None-Match": '"0xSTALE"'}, 200, self.blob, full)
+        await self.check(
+            "cached if-modified-since later", path, {"If-Modified-Since": formatdate(usegmt=True)}, 304, b"", {}
+        )
+        await self.check(
+            "cached range",
+            path,
+            {"Range": "bytes=10-19"},
+            206,
+            self.blob[10:20],
+            {"Content-Length": "10", "Accept-Ranges": "bytes", "Content-Range": f"bytes 10-19/{size}"},
+        )
+        await self.check(
+            "cached open range",
+            path,
+            {"Range": f"bytes={size - 5}-"},
+            206,
+            self.blob[-5:],
+            {"Content-Length": "5", "Content-Range": f"bytes {size - 5}-{size - 1}/{size}"},
+        )
+        await self.check(
+            "cached range past the last byte",
+            path,
+            {"Range": f"bytes={size - 5}-{size + 100}"},
+            206,
+            self.blob[-5:],
+            {"Content-Length": "5", "Content-Range": f"bytes {size - 5}-{size - 1}/{size}"},
+        )
+        await self.check("cached suffix range", path, {"Range": "bytes=-10"}, 200, self.blob, full)
+        await self.check("cached multiple ranges", path, {"Range": "bytes=0-9,20-29"}, 200, self.blob, full)
+        await self.check(
+            "cached range if-range current",
+            path,
+            {"Range": "bytes=0-9", "If-Range": etag},
+            206,
+            self.blob[:10],
+            {"Content-Range": f"bytes 0-9/{size}"},
+        )
+        await self.check("cached range if-range stale", path, {"Range": "bytes=0-9", "If-Range": '"0xSTALE"'}, 200, self.blob, full)
+        await self.check("cached range past the end", path, {"Range": f"bytes={size}-"}, 416, b"", {})
+        if self.fake.blob_requests != blob_requests:
+            self.results.append({
+                "case": "cached requests stay local",
+                "status": None,
+                "problems": [f"{self.fake.blob_requests - blob_requests} requests reached Blob Storage"],
+            })
+
+
+async def main():
+    fake = FakeServices(parse_fake_args(["--blob-kb", str(args.blob_kb), "--blob-latency-ms", "0", "--latency-sigma", "0"]))
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+    cache_dir = tempfile.mkdtemp(prefix="content-")
+    os.environ.update(backend_environment(f"http://127.0.0.1:{args.port}", cache_dir))
+
+    import app as backend
+
+    try:
+        async with backend.app.test_app() as test_app:
+            checks = Checks(test_app.test_client(), fake)
+            await checks.uncached(fake.blob_etag)
+            await checks.cached(fake.blob_etag)
+    finally:
+        await runner.cleanup()
+    failures = [r for r in checks.results if r["problems"]]
+    print(json.dumps({"checks": len(checks.results), "results": checks.results}, indent=2))
+    if failures:
+        sys.exit("Content responses differ from the expected ones")
+
+
+asyncio.run(main())
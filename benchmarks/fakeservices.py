@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import formatdate
+from aiohttp import web
+
+# Local stand-ins for the Azure OpenAI completions API, the Cognitive Search query API and the Blob Storage download
+# API, close enough to the real ones for the SDKs the backend uses. Every response is delayed by a latency drawn from
+# a log-normal distribution around the configured median, so runs behave like the real services without using quota.
+
+WORDS = (
+    "póliza cobertura asegurado siniestro franquicia granizo robo incendio vehículo responsabilidad civil terceros "
+    "prima vigencia endoso cláusula condiciones generales particulares beneficiario suma asegurada daño total parcial "
+    "denuncia plazo días hábiles compañía aseguradora domicilio titular mascota veterinaria accidente"
+).split()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve fake Azure OpenAI, Cognitive Search and Blob Storage endpoints on one local port.",
+        epilog="Example: fakeservices.py --port 9100 --openai-latency-ms 800 --search-latency-ms 80",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--seed", type=int, default=0, help="Seed for generated content and latencies")
+    parser.add_argument("--latency-sigma", type=float, default=0.35, help="Sigma of the log-normal latency distributions (0 for fixed latencies)")
+    parser.add_argument("--openai-latency-ms", type=float, default=600, help="Median time until a completion starts")
+    parser.add_argument("--openai-token-ms", type=float, default=15, help="Time per generated token")
+    parser.add_argument("--openai-tokens", type=int, default=120, help="Tokens in generated answers")
+    parser.add_argument("--search-latency-ms", type=float, default=60, help="Median search latency")
+    parser.add_argument("--search-results", type=int, default=6, help="Maximum documents per search")
+    parser.add_argument("--section-chars", type=int, default=1000, help="Characters per returned section")
+    parser.add_argument("--blob-latency-ms", type=float, default=20, help="Median time to first byte of a blob")
+    parser.add_argument("--blob-kb", type=int, default=200, help="Size of every blob")
+    return parser.parse_args(argv)
+
+
+class FakeServices:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.blob_data = bytes(self.random.getrandbits(8) for _ in range(args.blob_kb * 1024))
+        self.blob_etag = '"0x' + hashlib.sha256(self.blob_data).hexdigest()[:16].upper() + '"'
+        self.blob_requests = 0
+        self.blob_modified_at = datetime.fromtimestamp(int(time.time()), timezone.utc)
+        self.blob_modified = formatdate(self.blob_modified_at.timestamp(), usegmt=True)
+
+    async def delay(self, median_ms: float):
+        if median_ms > 0:
+            await asyncio.sleep(median_ms / 1000 * self.random.lognormvariate(0, self.args.latency_sigma))
+
+    def text(self, words: int) -> str:
+        return " ".join(self.random.choice(WORDS) for _ in range(words))
+
+    # Azure OpenAI
+
+    def completion_text(self, prompt: str) -> str:
+        # The LangChain agents need replies in their own format to finish: search once, then answer
+        scratchpad = prompt[prompt.rfind("Question:") :]
+        if "Action Input:" in prompt:
+            if "Observation:" in scratchpad:
+                return " I now know the final answer\nFinal Answer: " + self.text(self.args.openai_tokens) + " [poliza-1.pdf]"
+            return " I should search for this\nAction: CognitiveSearch\nAction Input: " + self.text(4)
+        if "Action: Search[" in prompt:
+            if "Observation:" in scratchpad:
+                return " I have the answer.\nAction: Finish[" + self.text(self.args.openai_tokens) + " <poliza-1.pdf>]"
+            return " I need to search.\nAction: Search[" + self.text(4) + "]"
+        if prompt.rstrip().endswith("Search query:"):
+            return self.text(5)
+        return self.text(self.args.openai_tokens)
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        prompt = body.get("prompt") or ""
+        if isinstance(prompt, list):
+            prompt = "".join(prompt)
+        text = self.completion_text(prompt)
+        tokens = re.findall(r"\S+\s*|\s+", text)
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(tokens), "total_tokens": len(prompt) // 4 + len(tokens)}
+        await self.delay(self.args.openai_latency_ms)
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.args.openai_token_ms / 1000 * len(tokens))
+            return web.json_response({
+                "id": "cmpl-fake",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": request.match_info["deployment"],
+                "choices": [{"text": text, "index": 0, "finish_reason": "stop", "logprobs": None}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in tokens:
+            await asyncio.sleep(self.args.openai_token_ms / 1000)
+            chunk = {"id": "cmpl-fake", "object": "text_completion", "created": int(time.time()), "model": request.match_info["deployment"],
+                     "choices": [{"text": token, "index": 0, "finish_reason": None, "logprobs": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    # Cognitive Search
+
+    async def search(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        top = min(body.get("top") or 50, self.args.search_results)
+        await self.delay(self.args.search_latency_ms)
+        documents = []
+        for i in range(top):
+            page = self.random.randint(0, 20)
+            content = self.text(self.args.section_chars // 8)[: self.args.section_chars]
+            documents.append({
+                "@search.score": 10.0 - i,
+                "@search.rerankerScore": 3.0 - i / 10,
+                "@search.captions": [{"text": content[:200], "highlights": None}],
+                "id": f"poliza_pdf-{page * 3 + i % 3}",
+                "content": content,
+                "category": None,
+                "sourcepage": f"poliza-{page}.pdf",
+                "sourcefile": "poliza.pdf",
+            })
+        result = {"value": documents}
+        if body.get("count"):
+            result["@odata.count"] = len(documents)
+        if body.get("answers"):
+            result["@search.answers"] = []
+        return web.json_response(result)
+
+    # Blob Storage
+
+    def blob_headers(self) -> dict:
+        return {
+            "ETag": self.blob_etag,
+            "Last-Modified": self.blob_modified,
+            "Content-Type": "application/pdf",
+            "Accept-Ranges": "bytes",
+            "x-ms-blob-type": "BlockBlob",
+            "x-ms-version": "2021-08-06",
+            "x-ms-creation-time": self.blob_modified,
+            "x-ms-lease-state": "available",
+            "x-ms-lease-status": "unlocked",
+            "x-ms-server-encrypted": "true",
+        }
+
+    async def blob(self, request: web.Request) -> web.Response:
+        self.blob_requests += 1
+        await self.delay(self.args.blob_latency_ms)
+        headers = self.blob_headers()
+        # Like Blob Storage, unmet conditions come with the ConditionNotMet error code, also on a 304
+        if request.headers.get("If-None-Match") == self.blob_etag or (
+            request.if_modified_since and request.if_modified_since >= self.blob_modified_at
+        ):
+            return web.Response(status=304, headers={**headers, "x-ms-error-code": "ConditionNotMet"})
+        if request.headers.get("If-Match") not in (None, self.blob_etag):
+            return web.Response(status=412, headers={"x-ms-error-code": "ConditionNotMet"})
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(self.blob_data))
+            return web.Response(headers=headers)
+
+        m = re.match(r"bytes=(\d+)-(\d*)", request.headers.get("x-ms-range") or request.headers.get("Range") or "")
+        if not m:
+            return web.Response(body=self.blob_data, headers=headers)
+        start = int(m.group(1))
+        end = min(int(m.group(2)) if m.group(2) else len(self.blob_data) - 1, len(self.blob_data) - 1)
+        if start >= len(self.blob_data):
+            return web.Response(status=416, headers={"Content-Range": f"bytes */{len(self.blob_data)}"})
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(self.blob_data)}"
+        return web.Response(status=206, body=self.blob_data[start : end + 1], headers=headers)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/openai/deployments/{deployment}/completions", self.completions)
+        app.router.add_post(r"/indexes{index:.*}/docs/search.post.search", self.search)
+        app.router.add_route("GET", "/{account}/{container}/{blob:.+}", self.blob)
+        app.router.add_route("HEAD", "/{account}/{container}/{blob:.+}", self.blob)
+        return app
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    web.run_app(FakeServices(args).app(), host=args.host, port=args.port, print=None)
@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+import psutil
+from loadtest import request_body, run_load
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(BENCHMARKS_DIR, "..", "app", "backend")
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the backend fully offline: start local stand-ins for Azure OpenAI, Cognitive Search and Blob Storage (see fakeservices.py), "
+    "start the backend under gunicorn against them and drive each scenario at a fixed concurrency. Reports throughput, latency percentiles and worker memory.",
+    epilog="Example: harness.py --workers 2 --concurrency 32 --duration 20 --openai-latency-ms 800 --scenarios ask:rtr,chat:rrr",
+)
+parser.add_argument("--scenarios", default="ask:rtr,ask:rrr,ask:rda,chat:rrr", help="Comma separated endpoint:approach pairs, or content for /content downloads")
+parser.add_argument("--workers", type=int, default=2, help="Backend worker processes")
+parser.add_argument("--concurrency", type=int, default=16, help="Requests kept in flight")
+parser.add_argument("--duration", type=float, default=20, help="Seconds per scenario")
+parser.add_argument("--warmup", type=float, default=3, help="Seconds of load before each scenario is measured")
+parser.add_argument("--stream", action="store_true", help="Request Server-Sent Events responses")
+parser.add_argument("--caches", action="store_true", help="Keep the search, query rewrite and content caches enabled (they are disabled so every request reaches the stand-ins)")
+parser.add_argument("--question", default="¿Cuál es la cobertura incluida en mi póliza?", help="Question sent in every request")
+parser.add_argument("--output", help="Also write the JSON report to this file")
+parser.add_argument("--verbose", "-v", action="store_true", help="Show the backend and stand-in logs")
+args, fake_args = parser.parse_known_args()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args} exited with code {process.returncode}")
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout} seconds")
+
+
+def backend_environment(fake_url: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "AZURE_OPENAI_ENDPOINT": fake_url,
+        "AZURE_OPENAI_KEY": "harness",
+        "AZURE_OPENAI_GPT_DEPLOYMENT": "davinci",
+        "AZURE_OPENAI_CHATGPT_DEPLOYMENT": "chat",
+        "AZURE_SEARCH_ENDPOINT": fake_url,
+        "AZURE_SEARCH_KEY": "harness",
+        "AZURE_SEARCH_INDEX": "gptkbindex",
+        "AZURE_STORAGE_ACCOUNT": "harness",
+        "AZURE_STORAGE_ENDPOINT": f"{fake_url}/harness",
+        "AZURE_STORAGE_KEY": base64.b64encode(b"harness").decode(),
+        "AZURE_STORAGE_CONTAINER": "content",
+    })
+    # The question has no DNI or CUIT, chat would answer without searching
+    env.setdefault("CUSTOMER_SCOPED_SEARCH", "false")
+    # The fake search service serves no index definition for "auto" to check
+    env.setdefault("IDENTIFIER_FAST_PATH", "true")
+    if not args.caches:
+        env.update({
+            "SEARCH_CACHE_TTL_SECONDS": "0",
+            "QUERY_REWRITE_CACHE_MAX_ENTRIES": "0",
+            "CONTENT_DISK_CACHE_MAX_BYTES": "0",
+        })
+    return env
+
+
+class MemorySampler:
+    """Samples the resident memory of the gunicorn workers while a scenario runs."""
+
+    def __init__(self, master_pid: int, interval: float = 0.5):
+        self.master = psutil.Process(master_pid)
+        self.interval = interval
+        self.peak_worker = 0
+        self.peak_total = 0
+
+    def sample(self) -> int:
+        total = 0
+        for worker in self.master.children():
+            try:
+                rss = worker.memory_info().rss
+            except psutil.NoSuchProcess:
+                continue
+            self.peak_worker = max(self.peak_worker, rss)
+            total += rss
+        self.peak_total = max(self.peak_total, total)
+        return total
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def report(self) -> dict:
+        mb = 1024 * 1024
+        return {
+            "workers": len(self.master.children()),
+            "worker_rss_peak_mb": round(self.peak_worker / mb, 1),
+            "workers_rss_peak_total_mb": round(self.peak_total / mb, 1),
+            "workers_rss_end_total_mb": round(self.sample() / mb, 1),
+        }
+
+
+async def run_scenario(backend_url: str, master_pid: int, scenario: str) -> dict:
+    if scenario == "content":
+        url, body = f"{backend_url}/content/poliza-1.pdf", None
+    else:
+        endpoint, approach = scenario.split(":")
+        url, body = f"{backend_url}/{endpoint}", request_body(endpoint, approach, args.question, args.stream)
+
+    if args.warmup > 0:
+        await run_load(url, body, args.concurrency, args.warmup)
+    sampler = MemorySampler(master_pid)
+    sampling = asyncio.create_task(sampler.run())
+    try:
+        result = await run_load(url, body, args.concurrency, args.duration)
+    finally:
+        sampling.cancel()
+    return {"scenario": scenario, **result, **sampler.report()}
+
+
+async def main():
+    output = None if args.verbose else subprocess.DEVNULL
+    fake_port = free_port()
+    backend_port = free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    backend_url = f"http://127.0.0.1:{backend_port}"
+
+    # The backend runs in a scratch directory holding the files the agents read (data/employeeinfo.csv)
+    workdir = tempfile.mkdtemp(prefix="harness-")
+    os.makedirs(os.path.join(workdir, "data"))
+    with open(os.path.join(workdir, "data", "employeeinfo.csv"), "w", newline="") as f:
+        f.write("name,title,insurance,insurancegroup\nEmployee1,Program Manager,Standard,A\n")
+
+    fakes = subprocess.Popen(
+        [sys.executable, os.path.join(BENCHMARKS_DIR, "fakeservices.py"), "--port", str(fake_port), *fake_args],
+        stdout=output, stderr=output,
+    )
+    backend = None
+    try:
+        await wait_until_up(f"{fake_url}/", fakes)
+        backend = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", os.path.join(BACKEND_DIR, "gunicorn.conf.py"),
+             "--pythonpath", BACKEND_DIR, "--bind", f"127.0.0.1:{backend_port}", "--workers", str(args.workers),
+             # Workers are not recycled during a run, so their memory can be compared across scenarios
+             "--max-requests", "0",
+             "app:app"],
+            cwd=workdir, env=backend_environment(fake_url), stdout=output, stderr=output,
+        )
+        await wait_until_up(f"{backend_url}/metrics", backend)
+
+        results = []
+        for scenario in args.scenarios.split(","):
+            result = await run_scenario(backend_url, backend.pid, scenario.strip())
+            if args.verbose:
+                print(json.dumps(result))
+            results.append(result)
+    finally:
+        for process in (backend, fakes):
+            if process:
+                process.terminate()
+                process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "workers": args.workers,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "stream": args.stream,
+        "caches": args.caches,
+        "stand_ins": fake_args,
+        "scenarios": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+asyncio.run(main())
@@ -0,0 +1,91 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "app", "backend"))
+
+from identifiers import customer_identifier, find_identifiers
+from querybuilder import split_identifiers
+
+parser = argparse.ArgumentParser(
+    description="Checks which policy numbers, CUITs and DNIs app/backend/identifiers.py finds in typical chat messages, amounts and phone "
+    "numbers included, which customer a conversation is scoped to and the lookup the identifier fast path makes of a message, then times "
+    "find_identifiers. Exits with an error when a message is read differently than expected.",
+    epilog="Example: identifiers.py --repeat 20000",
+)
+parser.add_argument("--repeat", type=int, default=10000, help="Times each message is parsed for the timing")
+args = parser.parse_args()
+
+# Message, the (kind, value) pairs find_identifiers should report
+MESSAGES = [
+    ("30123456", [("dni", "30123456")]),
+    ("30.123.456", [("dni", "30123456")]),
+    ("30.123.456.", [("dni", "30123456")]),
+    ("mi DNI es 30.123.456", [("dni", "30123456")]),
+    ("D.N.I. 30123456", [("dni", "30123456")]),
+    ("documento: 30123456", [("dni", "30123456")]),
+    ("mi dni es 30123456 y el auto vale $12.345.678", [("dni", "30123456")]),
+    ("mi auto vale $8.500.000, que me cubre por robo?", []),
+    ("mi auto vale $ 18.500.000", []),
+    ("el auto vale 12.345.678", []),
+    ("tengo 30123456 pesos", []),
+    ("la suma asegurada es ARS 25.000.000", []),
+    ("$30.123.456", []),
+    ("llamame al 11 4567 8901", []),
+    ("mi DNI es 7.123.456", []),
+    ("cuit 20-30123456-7", [("cuit", "20-30123456-7")]),
+    ("20301234567", [("cuit", "20-30123456-7")]),
+    ("poliza 123-45678901-01", [("npoliza", "123-45678901-01")]),
+    ("que cubre la poliza 123-45678901-01 de mi dni 30123456?", [("npoliza", "123-45678901-01"), ("dni", "30123456")]),
+]
+
+# Messages of a customer in order, the identifier the searches are scoped to
+CONVERSATIONS = [
+    (["mi auto vale $18.500.000, que me cubre?", "30123456"], ("dni", "30123456")),
+    (["mi DNI es 30123456", "mi auto vale $8.500.000, que me cubre por robo?"], ("dni", "30123456")),
+    (["hola", "el auto vale 12.345.678"], None),
+    (["dni 30123456", "perdon, dni 31123456", "31123456"], ("dni", "31123456")),
+]
+
+# Message, the identifiers the identifier fast path looks up
+LOOKUPS = [
+    ("mi auto vale $8.500.000, que me cubre por robo?", []),
+    ("que cubre mi dni 30123456", [("dni", "30123456")]),
+]
+
+
+def main():
+    failures = []
+    for message, expected in MESSAGES:
+        found = [(kind, value) for _, _, kind, value in find_identifiers(message)]
+        if found != expected:
+            failures.append({"message": message, "expected": expected, "found": found})
+    for messages, expected in CONVERSATIONS:
+        found = customer_identifier(messages)
+        if found != expected:
+            failures.append({"messages": messages, "expected": expected, "found": found})
+    for message, expected in LOOKUPS:
+        found, query = split_identifiers(message)
+        if found != expected:
+            failures.append({"lookup": message, "expected": expected, "found": found, "query": query})
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for message, _ in MESSAGES:
+            find_identifiers(message)
+    seconds = time.perf_counter() - start
+    print(json.dumps({
+        "messages": len(MESSAGES),
+        "conversations": len(CONVERSATIONS),
+        "lookups": len(LOOKUPS),
+        "find_identifiers_us": round(seconds / (args.repeat * len(MESSAGES)) * 1e6, 2),
+        "failures": failures,
+    }, indent=2, ensure_ascii=False))
+    if failures:
+        sys.exit("Identifiers were read differently than expected")
+
+
+main()
@@ -0,0 +1,241 @@
+import argparse
+import ast
+import contextlib
+import gc
+import glob
+import html
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from pypdf import PdfReader
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCHMARKS_DIR, "..", "scripts")
+DATA_DIR = os.path.join(BENCHMARKS_DIR, "..", "data")
+
+parser = argparse.ArgumentParser(
+    description="Time the text processing of scripts/prepdocs.py and scripts/data-ingestion-v2.py (get_document_text, table_to_html, split_text, create_sections "
+    "and the extract_dni/extract_cuit/extract_npoliza regexes) on Form Recognizer results synthesized from the sample PDFs, without calling Azure. "
+    "Reports chars/s and sections/s (pages/s, tables/s where sections don't apply) and compares them with a baseline saved by a previous run on the same machine.",
+    epilog="Example: ingestion.py --save-baseline before.json, then after a change: ingestion.py --baseline before.json",
+)
+parser.add_argument("--files", default=os.path.join(DATA_DIR, "*.pdf"), help="PDFs to build the synthetic Form Recognizer results from")
+parser.add_argument("--pdf-cache", default=os.path.join(tempfile.gettempdir(), "ingestion-benchmark-pages.json"), help="File keeping the text extracted from the PDFs between runs")
+parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark, the fastest one is reported")
+parser.add_argument("--table-every", type=int, default=2, help="Put a synthetic table on every n-th page")
+parser.add_argument("--table-lines", type=int, default=8, help="Lines of page text turned into each table")
+parser.add_argument("--only", help="Run only the benchmarks whose name contains this text")
+parser.add_argument("--save-baseline", help="Write the results to this file")
+parser.add_argument("--baseline", help="Compare with the results saved in this file")
+parser.add_argument("--tolerance", type=float, default=0.1, help="Exit with an error when a benchmark is this much slower than the baseline")
+args = parser.parse_args()
+
+
+class FakeDocumentAnalysisClient:
+    """Stands in for Form Recognizer: returns the synthetic result prepared for the file being analyzed."""
+
+    results = {}
+
+    def __init__(self, endpoint, credential, headers=None):
+        pass
+
+    def begin_analyze_document(self, model_id, document):
+        result = self.results[os.path.abspath(document.name)]
+        return SimpleNamespace(result=lambda: result)
+
+
+def synthesize_table(lines, offset, page_number):
+    # One row per line and one cell per run of words separated by 2+ spaces (or per word), first row as header
+    rows = [re.split(r"\s{2,}", line.strip()) if re.search(r"\s{2,}", line.strip()) else line.split() for line in lines]
+    column_count = max(1, min(6, max(len(row) for row in rows)))
+    cells = []
+    for row_index, row in enumerate(rows):
+        row = row[: column_count - 1] + [" ".join(row[column_count - 1 :])] if len(row) > column_count else row
+        for column_index, content in enumerate(row):
+            cells.append(SimpleNamespace(
+                row_index=row_index,
+                column_index=column_index,
+                row_span=1,
+                column_span=column_count - column_index if column_index == len(row) - 1 else 1,
+                kind="columnHeader" if row_index == 0 else "content",
+                content=content,
+            ))
+    length = sum(len(line) + 1 for line in lines)
+    return SimpleNamespace(
+        row_count=len(rows),
+        column_count=column_count,
+        cells=cells,
+        spans=[SimpleNamespace(offset=offset, length=length)],
+        bounding_regions=[SimpleNamespace(page_number=page_number)],
+    )
+
+
+def pdf_pages(filename, cache):
+    # Extracting the text takes far longer than the benchmarks, so it is kept until the PDF changes
+    stat = os.stat(filename)
+    key = f"{filename}:{stat.st_size}:{stat.st_mtime_ns}"
+    if key not in cache:
+        cache[key] = [page.extract_text() for page in PdfReader(filename).pages]
+    return cache[key]
+
+
+def synthesize_result(filename, cache):
+    """A Form Recognizer layout result (the attributes get_document_text and table_to_html read) with the text of the PDF."""
+    content = ""
+    pages = []
+    tables = []
+    for page_num, text in enumerate(pdf_pages(filename, cache)):
+        page_text = text + "\n"
+        if page_num % args.table_every == 0:
+            lines = page_text.split("\n")
+            first = len(lines) // 3
+            table_lines = [line for line in lines[first : first + args.table_lines] if line.strip()]
+            if table_lines:
+                table_offset = len(content) + sum(len(line) + 1 for line in lines[:first])
+                tables.append(synthesize_table(table_lines, table_offset, page_num + 1))
+        pages.append(SimpleNamespace(page_number=page_num + 1, spans=[SimpleNamespace(offset=len(content), length=len(page_text))]))
+        content += page_text
+    return SimpleNamespace(content=content, pages=pages, tables=tables)
+
+
+def load_script(path):
+    """
+    The ingestion scripts parse arguments and call Azure at import time, so only their function definitions and
+    literal constants are run, with the globals those functions use pointed at the synthetic Form Recognizer.
+    """
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    tree.body = [
+        node for node in tree.body
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) or (isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant))
+    ]
+    namespace = {
+        "__name__": os.path.splitext(os.path.basename(path))[0],
+        "os": os,
+        "re": re,
+        "html": html,
+        "args": SimpleNamespace(localpdfparser=False, verbose=False, category=None, formrecognizerservice="benchmark"),
+        "formrecognizer_creds": None,
+        "DocumentAnalysisClient": FakeDocumentAnalysisClient,
+        "filename": "benchmark.pdf",
+    }
+    exec(compile(tree, path, "exec"), namespace)
+    return SimpleNamespace(**namespace)
+
+
+def measure(function):
+    best = float("inf")
+    for _ in range(args.repeat):
+        gc.collect()
+        # data-ingestion-v2.py prints progress for every document
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(name, seconds, chars, unit, count):
+    return {
+        "benchmark": name,
+        "seconds": round(seconds, 6),
+        "chars_per_second": round(chars / seconds),
+        f"{unit}_per_second": round(count / seconds, 1),
+    }
+
+
+def benchmark_script(script, files, results):
+    name = os.path.splitext(script)[0]
+    module = load_script(os.path.join(SCRIPTS_DIR, script))
+    selected = lambda function: hasattr(module, function) and (not args.only or args.only in f"{name}.{function}")
+    chars = sum(len(FakeDocumentAnalysisClient.results[f].content) for f in files)
+
+    if selected("get_document_text"):
+        pages = sum(len(FakeDocumentAnalysisClient.results[f].pages) for f in files)
+        seconds = measure(lambda: [module.get_document_text(f) for f in files])
+        results.append(result(f"{name}.get_document_text", seconds, chars, "pages", pages))
+
+    if selected("table_to_html"):
+        tables = [t for f in files for t in FakeDocumentAnalysisClient.results[f].tables]
+        table_chars = sum(len(c.content) for t in tables for c in t.cells)
+        seconds = measure(lambda: [module.table_to_html(t) for t in tables])
+        results.append(result(f"{name}.table_to_html", seconds, table_chars, "tables", len(tables)))
+
+    page_maps = [(os.path.basename(f), module.get_document_text(f)) for f in files]
+    text_chars = sum(len(p[2]) for _, page_map in page_maps for p in page_map)
+    sections = [s[0] for _, page_map in page_maps for s in module.split_text(page_map)]
+
+    if selected("split_text"):
+        seconds = measure(lambda: [list(module.split_text(page_map)) for _, page_map in page_maps])
+        results.append(result(f"{name}.split_text", seconds, text_chars, "sections", len(sections)))
+
+    if selected("create_sections"):
+        seconds = measure(lambda: [list(module.create_sections(filename, page_map)) for filename, page_map in page_maps])
+        results.append(result(f"{name}.create_sections", seconds, text_chars, "sections", len(sections)))
+
+    section_chars = sum(len(s) for s in sections)
+    for function in ("extract_dni", "extract_cuit", "extract_npoliza"):
+        if selected(function):
+            extract = getattr(module, function)
+            seconds = measure(lambda: [extract(s) for s in sections])
+            results.append(result(f"{name}.{function}", seconds, section_chars, "sections", len(sections)))
+
+
+def compare(results, baseline):
+    """Adds the speedup over the baseline to each result and returns the names of the ones that got slower than the tolerance."""
+    previous = {r["benchmark"]: r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        if r["benchmark"] not in previous:
+            continue
+        r["baseline_seconds"] = previous[r["benchmark"]]["seconds"]
+        r["speedup"] = round(r["baseline_seconds"] / r["seconds"], 2)
+        if r["seconds"] > r["baseline_seconds"] * (1 + args.tolerance):
+            regressions.append(r["benchmark"])
+    return regressions
+
+
+files = sorted(os.path.abspath(f) for f in glob.glob(args.files))
+if not files:
+    sys.exit(f"No files match {args.files}")
+pdf_cache = {}
+if os.path.exists(args.pdf_cache):
+    with open(args.pdf_cache, encoding="utf-8") as f:
+        pdf_cache = json.load(f)
+for f in files:
+    FakeDocumentAnalysisClient.results[f] = synthesize_result(f, pdf_cache)
+with open(args.pdf_cache, "w", encoding="utf-8") as f:
+    json.dump(pdf_cache, f)
+corpus = {
+    "files": [os.path.basename(f) for f in files],
+    "chars": sum(len(r.content) for r in FakeDocumentAnalysisClient.results.values()),
+    "pages": sum(len(r.pages) for r in FakeDocumentAnalysisClient.results.values()),
+    "tables": sum(len(r.tables) for r in FakeDocumentAnalysisClient.results.values()),
+    "table_every": args.table_every,
+    "table_lines": args.table_lines,
+}
+
+results = []
+for script in ("prepdocs.py", "data-ingestion-v2.py"):
+    benchmark_script(script, files, results)
+
+report = {"corpus": corpus, "repeat": args.repeat, "results": results}
+regressions = []
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["corpus"] != corpus:
+        print("Warning: the baseline was measured on a different corpus, the comparison is not meaningful", file=sys.stderr)
+    regressions = compare(results, baseline)
+    report["regressions"] = regressions
+
+print(json.dumps(report, indent=2))
+if args.save_baseline:
+    with open(args.save_baseline, "w") as f:
+        json.dump(report, f, indent=2)
+if regressions:
+    sys.exit(f"Slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
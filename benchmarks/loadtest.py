@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import aiohttp
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Drive /ask or /chat of a running backend at a fixed concurrency and report throughput. Run it once against a build before a change and once after to compare.",
+        epilog="Example: loadtest.py --url http://127.0.0.1:5000 --endpoint chat --concurrency 64 --duration 30 --cores 4",
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="Base URL of the backend")
+    parser.add_argument("--endpoint", choices=["ask", "chat"], default="chat", help="Endpoint to drive")
+    parser.add_argument("--approach", default="rrr", help="Approach to request (rtr, rrr, rda for ask; rrr for chat)")
+    parser.add_argument("--question", default="¿Cuál es la cobertura incluida en mi póliza?", help="Question sent in every request")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of requests kept in flight")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to keep sending requests")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="CPU cores available to the backend, used to report requests/s per core")
+    parser.add_argument("--stream", action="store_true", help="Request Server-Sent Events responses")
+    return parser.parse_args(argv)
+
+
+def request_body(endpoint, approach, question, stream=False):
+    if endpoint == "ask":
+        body = {"approach": approach, "question": question, "overrides": {}}
+    else:
+        body = {"approach": approach, "history": [{"user": question}], "overrides": {}}
+    if stream:
+        body["stream"] = True
+    return body
+
+
+async def worker(session, url, body, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            if body is None:
+                request = session.get(url)
+            else:
+                request = session.post(url, json=body)
+            async with request as response:
+                await response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+                    continue
+        except aiohttp.ClientError as e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.monotonic() - start)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def run_load(url, body, concurrency, duration, cores=os.cpu_count()):
+    # POSTs body to url (GETs it when body is None) from concurrency workers for duration seconds
+    latencies = []
+    errors = []
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=300)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.monotonic()
+        deadline = start + duration
+        await asyncio.gather(*[worker(session, url, body, deadline, latencies, errors) for _ in range(concurrency)])
+        elapsed = time.monotonic() - start
+
+    throughput = len(latencies) / elapsed
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "requests_per_second": round(throughput, 2),
+        "requests_per_second_per_core": round(throughput / cores, 2),
+        "p50_seconds": round(percentile(latencies, 50), 4),
+        "p95_seconds": round(percentile(latencies, 95), 4),
+        "p99_seconds": round(percentile(latencies, 99), 4),
+    }
+
+
+async def main(args):
+    body = request_body(args.endpoint, args.approach, args.question, args.stream)
+    result = await run_load(f"{args.url}/{args.endpoint}", body, args.concurrency, args.duration, args.cores)
+    print(json.dumps({"endpoint": args.endpoint, "approach": args.approach, **result}, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,166 @@
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "app", "backend"))
+
+import lookuptool
+from lookuptool import CsvLookupStore, MappedTable, MemoryTable, key_hash
+
+parser = argparse.ArgumentParser(
+    description="Checks the memory-mapped CSV lookups of app/backend/lookuptool.py (MappedTable) against the in-memory ones "
+    "(MemoryTable) on a generated CSV with more rows than one sort chunk of the index build, values repeated across rows and "
+    "keys whose hashes collide: every looked up value must return the same rows from both. Also checks that CsvLookupStore "
+    "picks MappedTable above its size threshold and reloads when the file is replaced, and reports index build time and "
+    "lookup latency. Exits with an error on any difference.",
+    epilog="Example: lookups.py --rows 2000000 --sort-chunk 1000000",
+)
+parser.add_argument("--rows", type=int, default=200_000, help="Rows of the generated CSV")
+parser.add_argument("--sort-chunk", type=int, default=50_000, help="Records per sorted chunk of the index build (SORT_CHUNK_RECORDS)")
+parser.add_argument("--collisions", type=int, default=20, help="Pairs of keys with the same hash put in the file")
+parser.add_argument("--lookups", type=int, default=5000, help="Random values looked up on top of the colliding, repeated and missing ones")
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+HEADER = ("id", "policy", "name", "notes")
+
+
+def colliding_keys(pairs: int) -> list[tuple[str, str]]:
+    """Pairs of distinct keys with the same key_hash, found by hashing candidates until enough of them share one."""
+    seen: dict[int, str] = {}
+    found = []
+    i = 0
+    while len(found) < pairs:
+        key = f"C{i:09d}"
+        other = seen.setdefault(key_hash(key), key)
+        if other != key:
+            found.append((other, key))
+        i += 1
+    return found
+
+
+def write_csv(path: str, rows: list[tuple[str, ...]]):
+    # Written elsewhere and renamed over the file, as MappedTable requires
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+    os.replace(temp_path, path)
+
+
+def generate_rows(rng: random.Random, collisions: list[tuple[str, str]]) -> tuple[list[tuple[str, ...]], str]:
+    """The rows of the CSV, and a key repeated in several of them."""
+    # Policies are shared by several rows (repeated values of a secondary key), some notes are quoted because of commas
+    policies = [f"100-{n:08d}-01" for n in range(max(1, args.rows // 4))]
+    rows = [
+        (f"K{n:09d}", rng.choice(policies), f"Nombre {n}", "cobertura, granizo" if n % 7 == 0 else "sin notas")
+        for n in range(args.rows)
+    ]
+    for a, b in collisions:
+        rows.append((a, rng.choice(policies), f"Colisión {a}", "hash compartido"))
+        rows.append((b, rng.choice(policies), f"Colisión {b}", "hash compartido"))
+    repeated = rows[0][0]
+    rows.extend((repeated, rows[1][1], f"Repetido {n}", "clave repetida") for n in range(3))
+    rng.shuffle(rows)
+    return rows, repeated
+
+
+def compare(memory: MemoryTable, mapped: MappedTable, values: dict[str, list[str]]) -> list[dict]:
+    differences = []
+    for field, field_values in values.items():
+        for value in field_values:
+            expected, found = sorted(memory.find(field, value)), sorted(mapped.find(field, value))
+            if expected != found:
+                differences.append({"field": field, "value": value, "memory": len(expected), "mapped": len(found)})
+    return differences
+
+
+def main():
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="lookups-")
+    path = os.path.join(workdir, "clients.csv")
+    lookuptool.SORT_CHUNK_RECORDS = args.sort_chunk
+    try:
+        collisions = colliding_keys(args.collisions)
+        rows, repeated = generate_rows(rng, collisions)
+        write_csv(path, rows)
+
+        start = time.perf_counter()
+        memory = MemoryTable(path, ("id", "policy"))
+        memory_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        mapped = MappedTable(path, ("id", "policy"), os.path.join(workdir, "index"))
+        mapped_seconds = time.perf_counter() - start
+
+        ids = [row[0] for row in rows]
+        policies = [row[1] for row in rows]
+        # Colliding, repeated, random and missing values
+        values = {
+            "id": [key for pair in collisions for key in pair]
+            + [repeated]
+            + rng.sample(ids, min(args.lookups, len(ids)))
+            + [f"C{n:09d}-missing" for n in range(100)],
+            "policy": rng.sample(policies, min(args.lookups, len(policies))) + ["999-99999999-99"],
+        }
+        differences = compare(memory, mapped, values)
+        # Every row must be in the index of every field, whatever chunk of the build it was sorted in
+        for field in ("id", "policy"):
+            if len(mapped.indexes[field][2]) != len(rows):
+                differences.append({"field": field, "index_records": len(mapped.indexes[field][2]), "rows": len(rows)})
+        if len(mapped.find("id", repeated)) != 4:
+            differences.append({"field": "id", "value": repeated, "memory": 4, "mapped": len(mapped.find("id", repeated))})
+
+        start = time.perf_counter()
+        for value in values["id"]:
+            mapped.find("id", value)
+        mapped_lookup_us = (time.perf_counter() - start) / len(values["id"]) * 1e6
+        start = time.perf_counter()
+        for value in values["id"]:
+            memory.find("id", value)
+        memory_lookup_us = (time.perf_counter() - start) / len(values["id"]) * 1e6
+
+        # The store serves the file through MappedTable above the threshold and reloads it once it is replaced
+        store_problems = []
+        store = CsvLookupStore(path, "id", ("policy",), index_threshold_bytes=0, index_dir=os.path.join(workdir, "index"))
+        if not isinstance(store.table, MappedTable):
+            store_problems.append(f"store uses {type(store.table).__name__}")
+        key = collisions[0][0]
+        if f"id:{key}" not in (store.lookup(key) or ""):
+            store_problems.append(f"{key} not found by the store")
+        replacement = [row for row in rows if row[0] != key] + [("NEW000000001", "100-00000000-01", "Nuevo", "recargado")]
+        write_csv(path, replacement)
+        os.utime(path, ns=(time.time_ns() + 10**9, time.time_ns() + 10**9))
+        if store.lookup(key) is not None:
+            store_problems.append(f"{key} still found after the file was replaced")
+        if "Nuevo" not in (store.lookup("NEW000000001") or ""):
+            store_problems.append("row added by the replacement not found")
+
+        report = {
+            "rows": len(rows),
+            "sort_chunks": -(-len(rows) // args.sort_chunk),
+            "colliding_keys": 2 * len(collisions),
+            "values_compared": sum(len(v) for v in values.values()),
+            "memory_load_seconds": round(memory_seconds, 2),
+            "mapped_build_seconds": round(mapped_seconds, 2),
+            "memory_lookup_us": round(memory_lookup_us, 2),
+            "mapped_lookup_us": round(mapped_lookup_us, 2),
+            "differences": differences[:20],
+            "store_problems": store_problems,
+        }
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        del store, mapped
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if differences or store_problems:
+        sys.exit("Memory-mapped lookups differ from the in-memory ones")
+
+
+main()
@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(BENCHMARKS_DIR, "..", "app", "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+import openai
+from openai.openai_object import OpenAIObject
+from retrievalcache import CachedSearchClient, CachedSearchResults, CoalescingSearchClient
+from rewritecache import QueryRewriteCache
+from approaches.retrievethenread import RetrieveThenReadApproach
+from approaches.readretrieveread import ReadRetrieveReadApproach
+from approaches.readdecomposeask import ReadDecomposeAsk
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+
+parser = argparse.ArgumentParser(
+    description="Stress test for cross-request leakage: runs many requests at once through approach instances shared by several threads, each "
+    "with its own event loop, as a worker does. Every request asks about its own marker, and OpenAI and Cognitive Search are replaced by "
+    "in-process stand-ins that answer with the markers they were given after a random delay. A request whose sources, answer, thoughts or "
+    "search options mention another request's marker leaked. Exits with an error on any leak or failed request.",
+    epilog="Example: reentrancy.py --threads 4 --concurrency 32 --requests 200",
+)
+parser.add_argument("--scenarios", default="rtr,rtr-stream,rrr,rda,chat,chat-stream", help="Comma separated approaches, -stream for run_stream")
+parser.add_argument("--threads", type=int, default=4, help="Threads running requests, each on its own event loop")
+parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight per thread")
+parser.add_argument("--requests", type=int, default=100, help="Requests per thread and scenario")
+parser.add_argument("--same-question", type=int, default=2, help="Requests per thread asking each question, so identical ones get coalesced or cached")
+parser.add_argument("--max-delay-ms", type=float, default=5, help="Longest random delay of the stand-ins")
+args = parser.parse_args()
+
+# Search queries built from keywords are lowercased
+MARKER = re.compile(r"Q\d{6}Z", re.IGNORECASE)
+# Leaks found by the search stand-in, whose options (the category filter) come from the request's overrides
+search_leaks: list[str] = []
+
+
+def markers(text: str) -> list[str]:
+    return list(dict.fromkeys(m.upper() for m in MARKER.findall(text)))
+
+
+async def delay():
+    await asyncio.sleep(random.uniform(0, args.max_delay_ms) / 1000)
+
+
+def completion_text(prompt: str) -> str:
+    # Replies in the format of the LangChain agents so they search once and answer, with the markers of the prompt
+    found = " ".join(markers(prompt[prompt.rfind("Question:") :] if "Question:" in prompt else prompt))
+    scratchpad = prompt[prompt.rfind("Question:") :]
+    if "Action Input:" in prompt:
+        if "Observation:" in scratchpad:
+            return f" I now know the final answer\nFinal Answer: {found}"
+        return f" I should search for this\nAction: CognitiveSearch\nAction Input: {found}"
+    if "Action: Search[" in prompt:
+        if "Observation:" in scratchpad:
+            return f" I have the answer.\nAction: Finish[{found}]"
+        return f" I need to search.\nAction: Search[{found}]"
+    return found
+
+
+async def fake_completion(engine=None, prompt=None, stream=False, **kwargs):
+    text = completion_text(prompt if isinstance(prompt, str) else "".join(prompt))
+    await delay()
+    if stream:
+        return stream_completion(text)
+    return OpenAIObject.construct_from({
+        "choices": [{"text": text, "index": 0, "finish_reason": "stop", "logprobs": None}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+    })
+
+
+async def stream_completion(text: str):
+    for token in re.findall(r"\S+\s*|\s+", text):
+        await delay()
+        yield OpenAIObject.construct_from({"choices": [{"text": token, "index": 0, "finish_reason": None}]})
+
+
+class FakeSearchClient:
+    async def search(self, search_text, **kwargs):
+        await delay()
+        found = markers(search_text)
+        foreign = set(markers(repr(kwargs))) - set(found)
+        if foreign:
+            search_leaks.append(f"search for {found} with options of {sorted(foreign)}")
+        documents = [
+            {
+                "id": f"{'-'.join(found)}-{i}",
+                "content": f"Cobertura de la póliza {' '.join(found)}, parte {i}.",
+                "sourcepage": f"{'-'.join(found) or 'general'}-{i}.pdf",
+                "sourcefile": f"{'-'.join(found) or 'general'}.pdf",
+                "category": "poliza",
+                "@search.captions": [],
+            }
+            for i in range(kwargs.get("top") or 3)
+        ]
+        return CachedSearchResults(documents, [], len(documents))
+
+
+def create_approaches(workdir: str) -> dict:
+    # Set up as app.py does: searches are coalesced and cached for all requests, rewrites cached in SQLite
+    search_client = CachedSearchClient(CoalescingSearchClient(FakeSearchClient()))
+    rewrite_cache = QueryRewriteCache(os.path.join(workdir, "rewrites.db"))
+    return {
+        "rtr": RetrieveThenReadApproach(search_client, "davinci", "sourcepage", "content"),
+        "rrr": ReadRetrieveReadApproach(search_client, "davinci", "sourcepage", "content"),
+        "rda": ReadDecomposeAsk(search_client, "davinci", "sourcepage", "content"),
+        "chat": ChatReadRetrieveReadApproach(search_client, "chat", "davinci", "sourcepage", "content", query_rewrite_cache=rewrite_cache),
+    }
+
+
+async def ask(approach, name: str, stream: bool, marker: str, overrides: dict) -> dict:
+    question = f"¿Qué cubre la póliza {marker}?"
+    # A second turn, so the search query comes from the rewrite completion (and its cache) rather than from keywords
+    q = [{"user": "Hola", "bot": "Hola, ¿en qué puedo ayudarte?"}, {"user": question}] if name == "chat" else question
+    if not stream:
+        return await approach.run(q, overrides)
+    r = {"answer": ""}
+    async for event in approach.run_stream(q, overrides):
+        answer = event.pop("answer", "")
+        r.update(event)
+        r["answer"] += answer
+    return r
+
+
+def check(marker: str, r: dict) -> list[str]:
+    problems = []
+    foreign = set(markers(json.dumps(r, ensure_ascii=False))) - {marker}
+    if foreign:
+        problems.append(f"{marker} got {sorted(foreign)}")
+    if not r.get("data_points") or not all(marker in d for d in r["data_points"]):
+        problems.append(f"{marker} got sources {r.get('data_points')}")
+    return problems
+
+
+async def run_thread(approach, name: str, stream: bool, outcome: dict):
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def request(i: int):
+        # Every thread asks the same questions, so identical calls meet on different event loops too
+        marker = f"Q{i // args.same_question:06d}Z"
+        overrides = {"exclude_category": marker, "top": 1 + i // args.same_question % 3}
+        async with semaphore:
+            try:
+                r = await ask(approach, name, stream, marker, overrides)
+            except Exception as e:
+                outcome["errors"].append(f"{marker}: {e!r}")
+                return
+        outcome["leaks"].extend(check(marker, r))
+
+    await asyncio.gather(*[request(i) for i in range(args.requests)])
+
+
+def run_scenario(approaches: dict, scenario: str) -> dict:
+    name, _, stream = scenario.partition("-")
+    outcome = {"leaks": [], "errors": []}
+    search_leaks.clear()
+    threads = [
+        threading.Thread(target=asyncio.run, args=(run_thread(approaches[name], name, stream == "stream", outcome),))
+        for _ in range(args.threads)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+    leaks = outcome["leaks"] + search_leaks
+    return {
+        "scenario": scenario,
+        "requests": args.threads * args.requests,
+        "seconds": round(seconds, 2),
+        "leaks": len(leaks),
+        "errors": len(outcome["errors"]),
+        "examples": (leaks + outcome["errors"])[:5],
+    }
+
+
+def main():
+    openai.api_type = "azure"
+    openai.api_key = "reentrancy"
+    openai.Completion.acreate = fake_completion
+
+    # The rrr approach reads data/employeeinfo.csv relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="reentrancy-")
+    os.makedirs(os.path.join(workdir, "data"))
+    with open(os.path.join(workdir, "data", "employeeinfo.csv"), "w", newline="") as f:
+        f.write("name,title,insurance,insurancegroup\nEmployee1,Program Manager,Standard,A\n")
+    os.chdir(workdir)
+
+    approaches = create_approaches(workdir)
+    results = []
+    # The agents log every step to stdout (verbose=True)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for scenario in args.scenarios.split(","):
+            results.append(run_scenario(approaches, scenario.strip()))
+    print(json.dumps({"threads": args.threads, "concurrency": args.concurrency, "results": results}, indent=2, ensure_ascii=False))
+    if any(r["leaks"] or r["errors"] for r in results):
+        sys.exit("Requests leaked into each other or failed")
+
+
+main()
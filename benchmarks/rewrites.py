@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "app", "backend"))
+
+from bm25index import analyze, similar_queries
+
+parser = argparse.ArgumentParser(
+    description="Checks which search queries rewritten by GPT app/backend/bm25index.py's similar_queries takes as equivalent to the "
+    "question as typed, which decides whether chat keeps the speculative search for the question (SPECULATIVE_RETRIEVAL) or "
+    "searches again for the rewrite. Exits with an error when a pair is judged differently than expected.",
+    epilog="Example: rewrites.py --threshold 0.5",
+)
+parser.add_argument("--threshold", type=float, default=0.6, help="Threshold given to similar_queries")
+args = parser.parse_args()
+
+# Question, its rewrite by the query prompt of chatreadretrieveread.py, whether searching for the question is as good
+PAIRS = [
+    ("¿Qué cubre mi póliza de auto por granizo?", "qué cubre póliza auto granizo", True),
+    ("Hola, quisiera saber cuál es la franquicia de mi seguro de moto", "franquicia seguro moto", True),
+    ("¿Cuántos días tengo para denunciar un siniestro?", "plazo denuncia siniestro", True),
+    ("¿Qué cubre mi póliza de auto si me chocan estacionado?", "cobertura póliza auto choque estacionado", True),
+    ("Mi DNI es 30.123.456, ¿qué coberturas tengo?", "coberturas DNI 30123456", True),
+    ("¿La póliza de mi mascota cubre el extravío del perro?", "póliza mascota cobertura extravío perro", True),
+    ("¿Puedo rescindir el contrato del seguro cuando quiera?", "rescindir contrato seguro", True),
+    ("¿Está cubierta la rotura de cristales del auto?", "cobertura rotura cristales auto", True),
+    ("¿y por robo?", "cobertura robo póliza auto", False),
+    ("¿y para la moto?", "cobertura granizo moto", False),
+    ("¿cuánto tiempo tengo para eso?", "plazo denuncia siniestro granizo auto", False),
+    ("¿Qué es la franquicia?", "franquicia cristales póliza auto", False),
+]
+
+
+def main():
+    results = []
+    for question, rewrite, expected in PAIRS:
+        similar = similar_queries(question, rewrite, args.threshold)
+        results.append({
+            "question": question,
+            "rewrite": rewrite,
+            "terms": [analyze(question), analyze(rewrite)],
+            "similar": similar,
+            "ok": similar == expected,
+        })
+    failures = [r for r in results if not r["ok"]]
+    print(json.dumps({
+        "pairs": len(results),
+        "similar": sum(r["similar"] for r in results),
+        "failures": len(failures),
+        "results": results,
+    }, indent=2, ensure_ascii=False))
+    if failures:
+        sys.exit("Rewrites were judged differently than expected")
+
+
+main()
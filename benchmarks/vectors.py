@@ -0,0 +1,248 @@
+import argparse
+import ast
+import glob
+import html
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+import numpy as np
+from pypdf import PdfReader
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCHMARKS_DIR, "..", "scripts")
+DATA_DIR = os.path.join(BENCHMARKS_DIR, "..", "data")
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "app", "backend"))
+
+from vectorindex import VectorIndex, VectorIndexWriter, get_embedder
+
+parser = argparse.ArgumentParser(
+    description="Recall and latency of the local vector index (app/backend/vectorindex.py) on the sections prepdocs.py makes of the sample PDFs. "
+    "Queries are sentences taken from random sections: reports how often a section with the sentence is among the top results (self recall), how many of "
+    "the exact float32 top results the int8 and partitioned (IVF) variants find (recall), query latency percentiles, batch throughput and "
+    "index sizes. Questions about the sample policies worded differently than the policies answer them report how often a section with the "
+    "answer is among the top results (paraphrase recall), which is what an embedding capturing meaning should improve over the default "
+    "hashing one. --scale adds synthetic vectors around the real ones to see how the variants behave on larger collections.",
+    epilog="Example: vectors.py --embedding hashing:512 --nprobe 1,4,16 --scale 200000",
+)
+parser.add_argument("--files", default=os.path.join(DATA_DIR, "*.pdf"), help="PDFs to take the sections from")
+parser.add_argument("--pdf-cache", default=os.path.join(tempfile.gettempdir(), "ingestion-benchmark-pages.json"), help="File keeping the text extracted from the PDFs between runs (shared with ingestion.py)")
+parser.add_argument("--embedding", default="hashing:512", help="Embedding function, as given to prepdocs.py --embedding")
+parser.add_argument("--queries", type=int, default=200, help="Number of queries")
+parser.add_argument("--top", type=int, default=5, help="Results per query")
+parser.add_argument("--lists", type=int, default=0, help="Lists of the partitioned variants, the square root of the number of sections by default")
+parser.add_argument("--nprobe", default="1,4,8,16", help="Comma separated numbers of lists searched in the partitioned variants")
+parser.add_argument("--scale", type=int, default=0, help="Grow the collection to this many vectors with noisy copies of the real ones")
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+
+def pdf_pages(filename, cache):
+    # Same cache as ingestion.py, extracting the text takes far longer than the benchmark
+    stat = os.stat(filename)
+    key = f"{filename}:{stat.st_size}:{stat.st_mtime_ns}"
+    if key not in cache:
+        cache[key] = [page.extract_text() for page in PdfReader(filename).pages]
+    return cache[key]
+
+
+def load_sectioning():
+    """split_text and create_sections of prepdocs.py, which parses arguments and calls Azure at import time."""
+    path = os.path.join(SCRIPTS_DIR, "prepdocs.py")
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    tree.body = [
+        node for node in tree.body
+        if (isinstance(node, ast.FunctionDef) and node.name in ("split_text", "create_sections", "blob_name_from_file_page"))
+        or (isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant))
+    ]
+    namespace = {"os": os, "re": re, "html": html, "args": SimpleNamespace(verbose=False, category=None), "filename": "benchmark.pdf"}
+    exec(compile(tree, path, "exec"), namespace)
+    return SimpleNamespace(**namespace)
+
+
+def load_sections(files):
+    cache = {}
+    if os.path.exists(args.pdf_cache):
+        with open(args.pdf_cache, encoding="utf-8") as f:
+            cache = json.load(f)
+    prepdocs = load_sectioning()
+    sections = []
+    for filename in files:
+        page_map, offset = [], 0
+        for page_num, text in enumerate(pdf_pages(filename, cache)):
+            page_map.append((page_num, offset, text))
+            offset += len(text)
+        sections.extend(prepdocs.create_sections(os.path.basename(filename), page_map))
+    with open(args.pdf_cache, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    return sections
+
+
+def sentence_queries(sections, rng):
+    """Sentences of random sections with enough text."""
+    queries = []
+    candidates = [s for s in sections if len(s["content"].split()) >= 30]
+    for i in rng.choice(len(candidates), min(args.queries, len(candidates)), replace=False):
+        words = candidates[i]["content"].split()
+        start = int(rng.integers(0, len(words) - 12))
+        queries.append(" ".join(words[start : start + int(rng.integers(6, 13))]))
+    return queries
+
+
+# Questions a customer could ask about the sample policies in their own words, and a passage of the section answering
+# them. The questions share few or no words with the passage, so finding it takes more than lexical similarity
+PARAPHRASES = [
+    ("¿cuántos días tengo para avisar que choqué?", "en el plazo establecido de tres (3) días"),
+    ("si manejo después de tomar unas copas, me cubren?", "estado de ebriedad"),
+    ("¿hasta qué distancia me lleva la grúa si me quedo varado?", "servicio de remolque"),
+    ("me rompieron el vidrio de la ventanilla del coche", "cristales de puertas"),
+    ("me dañaron la traba de la puerta al intentar abrir el coche", "rotura de cerraduras"),
+    ("si corro una picada y choco, me pagan?", "competencias, carreras"),
+    ("¿puedo dar de baja el seguro cuando quiera?", "rescindir el presente contrato sin expresar causa"),
+    ("¿qué pasa si se me pierde el perro?", "sacrificio, robo y extravío"),
+    ("¿qué pasa si algo cambia y aumenta el peligro de lo asegurado?", "agravación del riesgo"),
+    ("una tormenta de piedras de hielo me abolló el techo del auto", "granizo"),
+    ("¿está protegida la carga que llevo en el camión por la ruta?", "durante su transporte terrestre"),
+    ("si me sacan el vehículo de la puerta de casa y no aparece", "perdida total por robo"),
+    ("¿cuánto tengo que abonar en total por el seguro?", "premio total"),
+    ("si un temblor de tierra destruye mi vehículo", "terremoto"),
+    ("si le presto el coche a un amigo y lastima a alguien", "persona que con su autorización conduzca"),
+    ("daños por disturbios o una manifestación en la calle", "tumulto popular"),
+    ("¿hay una página en internet para ver mis papeles del seguro?", "web exclusiva de clientes"),
+    ("si el daño lo causó un atentado o un levantamiento armado", "guerrilla, rebelión"),
+]
+
+
+def paraphrase_queries(sections):
+    """The PARAPHRASES whose passage is in some section (all of them with the sample PDFs)."""
+    contents = [" ".join(s["content"].lower().split()) for s in sections]
+    return [(question, passage) for question, passage in PARAPHRASES if any(passage in c for c in contents)]
+
+
+def percentile(values, p):
+    return round(float(np.percentile(values, p)) * 1000, 3)
+
+
+def measure_queries(index, vectors, nprobe):
+    """Row ids (per query) and per query latency of VectorIndex.search, then batch throughput of search_batch."""
+    found, latencies = [], []
+    for vector in vectors:
+        start = time.perf_counter()
+        results = index.search(vector, args.top, nprobe=nprobe)
+        latencies.append(time.perf_counter() - start)
+        found.append([section["id"] for _, section in results])
+    start = time.perf_counter()
+    index.search_batch(vectors, args.top, nprobe=nprobe)
+    batch_seconds = time.perf_counter() - start
+    return found, {
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "batch_queries_per_second": round(len(vectors) / batch_seconds),
+    }
+
+
+def overlap(found, exact):
+    return round(float(np.mean([len(set(f) & set(e)) / max(len(e), 1) for f, e in zip(found, exact)])), 3)
+
+
+def benchmark_variants(sections, vectors, embedder, query_vectors, queries, workdir, paraphrases=(), paraphrase_vectors=None):
+    lists = args.lists or max(2, int(np.sqrt(len(sections))))
+    results, exact = [], None
+    for dtype, partitions in (("float32", 0), ("int8", 0), ("float32", lists), ("int8", lists)):
+        path = os.path.join(workdir, f"{dtype}-{partitions}.idx")
+        writer_start = time.perf_counter()
+        write_index_from_vectors(path, sections, vectors, embedder, dtype, partitions)
+        build_seconds = time.perf_counter() - writer_start
+        index = VectorIndex(path)
+        for nprobe in [int(n) for n in args.nprobe.split(",")] if partitions else [None]:
+            found, timing = measure_queries(index, query_vectors, nprobe)
+            exact = exact or found
+            r = {
+                "variant": f"{dtype}" + (f" ivf{partitions} nprobe={nprobe}" if partitions else " exact"),
+                "size_mb": round(os.path.getsize(path) / 2**20, 2),
+                "build_seconds": round(build_seconds, 2),
+                f"recall@{args.top}": overlap(found, exact),
+                **timing,
+            }
+            if queries:
+                # Several sample PDFs share pages, any section with the sentence counts
+                contents = {s["id"]: " ".join(s["content"].split()) for s in sections}
+                r[f"self_recall@{args.top}"] = round(float(np.mean([any(t in contents[i] for i in f) for f, t in zip(found, queries)])), 3)
+            if paraphrases:
+                lowered = {s["id"]: " ".join(s["content"].lower().split()) for s in sections}
+                answered = [
+                    any(passage in lowered[section["id"]] for _, section in index.search(vector, args.top, nprobe=nprobe))
+                    for (_, passage), vector in zip(paraphrases, paraphrase_vectors)
+                ]
+                r[f"paraphrase_recall@{args.top}"] = round(float(np.mean(answered)), 3)
+            results.append(r)
+    return results
+
+
+def write_index_from_vectors(path, sections, vectors, embedder, dtype, lists):
+    # The vectors are computed once for all variants instead of by VectorIndexWriter.add_sections
+    writer = VectorIndexWriter(embedder, dtype, lists)
+    for section, vector in zip(sections, vectors):
+        writer.add(section, vector)
+    writer.write(path)
+
+
+def scaled(sections, vectors, rng):
+    """The real sections plus noisy copies of their vectors up to --scale, with ids but no content."""
+    extra = args.scale - len(sections)
+    if extra <= 0:
+        return sections, vectors
+    sources = rng.integers(0, len(vectors), extra)
+    noise = rng.normal(0, 0.5 / np.sqrt(vectors.shape[1]), (extra, vectors.shape[1])).astype(np.float32)
+    synthetic = vectors[sources] + noise
+    synthetic /= np.linalg.norm(synthetic, axis=1, keepdims=True)
+    return sections + [{"id": f"synthetic-{i}"} for i in range(extra)], np.vstack([vectors, synthetic])
+
+
+def main():
+    files = sorted(os.path.abspath(f) for f in glob.glob(args.files))
+    if not files:
+        sys.exit(f"No files match {args.files}")
+    rng = np.random.default_rng(args.seed)
+    sections = load_sections(files)
+    embedder = get_embedder(args.embedding)
+
+    start = time.perf_counter()
+    vectors = embedder.embed([s["content"] for s in sections])
+    embed_seconds = time.perf_counter() - start
+
+    queries = sentence_queries(sections, rng)
+    start = time.perf_counter()
+    query_vectors = embedder.embed(queries)
+    query_embed_seconds = time.perf_counter() - start
+
+    paraphrases = paraphrase_queries(sections)
+    paraphrase_vectors = embedder.embed([question for question, _ in paraphrases]) if paraphrases else None
+
+    workdir = tempfile.mkdtemp(prefix="vectors-")
+    report = {
+        "corpus": {"files": [os.path.basename(f) for f in files], "sections": len(sections)},
+        "embedding": embedder.spec,
+        "embed_sections_per_second": round(len(sections) / embed_seconds),
+        "embed_query_ms": round(query_embed_seconds / len(queries) * 1000, 3),
+        "queries": len(queries),
+        "paraphrases": len(paraphrases),
+        "results": benchmark_variants(
+            sections, vectors, embedder, query_vectors, queries, workdir, paraphrases, paraphrase_vectors
+        ),
+    }
+    if args.scale:
+        # Targets would be ambiguous among the noisy copies, only recall against exact search is meaningful
+        scaled_sections, scaled_vectors = scaled(sections, vectors, rng)
+        report["scaled"] = {
+            "vectors": len(scaled_sections),
+            "results": benchmark_variants(scaled_sections, scaled_vectors, embedder, query_vectors, None, workdir),
+        }
+    print(json.dumps(report, indent=2))
+
+
+main()
@@ -3,6 +3,9 @@ import glob
 import html
 import io
 import re
+import sys
+import urllib.error
+import urllib.request
 from PyPDF2 import PdfReader, PdfWriter
 from azure.identity import AzureDeveloperCliCredential
 from azure.core.credentials import AzureKeyCredential
@@ -13,6 +16,11 @@ from azure.search.documents import SearchClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from dotenv import load_dotenv
 
+# El índice local se escribe con el mismo código del backend, para que analice el texto igual al buscar
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from bm25index import BM25Index, BM25IndexWriter
+from vectorindex import VectorIndex, VectorIndexWriter, get_embedder
+
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
@@ -48,6 +56,20 @@ creds = AzureDeveloperCliCredential()
 search_creds = AzureKeyCredential(SEARCH_KEY)  # AzureDeveloperCliCredential()
 formrecognizer_creds = AzureKeyCredential(FORM_KEY)  # AzureDeveloperCliCredential()
 storage_creds = os.getenv("AZURE_STORAGE_CREDENTIAL")  # AzureDeveloperCliCredential()
+# Opcional: endpoint /cache/invalidate del backend, para descartar resultados de búsqueda cacheados luego de indexar
+CACHE_INVALIDATION_URL = os.getenv("BACKEND_CACHE_INVALIDATION_URL")
+CACHE_INVALIDATION_KEY = os.getenv("SEARCH_CACHE_INVALIDATION_KEY")
+# Opcional: archivo del índice BM25 local que el backend usa cuando Cognitive Search falla o demora (LOCAL_INDEX_PATH)
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH")
+# Opcional: archivo del índice vectorial local que el backend combina con Cognitive Search (VECTOR_INDEX_PATH), con la
+# función de embedding EMBEDDING (hashing[:<dimensiones>] o python:<módulo>:<función>), vectores int8 si
+# VECTOR_INDEX_INT8 y particionado en VECTOR_INDEX_LISTS listas. El embedding hashing (el default) es solo léxico: no
+# agrega recall semántico, no encuentra las secciones que responden preguntas formuladas con otras palabras que las
+# pólizas (ver benchmarks/vectors.py). Para eso hace falta un embedding python: basado en un modelo
+VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH")
+EMBEDDING = os.getenv("EMBEDDING") or "hashing:512"
+VECTOR_INDEX_INT8 = os.getenv("VECTOR_INDEX_INT8", "").lower() in ("1", "true")
+VECTOR_INDEX_LISTS = int(os.getenv("VECTOR_INDEX_LISTS") or 0)
 
 
 def table_to_html(table):
@@ -197,15 +219,11 @@ def create_search_index():
                 SearchableField(
                     name="content", type="Edm.String", analyzer_name="en.microsoft"
                 ),
-                SearchableField(
-                    name="dni", type="Edm.String", analyzer_name="en.microsoft"
-                ),
-                SearchableField(
-                    name="cuit", type="Edm.String", analyzer_name="en.microsoft"
-                ),
-                SearchableField(
-                    name="npoliza", type="Edm.String", analyzer_name="en.microsoft"
-                ),
+                # Filtrables tal cual: el backend limita las búsquedas al cliente con filtros dni/cuit eq. La búsqueda
+                # de texto completo los sigue encontrando en el contenido, que empieza con ellos
+                SimpleField(name="dni", type="Edm.String", filterable=True),
+                SimpleField(name="cuit", type="Edm.String", filterable=True),
+                SimpleField(name="npoliza", type="Edm.String", filterable=True),
                 SimpleField(
                     name="category", type="Edm.String", filterable=True, facetable=True
                 ),
@@ -240,6 +258,13 @@ def create_search_index():
         index_client.create_index(index)
     else:
         print(f"Search index {args.index} already exists")
+        fields = {f.name: f for f in index_client.get_index(args.index).fields}
+        if not all(fields.get(name) and fields[name].filterable for name in ("dni", "cuit", "npoliza")):
+            # Los campos de un índice existente no se pueden cambiar, hay que borrarlo y volver a indexar
+            print(
+                f"Warning: the dni, cuit and npoliza fields of {args.index} are not filterable, the backend can't scope "
+                "searches to a customer (CUSTOMER_SCOPED_SEARCH) until the index is deleted and the documents indexed again"
+            )
 
 
 def blob_name_from_file_page(filename, page=0):
@@ -311,9 +336,11 @@ def create_sections(filename, page_map):
                     "category": args.category,
                     "sourcepage": blob_name_from_file_page(filename, pagenum),
                     "sourcefile": filename,
-                    "dni": dni,
-                    "cuit": cuit,
-                    "npoliza": npoliza,
+                    # Los valores vigentes para la sección, no solo los que aparecen en ella, para que filtrar por
+                    # DNI o CUIT devuelva todas las secciones de la póliza
+                    "dni": dni_value,
+                    "cuit": cuit_value,
+                    "npoliza": npoliza_value,
                 }
             )
 
@@ -364,6 +391,49 @@ def index_sections(filename, sections):
         print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
 
 
+def invalidate_backend_cache():
+    if not CACHE_INVALIDATION_URL:
+        return
+    print(f"Invalidating backend search cache at '{CACHE_INVALIDATION_URL}'")
+    request = urllib.request.Request(
+        CACHE_INVALIDATION_URL,
+        method="POST",
+        headers={"X-Cache-Invalidation-Key": CACHE_INVALIDATION_KEY or ""},
+    )
+    try:
+        urllib.request.urlopen(request, timeout=30)
+    except urllib.error.URLError as e:
+        print(
+            f"Warning: could not invalidate the backend search cache, cached results expire on their own: {e}"
+        )
+
+
+def start_local_index(filenames):
+    # Se reemplazan las secciones de los archivos procesados y se mantienen las de los demás
+    writer = BM25IndexWriter()
+    if os.path.exists(LOCAL_INDEX_PATH):
+        names = {os.path.basename(f) for f in filenames}
+        for section in BM25Index(LOCAL_INDEX_PATH).documents():
+            if section.get("sourcefile") not in names:
+                writer.add(section)
+    return writer
+
+
+def start_vector_index(filenames):
+    writer = VectorIndexWriter(get_embedder(EMBEDDING), "int8" if VECTOR_INDEX_INT8 else "float32", VECTOR_INDEX_LISTS)
+    if os.path.exists(VECTOR_INDEX_PATH):
+        names = {os.path.basename(f) for f in filenames}
+        index = VectorIndex(VECTOR_INDEX_PATH)
+        kept = [(section, vector) for section, vector in index.rows() if section.get("sourcefile") not in names]
+        if index.embedding == writer.embedding:
+            for section, vector in kept:
+                writer.add(section, vector)
+        else:
+            # Los vectores de distintas funciones de embedding no son comparables, se vuelven a calcular
+            writer.add_sections([section for section, _ in kept])
+    return writer
+
+
 def split_text(page_map):
     SENTENCE_ENDINGS = [".", "!", "?"]
     WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
@@ -445,7 +515,10 @@ def split_text(page_map):
 
 
 create_search_index()
-for filename in glob.glob(DATA_PATH):
+filenames = glob.glob(DATA_PATH)
+local_index = start_local_index(filenames) if LOCAL_INDEX_PATH else None
+vector_index = start_vector_index(filenames) if VECTOR_INDEX_PATH else None
+for filename in filenames:
     print("Processing:", filename)
     upload_blobs(filename)
     page_map = get_document_text(filename)
@@ -454,3 +527,15 @@ for filename in glob.glob(DATA_PATH):
     npolizas = extract_npoliza
     sections = create_sections(os.path.basename(filename), page_map)
     index_sections(os.path.basename(filename), sections)
+    if local_index:
+        for section in sections:
+            local_index.add(section)
+    if vector_index:
+        vector_index.add_sections(sections)
+if local_index:
+    print(f"Writing {len(local_index.documents)} sections to local index '{LOCAL_INDEX_PATH}'")
+    local_index.write(LOCAL_INDEX_PATH)
+if vector_index:
+    print(f"Writing {len(vector_index.sections)} sections to local vector index '{VECTOR_INDEX_PATH}'")
+    vector_index.write(VECTOR_INDEX_PATH)
+invalidate_backend_cache()
@@ -4,7 +4,10 @@ import glob
 import html
 import io
 import re
+import sys
 import time
+import urllib.error
+import urllib.request
 from pypdf import PdfReader, PdfWriter
 from azure.identity import AzureDeveloperCliCredential
 from azure.core.credentials import AzureKeyCredential
@@ -14,6 +17,11 @@ from azure.search.documents.indexes.models import *
 from azure.search.documents import SearchClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
+# The local index is written with the backend's own code, so that it analyzes text the same way when searching
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from bm25index import BM25Index, BM25IndexWriter
+from vectorindex import VectorIndex, VectorIndexWriter, get_embedder
+
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
@@ -37,6 +45,13 @@ parser.add_argument("--removeall", action="store_true", help="Remove all blobs f
 parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
 parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
 parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+parser.add_argument("--invalidatecacheurl", required=False, help="Optional. URL of the backend's /cache/invalidate endpoint, called once indexing or removal is done so cached search results are dropped")
+parser.add_argument("--invalidatecachekey", required=False, help="Optional. Value of SEARCH_CACHE_INVALIDATION_KEY configured in the backend")
+parser.add_argument("--localindex", required=False, help="Optional. Also write the sections to this local BM25 index file, which the backend can search when Cognitive Search is slow or failing (LOCAL_INDEX_PATH). Sections of other files already in it are kept")
+parser.add_argument("--vectorindex", required=False, help="Optional. Also write the sections and their embeddings to this local vector index file, which the backend can search beside Cognitive Search (VECTOR_INDEX_PATH). Sections of other files already in it are kept")
+parser.add_argument("--embedding", default="hashing:512", help="Embedding function for --vectorindex: hashing[:<dimensions>] (no model needed, but lexical only: it adds no semantic recall, questions worded differently than the documents are not found) or python:<module>:<function> taking a list of texts and returning their vectors, importable by the backend too")
+parser.add_argument("--vectorint8", action="store_true", help="Store the vectors of --vectorindex as int8 instead of float32, a quarter of the size")
+parser.add_argument("--vectorlists", type=int, default=0, help="Partition the vectors of --vectorindex in this many lists, of which the backend only searches the closest (VECTOR_INDEX_NPROBE). Worth it from tens of thousands of sections")
 parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
 args = parser.parse_args()
 
@@ -291,15 +306,66 @@ def remove_from_index(filename):
         # It can take a few seconds for search results to reflect changes, so wait a bit
         time.sleep(2)
 
+def start_local_index(filenames):
+    # The sections of the files processed in this run are replaced (or removed), the ones of other files are kept
+    writer = BM25IndexWriter()
+    if os.path.exists(args.localindex):
+        names = {os.path.basename(f) for f in filenames}
+        for section in BM25Index(args.localindex).documents():
+            if section.get("sourcefile") not in names:
+                writer.add(section)
+    return writer
+
+def write_local_index(writer):
+    if args.verbose: print(f"Writing {len(writer.documents)} sections to local index '{args.localindex}'")
+    writer.write(args.localindex)
+
+def start_vector_index(filenames):
+    writer = VectorIndexWriter(get_embedder(args.embedding), "int8" if args.vectorint8 else "float32", args.vectorlists)
+    if os.path.exists(args.vectorindex):
+        names = {os.path.basename(f) for f in filenames}
+        index = VectorIndex(args.vectorindex)
+        kept = [(section, vector) for section, vector in index.rows() if section.get("sourcefile") not in names]
+        if index.embedding == writer.embedding:
+            for section, vector in kept:
+                writer.add(section, vector)
+        else:
+            # Vectors of different embedding functions can't be compared, the sections kept are embedded again
+            if args.verbose: print(f"Embedding {len(kept)} sections of local vector index '{args.vectorindex}' again with '{writer.embedding}' instead of '{index.embedding}'")
+            writer.add_sections([section for section, _ in kept])
+    return writer
+
+def write_vector_index(writer):
+    if args.verbose: print(f"Writing {len(writer.sections)} sections to local vector index '{args.vectorindex}'")
+    writer.write(args.vectorindex)
+
+def invalidate_backend_cache():
+    if args.invalidatecacheurl == None:
+        return
+    if args.verbose: print(f"Invalidating backend search cache at '{args.invalidatecacheurl}'")
+    request = urllib.request.Request(args.invalidatecacheurl, method="POST", headers={"X-Cache-Invalidation-Key": args.invalidatecachekey or ""})
+    try:
+        urllib.request.urlopen(request, timeout=30)
+    except urllib.error.URLError as e:
+        print(f"Warning: could not invalidate the backend search cache, cached results expire on their own: {e}")
+
 if args.removeall:
     remove_blobs(None)
     remove_from_index(None)
+    if args.localindex:
+        write_local_index(BM25IndexWriter())
+    if args.vectorindex:
+        write_vector_index(VectorIndexWriter(get_embedder(args.embedding)))
+    invalidate_backend_cache()
 else:
     if not args.remove:
         create_search_index()
     
     print(f"Processing files...")
-    for filename in glob.glob(args.files):
+    filenames = glob.glob(args.files)
+    local_index = start_local_index(filenames) if args.localindex else None
+    vector_index = start_vector_index(filenames) if args.vectorindex else None
+    for filename in filenames:
         if args.verbose: print(f"Processing '{filename}'")
         if args.remove:
             remove_blobs(filename)
@@ -311,5 +377,15 @@ else:
             if not args.skipblobs:
                 upload_blobs(filename)
             page_map = get_document_text(filename)
-            sections = create_sections(os.path.basename(filename), page_map)
+            sections = list(create_sections(os.path.basename(filename), page_map))
             index_sections(os.path.basename(filename), sections)
+            if local_index:
+                for section in sections:
+                    local_index.add(section)
+            if vector_index:
+                vector_index.add_sections(sections)
+    if local_index:
+        write_local_index(local_index)
+    if vector_index:
+        write_vector_index(vector_index)
+    invalidate_backend_cache()